@@ -1,12 +1,39 @@
 import os
+import sys
 import json
-from glob import glob
+import gzip
+import zlib
+import time
+import pstats
+import shutil
+import hashlib
+import threading
+import importlib.util
+from urllib.parse import urljoin
 import tempfile
-import traceback
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+from slicer.util import VTKObservationMixin
+# SegCommon (the helpers shared by the three modules) sits next to this module's folder in the repo,
+# so it can be imported even when only this module's folder was added to the module paths
+segCommonDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SegCommon')
+if os.path.isdir(segCommonDir) and segCommonDir not in sys.path:
+    sys.path.append(segCommonDir)
+try:
+    from SegCommon import (loadLabelArrayFromFile, readManifest, writeManifest, findMissingFiles,
+        fileSignatures, brainMaskFromArray, computeCaseQC, anomalyScores, qcSummary, CaseStore,
+        DicomIndex, isRemoteUrl, remoteManifestUrl, RemoteFileCache, splitCaseFileRef, caseFileExists,
+        globCaseFiles, readCaseArray, loadCaseVolume, caseNodeName, sitkIJKToRAS, readCaseImage,
+        sitkImageFromArray, readCaseGeometry, findGeometryMismatches, ResampleCache, validateCaseFiles,
+        convertTreeToCaseStores, ActionProfiler, printProfileHotSpots, showCaseLoadTime,
+        lifecycleSnapshot, installMemoryStatusLabel)
+except ModuleNotFoundError as e:
+    if e.name != 'SegCommon':
+        raise
+    raise ModuleNotFoundError('SegCommon not found: add the SegCommon folder of this repository to the Slicer module paths', name='SegCommon') from e
 import logging
 
 
@@ -16,7 +43,7 @@ class BatchSegmenter(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "Batch Segmentation Editor"
         self.parent.categories = ["Segmentation"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ['SegCommon']
         self.parent.contributors = ["Brian Keating (Cortechs.ai)"]
         self.parent.helpText = """"""
         self.parent.helpText += self.getDefaultModuleDocumentationLink()
@@ -25,9 +52,13 @@ class BatchSegmenter(ScriptedLoadableModule):
 
 """
 Possibly relevant example: https://github.com/Slicer/Slicer/blob/a18612bb2584018822347ff4db16439b5c578e00/Utilities/Templates/Modules/Scripted/TemplateKey.py#L104-L108
-Use VTKObservationMixin and removeObservers()
 """
-class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
+class BatchSegmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
+
+    def __init__(self, parent=None):
+        ScriptedLoadableModuleWidget.__init__(self, parent)
+        VTKObservationMixin.__init__(self)
+
 
     def setup(self):
         ScriptedLoadableModuleWidget.setup(self)
@@ -37,7 +68,6 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         print('Loading config from ', config_fn)
         with open(config_fn) as f:
             self.config = json.load(f)
-        self.labelNameToLabelVal = {val: key for key, val in self.config['labelNames'].items()}
 
         #### Data Area ####
 
@@ -54,6 +84,39 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         self.selectDataButton.enabled = True
         dataFormLayout.addRow(qt.QLabel('Cases:'), self.selectDataButton)
 
+        # Load/save a manifest (csv with one row per case) instead of selecting folders
+        manifestLayout = qt.QHBoxLayout()
+        self.loadManifestButton = qt.QPushButton('Load Manifest')
+        self.loadManifestButton.toolTip = 'Load cases from a csv with columns: case, image columns, seg column(s)'
+        manifestLayout.addWidget(self.loadManifestButton)
+        self.saveManifestButton = qt.QPushButton('Save Manifest')
+        self.saveManifestButton.toolTip = 'Save the loaded cases to a csv so they can be reopened without scanning folders'
+        self.saveManifestButton.enabled = False
+        manifestLayout.addWidget(self.saveManifestButton)
+        self.loadFromUrlButton = qt.QPushButton('Load from URL')
+        self.loadFromUrlButton.toolTip = 'Load cases from a dataset hosted over http(s): a base url with a manifest.csv, or the url of a manifest csv'
+        manifestLayout.addWidget(self.loadFromUrlButton)
+        self.checkFilesExistCheckBox = qt.QCheckBox('Check files exist')
+        self.checkFilesExistCheckBox.toolTip = 'Skip manifest cases whose files are missing (checked in parallel)'
+        manifestLayout.addWidget(self.checkFilesExistCheckBox)
+        dataFormLayout.addRow(qt.QLabel('Manifest:'), manifestLayout)
+
+        # Pre-flight check of the case files (gzip CRC and headers)
+        integrityLayout = qt.QHBoxLayout()
+        self.validateFilesCheckBox = qt.QCheckBox('Validate files on load')
+        self.validateFilesCheckBox.toolTip = 'Check the gzip CRC and header of every case file (in parallel) when cases are loaded; later checks only read files that changed'
+        self.validateFilesCheckBox.checked = self.config.get('validateFiles', False)
+        integrityLayout.addWidget(self.validateFilesCheckBox)
+        self.validateNowButton = qt.QPushButton('Validate Now')
+        self.validateNowButton.toolTip = 'Check the files of all loaded cases and mark the cases with corrupt files'
+        integrityLayout.addWidget(self.validateNowButton)
+        dataFormLayout.addRow(qt.QLabel('Integrity:'), integrityLayout)
+
+        # Convert folders of image files to chunked case stores (which can be selected like data folders)
+        self.convertToCaseStoresButton = qt.QPushButton('Convert Folders to Case Stores')
+        self.convertToCaseStoresButton.toolTip = 'Convert a folder tree of files matching the config patterns into chunked case stores (same folder layout), which load faster'
+        dataFormLayout.addRow(qt.QLabel('Case Stores:'), self.convertToCaseStoresButton)
+
         # Combobox to display selected folders
         self.caseComboBox = qt.QComboBox()
         self.caseComboBox.enabled = False
@@ -91,14 +154,157 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         self.segEditorWidget.setReadOnly(False)
         segFormLayout.addRow(self.segEditorWidget)
 
+        # Undo/redo between saved versions of the label file (persists across case switches)
+        editHistoryLayout = qt.QHBoxLayout()
+        self.undoSavedEditButton = qt.QPushButton('Undo Saved Edit')
+        self.undoSavedEditButton.toolTip = 'Revert the label file to its previously saved version'
+        editHistoryLayout.addWidget(self.undoSavedEditButton)
+        self.redoSavedEditButton = qt.QPushButton('Redo Saved Edit')
+        self.redoSavedEditButton.toolTip = 'Re-apply the most recently undone saved edit'
+        editHistoryLayout.addWidget(self.redoSavedEditButton)
+        segFormLayout.addRow(editHistoryLayout)
+
+        # Live volume of each ROI
+        self.volumeStatsTable = qt.QTableWidget()
+        self.volumeStatsTable.setColumnCount(4)
+        self.volumeStatsTable.setHorizontalHeaderLabels(['ROI', 'Voxels', 'Volume (mL)', 'Change (mL)'])
+        self.volumeStatsTable.horizontalHeader().setStretchLastSection(True)
+        self.volumeStatsTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.volumeStatsTable.setRowCount(len(self.config['labelNames']))
+        for row, labelName in enumerate(self.config['labelNames'].values()):
+            self.volumeStatsTable.setItem(row, 0, qt.QTableWidgetItem(labelName))
+        segFormLayout.addRow(self.volumeStatsTable)
+
+        # coalesce the segment-modified events of a paint stroke into one update
+        self.volumeStatsTimer = qt.QTimer()
+        self.volumeStatsTimer.setSingleShot(True)
+        self.volumeStatsTimer.setInterval(200)
+
+        #### Interpolation Area ####
+
+        interpolationCollapsibleButton = ctk.ctkCollapsibleButton()
+        interpolationCollapsibleButton.text = 'Slice Interpolation'
+        interpolationCollapsibleButton.collapsed = True
+        self.layout.addWidget(interpolationCollapsibleButton)
+        interpolationFormLayout = qt.QFormLayout(interpolationCollapsibleButton)
+
+        # draw the selected ROI on every Nth slice and fill the slices in between
+        self.interpolateCheckBox = qt.QCheckBox('Fill between drawn slices while editing')
+        self.interpolateCheckBox.toolTip = 'Fill the slices between the slices you drew of the selected ROI by shape-based (signed distance) interpolation, updated as you draw'
+        interpolationFormLayout.addRow(self.interpolateCheckBox)
+        self.fillGapsButton = qt.QPushButton('Fill Gaps Now')
+        self.fillGapsButton.toolTip = 'Fill the slices between the drawn slices of the ROI selected in the segment editor'
+        interpolationFormLayout.addRow(self.fillGapsButton)
+        self.interpolationStatusLabel = qt.QLabel('')
+        interpolationFormLayout.addRow(self.interpolationStatusLabel)
+
+        # coalesce the segment-modified events of a paint stroke into one interpolation
+        self.interpolationTimer = qt.QTimer()
+        self.interpolationTimer.setSingleShot(True)
+        self.interpolationTimer.setInterval(300)
+
+        #### Islands Area ####
+
+        islandsCollapsibleButton = ctk.ctkCollapsibleButton()
+        islandsCollapsibleButton.text = 'Islands'
+        islandsCollapsibleButton.collapsed = True
+        self.layout.addWidget(islandsCollapsibleButton)
+        islandsFormLayout = qt.QFormLayout(islandsCollapsibleButton)
+
+        # connected components of every ROI, smallest first; click a row to jump to it
+        self.islandsTable = qt.QTableWidget()
+        self.islandsTable.setColumnCount(3)
+        self.islandsTable.setHorizontalHeaderLabels(['ROI', 'Voxels', 'Centroid (RAS)'])
+        self.islandsTable.horizontalHeader().setStretchLastSection(True)
+        self.islandsTable.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+        self.islandsTable.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+        islandsFormLayout.addRow(self.islandsTable)
+
+        self.minIslandSizeSpinBox = qt.QSpinBox()
+        self.minIslandSizeSpinBox.setRange(1, 100000)
+        self.minIslandSizeSpinBox.setValue(self.config.get('minIslandSize', 10))
+        self.minIslandSizeSpinBox.toolTip = 'Connected components smaller than this (in voxels) are removed'
+        islandsFormLayout.addRow('Min island size:', self.minIslandSizeSpinBox)
+
+        removeIslandsLayout = qt.QHBoxLayout()
+        self.removeIslandsButton = qt.QPushButton('Remove Islands')
+        self.removeIslandsButton.toolTip = 'Remove small islands from every ROI of the current case'
+        removeIslandsLayout.addWidget(self.removeIslandsButton)
+        self.removeIslandsAllCasesButton = qt.QPushButton('Remove Islands in All Cases')
+        self.removeIslandsAllCasesButton.toolTip = 'Remove small islands from the label files of every selected case'
+        removeIslandsLayout.addWidget(self.removeIslandsAllCasesButton)
+        islandsFormLayout.addRow(removeIslandsLayout)
+
+        #### Cohort QC Area ####
+
+        qcCollapsibleButton = ctk.ctkCollapsibleButton()
+        qcCollapsibleButton.text = 'Cohort QC'
+        qcCollapsibleButton.collapsed = True
+        self.layout.addWidget(qcCollapsibleButton)
+        qcFormLayout = qt.QFormLayout(qcCollapsibleButton)
+
+        self.runQCButton = qt.QPushButton('Run Cohort QC')
+        self.runQCButton.toolTip = 'Measure ROI volumes, connected components and extents of every case, and flag unknown labels'
+        qcFormLayout.addRow(self.runQCButton)
+        self.orderByAnomalyCheckBox = qt.QCheckBox('Most suspicious cases first')
+        self.orderByAnomalyCheckBox.toolTip = 'Order the cases by QC anomaly score instead of by name'
+        qcFormLayout.addRow('Case order:', self.orderByAnomalyCheckBox)
+
+        #### Developer Area ####
+
+        developerCollapsibleButton = ctk.ctkCollapsibleButton()
+        developerCollapsibleButton.text = 'Developer'
+        developerCollapsibleButton.collapsed = True
+        self.layout.addWidget(developerCollapsibleButton)
+        developerFormLayout = qt.QFormLayout(developerCollapsibleButton)
+
+        self.profileActionsCheckBox = qt.QCheckBox('Profile user actions')
+        self.profileActionsCheckBox.toolTip = 'Run data selection, case changes and saves under cProfile and save one profile per action'
+        developerFormLayout.addRow(self.profileActionsCheckBox)
+        self.slowestActionsList = qt.QListWidget()
+        self.slowestActionsList.toolTip = 'Slowest profiled actions of this session. Click one to print its hot spots in the Python console'
+        developerFormLayout.addRow('Slowest actions:', self.slowestActionsList)
+
         ## Add vertical spacer to keep widgets near top
         self.layout.addStretch(1)
         
         ### connections ###
+        # wrap the profiled handlers before they are connected
+        self.actionProfiler = ActionProfiler(
+            self.config.get('profileFolder') or os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'profiles'),
+            lambda: self.active_case_name, self.updateSlowestActions)
+        self.actionProfiler.wrap(self, {
+            'onSelectDataButtonPressed': 'select data',
+            'onLoadManifestButtonPressed': 'select data',
+            'onLoadFromUrlButtonPressed': 'select data',
+            'onComboboxChanged': 'case change',
+            'saveActiveSegmentation': 'save',
+            'onSaveManifestButtonPressed': 'save manifest',
+        })
+        self.profileActionsCheckBox.connect('toggled(bool)', self.onProfileActionsToggled)
+        self.slowestActionsList.connect('itemClicked(QListWidgetItem*)', self.onSlowestActionClicked)
         self.selectDataButton.clicked.connect(self.onSelectDataButtonPressed)
         self.previousImageButton.connect('clicked(bool)', self.previousImage)
         self.nextImageButton.connect('clicked(bool)', self.nextImage)
         self.caseComboBox.connect('currentIndexChanged(const QString&)', self.onComboboxChanged)
+        self.loadManifestButton.connect('clicked(bool)', self.onLoadManifestButtonPressed)
+        self.loadFromUrlButton.connect('clicked(bool)', self.onLoadFromUrlButtonPressed)
+        self.convertToCaseStoresButton.connect('clicked(bool)', self.onConvertToCaseStoresButtonPressed)
+        self.validateNowButton.connect('clicked(bool)', self.validateCases)
+        self.volumeStatsTimer.connect('timeout()', self.updateModifiedSegmentStats)
+        self.interpolationTimer.connect('timeout()', self.interpolateSelectedRoi)
+        self.fillGapsButton.connect('clicked(bool)', self.interpolateSelectedRoi)
+        self.islandsTable.connect('cellClicked(int, int)', self.onIslandClicked)
+        self.removeIslandsButton.connect('clicked(bool)', self.removeIslands)
+        self.removeIslandsAllCasesButton.connect('clicked(bool)', self.removeIslandsInAllCases)
+        self.runQCButton.connect('clicked(bool)', self.onRunQCButtonPressed)
+        self.orderByAnomalyCheckBox.connect('toggled(bool)', self.onOrderByAnomalyToggled)
+        self.saveManifestButton.connect('clicked(bool)', self.onSaveManifestButtonPressed)
+        self.undoSavedEditButton.connect('clicked(bool)', self.undoSavedEdit)
+        self.redoSavedEditButton.connect('clicked(bool)', self.redoSavedEdit)
+
+        # process memory and scene size readout in the status bar
+        installMemoryStatusLabel()
 
         ### Logic ###
         self.image_label_dict = OrderedDict()
@@ -107,6 +313,30 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         self.selected_image_ind = None
         self.active_label_fn = None
         self.dataFolders = None
+        self.dataSource = None  # {'folders': [...]} or {'manifest': path or url}, identifies the session
+        self.sessionRestoreAttempted = False
+        self.lifecycleLog = []  # (before, after) lifecycleSnapshot of each clearNodes call
+        self.qcResults = {}  # case name -> output of computeCaseQC
+        self.qcScores = {}  # case name -> anomaly score
+        self.loadedCaseOrder = None  # case names in the order they were loaded, while ordered by anomaly score
+        self.active_case_name = None
+        self.savedLabelArray = None  # label array as last written to (or read from) active_label_fn
+        self.savedLabelSignature = None  # size/mtime of active_label_fn when savedLabelArray was written (or read)
+        self.loadedLabelArray = None  # label array as read from active_label_fn, for the change audit
+        self.caseLoadTime = None
+        self.islands = []  # (labelVal, size, centroid RAS) per row of self.islandsTable
+        self.baselineVoxelCounts = {}  # labelVal -> voxel count when the case was loaded
+        self.voxelCounts = {}  # labelVal -> current voxel count
+        self.statsLayers = {}  # segmentation layer index -> (extent, segment IDs, layer array copy, label value counts) at the last stats update
+        self.voxelVolumeMl = 0
+        self.modifiedSegmentIds = set()
+        self.sliceInterpolators = {}  # labelVal -> SliceInterpolator of the current case
+        self.interpolating = False  # True while interpolated slices are written to the segmentation
+        self.badCaseFiles = {}  # case name -> {file: problem} from the last validation
+        self.resampleCache = ResampleCache(os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'resampled'))
+        self.resampleTargets = {}  # file -> grid of its case's first image, for files on a different grid
+        self.resampledCases = {}  # case name -> its files that are resampled onto the first image's grid
+        self.geometryCheckedCases = set()
 
 
     def onSelectDataButtonPressed(self):
@@ -124,40 +354,376 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         if file_dialog.exec_():
             data_folders = file_dialog.selectedFiles()
             self.image_label_dict = OrderedDict()
+            self.loadedCaseOrder = None
             for data_folder in data_folders:
-                folder_ims = [glob(os.path.join(data_folder, im_fn)) for im_fn in self.config['imageFilenamePatterns']]
+                folder_ims = [globCaseFiles(data_folder, im_fn) for im_fn in self.config['imageFilenamePatterns']]
                 has_required_ims = all(len(ims)==1 for ims in folder_ims)
-                has_label = len(glob(os.path.join(data_folder, self.config['labelFilenamePattern']))) == 1
+                has_label = len(globCaseFiles(data_folder, self.config['labelFilenamePattern'])) == 1
                 if has_required_ims and has_label:
                     folder_name = os.path.basename(data_folder)
                     im_fns = [ims[0] for ims in folder_ims]
-                    label_fn = glob(os.path.join(data_folder, self.config['labelFilenamePattern']))[0]
+                    label_fn = globCaseFiles(data_folder, self.config['labelFilenamePattern'])[0]
                     self.image_label_dict[folder_name] = im_fns, label_fn
                 else:
                     print('WARNING: Skipping '+data_folder+' because it is missing (or contains multiple) required input images')
+            self.dataSource = {'folders': sorted(data_folders)}
+            self.qcResults, self.qcScores = {}, {}
+            self.preflightCases()
+            self.checkCaseGeometries()
+            self.updateWidgets()
+
+
+    def enter(self):
+        """Resume the last session the first time the module is opened"""
+        if not self.sessionRestoreAttempted:
+            self.sessionRestoreAttempted = True
+            if not self.image_label_dict:
+                self.restoreLastSession()
+
+
+    def datasetKey(self):
+        """Short hash identifying the current dataset (set of data folders or manifest)"""
+        return hashlib.sha1(json.dumps(self.dataSource, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+    def sessionFilename(self):
+        """Session file for the current dataset"""
+        return os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'sessions', self.datasetKey()+'.json')
+
+
+    def auditLogFilename(self):
+        """Change audit log (JSONL) for the current dataset, from the config or in the cache folder"""
+        if self.config.get('auditLogFilename'):
+            return self.config['auditLogFilename']
+        return os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'audit', self.datasetKey()+'.jsonl')
+
+
+    def saveSession(self):
+        """Save the case list and active case so the session can be resumed"""
+        if not self.dataSource or not self.image_label_dict:
+            return
+        session = {
+            'dataSource': self.dataSource,
+            'cases': [[name, im_fns, label_fn] for name, (im_fns, label_fn) in self.image_label_dict.items()],
+            'caseIndex': self.selected_image_ind,
+        }
+        session_fn = self.sessionFilename()
+        os.makedirs(os.path.dirname(session_fn), exist_ok=True)
+        with open(session_fn+'.tmp', 'w') as f:
+            json.dump(session, f)
+        os.replace(session_fn+'.tmp', session_fn)
+        qt.QSettings().setValue('BatchSegmenter/lastSession', session_fn)
+
+
+    def restoreLastSession(self):
+        """Reload the last saved session without rescanning the data folders
+
+        Only the files of the active case are checked (when it is loaded).
+        """
+        session_fn = qt.QSettings().value('BatchSegmenter/lastSession')
+        if not session_fn or not os.path.exists(session_fn):
+            return False
+        print('INFO: resuming session', session_fn)
+        try:
+            with open(session_fn) as f:
+                session = json.load(f)
+            self.dataSource = session['dataSource']
+            image_label_dict = OrderedDict((name, (im_fns, label_fn)) for name, im_fns, label_fn in session['cases'])
+            caseIndex = min(max(session['caseIndex'] or 0, 0), len(image_label_dict) - 1)
+        except (ValueError, KeyError, TypeError) as e:
+            print('WARNING: could not resume session '+session_fn+':', e)
+            return False
+        self.image_label_dict = image_label_dict
+        self.loadedCaseOrder = None
+        self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+        self.preflightCases()
+        self.updateWidgets(caseIndex)
+        return True
+
+
+    def onConvertToCaseStoresButtonPressed(self):
+        """Convert a folder tree of image files into case stores with the same layout, in parallel"""
+        srcRoot = qt.QFileDialog.getExistingDirectory(None, 'Folder Tree to Convert')
+        if not srcRoot:
+            return
+        dstRoot = qt.QFileDialog.getExistingDirectory(None, 'Output Folder for Case Stores')
+        if not dstRoot:
+            return
+        patterns = list(self.config['imageFilenamePatterns']) + [self.config['labelFilenamePattern']]
+        progressDialog = slicer.util.createProgressDialog(labelText='Converting to case stores')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        results = convertTreeToCaseStores(srcRoot, dstRoot, patterns, onProgress)
+        progressDialog.close()
+        numFailed = sum(isinstance(result, Exception) for result in results.values())
+        print('INFO: converted %d folders into case stores under %s (%d failed)' % (len(results) - numFailed, dstRoot, numFailed))
+
+
+    def onLoadManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getOpenFileName(None, 'Load Manifest', '', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.loadManifest(manifest_fn)
+
+
+    def onLoadFromUrlButtonPressed(self):
+        url = qt.QInputDialog.getText(None, 'Load from URL', 'Dataset or manifest URL (http/https):')
+        if url:
+            self.loadManifest(remoteManifestUrl(url.strip()))
+
+
+    def loadManifest(self, manifest_fn):
+        """Load cases from a manifest csv: one read, no globbing
+
+        Image columns are matched to the config's image patterns (see ``matchManifestColumns``),
+        so the images are in config order, and the first seg column is the label file.
+        ``manifest_fn`` can be an http(s) url, in which case relative paths in the manifest are
+        resolved against it and the case files are fetched through the ``RemoteFileCache``.
+        """
+        print('INFO: loading manifest', manifest_fn)
+        imageColumns, segColumns, rows = readManifest(manifest_fn)
+        imagePatterns = list(self.config['imageFilenamePatterns'])
+        patternColumns = matchManifestColumns(imagePatterns, imageColumns)
+        missingColumns = [pattern for pattern, col in zip(imagePatterns, patternColumns) if col is None]
+        if missingColumns or not segColumns:
+            print('ERROR: manifest '+manifest_fn+' needs columns for '+str(imagePatterns)+' and a seg column, missing '+str(missingColumns or ['seg']))
+            return
+        ignoredColumns = [col for col in imageColumns if col not in patternColumns]
+        if ignoredColumns:
+            print('INFO: ignoring manifest columns', ignoredColumns)
+        image_label_dict = OrderedDict()
+        for case_name, paths in rows:
+            im_fns = [paths.get(col) for col in patternColumns]
+            label_fn = paths.get(segColumns[0])
+            if all(im_fns) and label_fn:
+                image_label_dict[case_name] = im_fns, label_fn
+            else:
+                print('WARNING: Skipping '+case_name+' because it is missing required input images')
+
+        # optionally drop cases whose files have disappeared
+        if self.checkFilesExistCheckBox.checked:
+            missing = findMissingFiles(fn for im_fns, label_fn in image_label_dict.values() for fn in im_fns + [label_fn])
+            for case_name, (im_fns, label_fn) in list(image_label_dict.items()):
+                if missing.intersection(im_fns + [label_fn]):
+                    print('WARNING: Skipping '+case_name+' because some of its files are missing')
+                    del image_label_dict[case_name]
+
+        self.image_label_dict = image_label_dict
+        self.loadedCaseOrder = None
+        self.dataSource = {'manifest': manifest_fn if isRemoteUrl(manifest_fn) else os.path.abspath(manifest_fn)}
+        self.qcResults, self.qcScores = {}, {}
+        self.preflightCases()
+        self.checkCaseGeometries()
+        self.updateWidgets()
+
+
+    def onSaveManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getSaveFileName(None, 'Save Manifest', 'image_paths.csv', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.saveManifest(manifest_fn)
+
+
+    def saveManifest(self, manifest_fn):
+        """Write the loaded cases (e.g. from a folder scan) to a manifest csv"""
+        imageColumns = list(self.config['imageFilenamePatterns'])
+        rows = []
+        for case_name, (im_fns, label_fn) in self.image_label_dict.items():
+            paths = dict(zip(imageColumns, [fn if isRemoteUrl(fn) else os.path.abspath(fn) for fn in im_fns]))
+            paths['seg'] = label_fn if isRemoteUrl(label_fn) else os.path.abspath(label_fn)
+            rows.append((case_name, paths))
+        writeManifest(manifest_fn, imageColumns + ['seg'], rows)
+        print('INFO: saved manifest of '+str(len(rows))+' cases to', manifest_fn)
+
+
+    def onRunQCButtonPressed(self):
+        """Run (or load cached) QC for every case, then score and optionally reorder the cases"""
+        if not self.image_label_dict:
+            return
+        cache_fn = os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'qc-cache.json')
+        cache = {}
+        if os.path.exists(cache_fn):
+            with open(cache_fn) as f:
+                cache = json.load(f)
+
+        # only cases whose files changed since they were last measured need to be read
+        jobs = OrderedDict()
+        for case_name, (im_fns, label_fn) in self.image_label_dict.items():
+            brain_fn = im_fns[0]
+            signature = fileSignatures([brain_fn, label_fn])
+            cached = cache.get(label_fn)
+            if cached and cached['signature'] == signature and 'brainMask' in cached['qc']:  # older results used another brain mask
+                self.qcResults[case_name] = cached['qc']
+            else:
+                jobs[case_name] = brain_fn, label_fn, signature
+        print('INFO: running QC on '+str(len(jobs))+' of '+str(len(self.image_label_dict))+' cases')
+
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Running cohort QC')
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(computeCaseQC, brain_fn, label_fn, self.config['labelNames']): case_name for case_name, (brain_fn, label_fn, signature) in jobs.items()}
+            for num, future in enumerate(as_completed(futures)):
+                case_name = futures[future]
+                brain_fn, label_fn, signature = jobs[case_name]
+                try:
+                    self.qcResults[case_name] = future.result()
+                    cache[label_fn] = {'signature': signature, 'qc': self.qcResults[case_name]}
+                except Exception as e:
+                    print('ERROR: QC failed for '+case_name+':', e)
+                progressDialog.setValue(num + 1)
+                slicer.app.processEvents()
+        progressDialog.close()
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        with open(cache_fn, 'w') as f:
+            json.dump(cache, f)
+
+        self.qcScores = anomalyScores(self.qcResults)
+        for case_name, score in sorted(self.qcScores.items(), key=lambda item: -item[1])[:10]:
+            print('INFO: QC anomaly score %.1f for %s' % (score, case_name), self.qcResults[case_name])
+        if self.orderByAnomalyCheckBox.checked:
+            self.onOrderByAnomalyToggled(True)
+        else:
+            self.updateCaseTooltips()
+
+
+    def updateCaseTooltips(self):
+        """Show each case's QC summary (and corrupt or resampled files) as the tooltip of its combobox item"""
+        for ind in range(self.caseComboBox.count):
+            case_name = self.caseComboBox.itemText(ind)
+            lines = []
+            if case_name in self.badCaseFiles:
+                lines.append('Corrupt files: '+'; '.join('%s (%s)' % (caseNodeName(fn), error) for fn, error in self.badCaseFiles[case_name].items()))
+            self.caseComboBox.setItemIcon(ind, slicer.app.style().standardIcon(qt.QStyle.SP_MessageBoxWarning) if case_name in self.badCaseFiles else qt.QIcon())
+            if case_name in self.qcScores:
+                lines.append(qcSummary(self.qcScores[case_name], self.qcResults[case_name]))
+            if self.resampledCases.get(case_name):
+                lines.append('Resampled onto the grid of the first image: '+', '.join(caseNodeName(fn) for fn in self.resampledCases[case_name]))
+            if lines:
+                self.caseComboBox.setItemData(ind, '\n'.join(lines), qt.Qt.ToolTipRole)
+
+
+    def preflightCases(self):
+        """Validate the files of the loaded cases if ``Validate files on load`` is checked"""
+        self.badCaseFiles = {}
+        if self.validateFilesCheckBox.checked:
+            self.validateCases()
+
+
+    def validateCases(self):
+        """Check the gzip CRC and header of every local case file in parallel, and mark the cases with corrupt files
+
+        Results and checksums are kept in an integrity index in the cache folder, so later checks
+        (in this or another session) only read the files whose size or mtime changed.
+        """
+        case_files = OrderedDict((name, im_fns + [label_fn]) for name, (im_fns, label_fn) in self.image_label_dict.items())
+        progressDialog = slicer.util.createProgressDialog(labelText='Validating case files')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        errors = validateCaseFiles([fn for fns in case_files.values() for fn in fns], os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'integrity.json'), onProgress)
+        progressDialog.close()
+        self.badCaseFiles = OrderedDict()
+        for case_name, fns in case_files.items():
+            bad = OrderedDict((fn, errors[fn]) for fn in fns if fn in errors)
+            if bad:
+                self.badCaseFiles[case_name] = bad
+                print('WARNING: '+case_name+' has corrupt files:', '; '.join(fn+': '+error for fn, error in bad.items()))
+        print('INFO: validated the files of %d cases, %d have corrupt or missing files' % (len(case_files), len(self.badCaseFiles)))
+        self.updateCaseTooltips()
+
+
+    def checkCaseGeometries(self, case_names=None):
+        """Compare the grid of each case's files with its first image, and resample mismatched files once
+
+        The resampled arrays are kept in ``self.resampleCache``, so loading the case again (in this
+        or a later session) doesn't resample them. Without ``case_names`` all cases are checked,
+        except those with remote files, which are checked when they are loaded.
+        """
+        if case_names is None:
+            self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+            case_names = [name for name, (im_fns, label_fn) in self.image_label_dict.items() if not any(isRemoteUrl(fn) for fn in im_fns + [label_fn])]
+        cases = [(name, self.image_label_dict[name][0][0], self.image_label_dict[name][0][1:] + [self.image_label_dict[name][1]]) for name in case_names]
+        mismatches = findGeometryMismatches(cases, os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'geometry-cache.json'))
+        self.geometryCheckedCases.update(case_names)
+        if not mismatches:
+            return
+        print('WARNING: %d cases have files on a different grid than their first image, resampling them: %s' % (len(mismatches), ', '.join(mismatches)))
+        label_fns = {self.image_label_dict[name][1] for name in mismatches}
+        jobs = [(fn, geometry, fn in label_fns) for refs in mismatches.values() for fn, geometry in refs.items()]
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Resampling onto the reference grid')
+
+        def onProgress(num, total):
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        failures = self.resampleCache.prepare(jobs, onProgress)
+        progressDialog.close()
+        for case_name, refs in mismatches.items():
+            for fn in sorted(failures.keys() & refs.keys()):
+                print('ERROR: could not resample '+fn+':', failures[fn])
+                del refs[fn]
+            self.resampleTargets.update(refs)
+            self.resampledCases[case_name] = sorted(refs)
+        self.updateCaseTooltips()
+
+
+    def onOrderByAnomalyToggled(self, checked):
+        """Reorder the cases: highest QC anomaly score first, or back in the order they were loaded"""
+        if not self.image_label_dict:
+            return
+        if checked:
+            if self.loadedCaseOrder is None:
+                self.loadedCaseOrder = list(self.image_label_dict)
+            case_names = sorted(self.loadedCaseOrder, key=lambda case_name: -self.qcScores.get(case_name, 0))
+        else:
+            if self.loadedCaseOrder is None:
+                return
+            case_names, self.loadedCaseOrder = self.loadedCaseOrder, None
+        self.image_label_dict = OrderedDict((case_name, self.image_label_dict[case_name]) for case_name in case_names)
+        if self.active_label_fn and self.active_case_name in self.image_label_dict:
+            # the open case stays open (and selected) at its new position
+            self.updateWidgets(case_names.index(self.active_case_name), loadCase=False)
+            self.saveSession()
+        else:
             self.updateWidgets()
 
 
-    def updateWidgets(self):
-        """Load selected valid case names into the widget"""
+    def updateWidgets(self, caseIndex=0, loadCase=True):
+        """Load selected valid case names into the widget and load the ``caseIndex``-th case
+
+        With ``loadCase`` false the ``caseIndex``-th case is only selected, e.g. when it's already open.
+        """
         # select data button
         if len(self.image_label_dict) > 1:
             self.selectDataButton.setText(str(len(self.image_label_dict))+' cases')
         elif len(self.image_label_dict) == 1:
             self.selectDataButton.setText(os.path.basename(list(self.image_label_dict.keys())[0]))
         
-        # case combobox
+        # case combobox; its signals are blocked so clearing it doesn't switch (and save) cases
+        self.caseComboBox.blockSignals(True)
         self.caseComboBox.clear()
         if self.image_label_dict:
             case_names = list(self.image_label_dict.keys())
             self.caseComboBox.addItems(case_names)  # load names into combobox
+            self.caseComboBox.setCurrentIndex(caseIndex)
+        self.caseComboBox.blockSignals(False)
+        if self.image_label_dict:
+            self.updateCaseTooltips()
             self.caseComboBox.enabled = True
+            self.saveManifestButton.enabled = True
             self.nextImageButton.enabled = True
             self.previousImageButton.enabled = True
-            self.selected_image_ind = 0
+            self.selected_image_ind = caseIndex
+            if loadCase:
+                self.onComboboxChanged(case_names[caseIndex])
         else:
             self.selectDataButton.setText('Select Data Folders')
             self.caseComboBox.enabled = False
+            self.saveManifestButton.enabled = False
             self.nextImageButton.enabled = False
             self.previousImageButton.enabled = False
             self.selected_image_ind = None
@@ -190,18 +756,20 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
 
         Raises:
             ValueError: if the config is missing name/color for one of the integer labels in the 
-                label file
+                label file, or the label file has labels that aren't integers from 0 to 255
         """
+        startTime = time.perf_counter()
         
         if not self.image_label_dict:
             return
 
-        # save old seg before loading the new one
-        if self.segmentationNode:
-            self.saveActiveSegmentation()
+        # save old seg before loading the new one; if that fails, stay on the old case so the edits aren't lost
+        if self.segmentationNode and not self.saveActiveSegmentation():
+            self.selectActiveCase()
+            return
 
         try:
-            self.selected_image_ind = list(self.image_label_dict.keys()).index(text)
+            caseIndex = list(self.image_label_dict.keys()).index(text)
         except ValueError:
             return
 
@@ -210,8 +778,23 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
             im_fns, label_fn = self.image_label_dict[text]
         except KeyError:
             print('Could not find %s among selected images' % text)
+            self.selectActiveCase()
             return
+        # the loaded case stays open (and selected) if this one can't be loaded
+        missing_fns = [fn for fn in im_fns + [label_fn] if not caseFileExists(fn)]
+        if missing_fns:
+            print('ERROR: Cannot load '+text+' because some of its files are missing:', missing_fns)
+            self.selectActiveCase()
+            return
+        if text in self.badCaseFiles:
+            print('ERROR: Cannot load '+text+' because some of its files are corrupt:', dict(self.badCaseFiles[text]))
+            self.selectActiveCase()
+            return
+        if text not in self.geometryCheckedCases:
+            self.checkCaseGeometries([text])
         self.active_label_fn = label_fn
+        self.active_case_name = text
+        self.selected_image_ind = caseIndex
 
         # remove existing nodes (if any)
         self.clearNodes()
@@ -222,33 +805,73 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         self.loadVolumesFromFiles(im_fns)
 
         # create segmentation
-        self.createSegmentationFromFile(label_fn)
-
-        # configure views
-        for volNode, view_name in zip(self.volNodes, ['Red', 'Yellow', 'Green']):
-            view = slicer.app.layoutManager().sliceWidget(view_name)
-            view.sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(volNode.GetID())
-            view.sliceLogic().GetSliceCompositeNode().SetLinkedControl(True)
-            view.mrmlSliceNode().RotateToVolumePlane(volNode)
-            volNode.GetScalarVolumeDisplayNode().SetInterpolate(0)
-            view.sliceController().setSliceVisible(True)  # show in 3d view
-            
-        # make all slice views axial after loading volumes
-        sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
-        for sliceNode in sliceNodes:
-            sliceNode.SetOrientationToAxial()
+        if len(self.volNodes) == len(im_fns):
+            self.createSegmentationFromFile(label_fn)
+
+        # don't keep a half-loaded case, its (empty) segmentation would be saved over the label file
+        if not self.segmentationNode:
+            print('ERROR: Failed to load '+text+', some of its files are unreadable (use Validate Now to find them)')
+            self.clearNodes()
+            self.active_label_fn = None
+            return
+        loadedTime = time.perf_counter()
+
+        # configure all views as one batch with rendering paused, then render once
+        with slicer.util.RenderBlocker():
+            for volNode, view_name in zip(self.volNodes, ['Red', 'Yellow', 'Green']):
+                view = slicer.app.layoutManager().sliceWidget(view_name)
+                compositeNode = view.sliceLogic().GetSliceCompositeNode()
+                wasModifying = compositeNode.StartModify()  # one modified event (and linked-view update) per view
+                compositeNode.SetBackgroundVolumeID(volNode.GetID())
+                compositeNode.SetLinkedControl(True)
+                compositeNode.EndModify(wasModifying)
+                view.mrmlSliceNode().RotateToVolumePlane(volNode)
+                volNode.GetScalarVolumeDisplayNode().SetInterpolate(0)
+                view.sliceController().setSliceVisible(True)  # show in 3d view
+
+            # make all slice views axial after loading volumes
+            sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
+            for sliceNode in sliceNodes:
+                sliceNode.SetOrientationToAxial()
+        slicer.util.forceRenderAllViews()
+        showCaseLoadTime(text, startTime, loadedTime)
+
+        self.prefetchUpcomingCases()
+        self.saveSession()
+
+
+    def prefetchUpcomingCases(self):
+        """Download the remote files of the next few cases in the background"""
+        caseNames = list(self.image_label_dict)[self.selected_image_ind+1:self.selected_image_ind+1+self.config.get('prefetchCases', 2)]
+        urls = [fn for name in caseNames for fn in self.image_label_dict[name][0] + [self.image_label_dict[name][1]] if isRemoteUrl(fn)]
+        if urls:
+            RemoteFileCache.shared().prefetch(urls)
+
+
+    def loadCaseVolume(self, filename, labelmap=False):
+        """Load a case file, from ``self.resampleCache`` if it's on a different grid than the case's first image"""
+        geometry = self.resampleTargets.get(filename)
+        if geometry is None:
+            return loadCaseVolume(filename, labelmap)
+        array = self.resampleCache.load(filename, geometry, labelmap)
+        nodeClassName = 'vtkMRMLLabelMapVolumeNode' if labelmap else 'vtkMRMLScalarVolumeNode'
+        return slicer.util.addVolumeFromArray(array, np.array(geometry['ijkToRas']), caseNodeName(filename), nodeClassName)
 
 
     def loadVolumesFromFiles(self, filenames):
         self.volNodes = []
         for im_fn in filenames:
-            volNode = slicer.util.loadVolume(im_fn)
+            try:
+                volNode = self.loadCaseVolume(im_fn)
+            except (RuntimeError, OSError, ValueError) as e:  # e.g. a truncated or corrupt file
+                print('ERROR: Failed to read volume', im_fn, e)
+                volNode = None
             if volNode:
                 self.volNodes.append(volNode)
             else:
                 print('WARNING: Failed to load volume ', im_fn)
         if len(self.volNodes) == 0:
-            print('Failed to load any volumes from folder '+text+'!')
+            print('Failed to load any volumes ('+', '.join(filenames)+')!')
             return
 
 
@@ -256,11 +879,24 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         print('INFO: BatchSegmenter.createSegmentationFromFile invoked', label_fn)
 
         # create label node as a labelVolume
-        labelmapNode = slicer.util.loadLabelVolume(label_fn)
+        try:
+            labelmapNode = self.loadCaseVolume(label_fn, labelmap=True)
+        except (RuntimeError, OSError, ValueError) as e:  # e.g. a truncated or corrupt file
+            print('ERROR: Failed to read label volume', label_fn, e)
+            labelmapNode = None
         if not labelmapNode:
             print('Failed to load label volume ', label_fn)
             return
 
+        # keep all ROIs in one shared uint8 labelmap layer
+        labelArray = slicer.util.arrayFromVolume(labelmapNode)
+        if labelArray.dtype != np.uint8:
+            # the cast would silently truncate fractional or out-of-range labels
+            if labelArray.size and (labelArray.min() < 0 or labelArray.max() > 255 or not np.array_equal(labelArray, np.floor(labelArray))):
+                slicer.mrmlScene.RemoveNode(labelmapNode)
+                raise ValueError('The labels in '+label_fn+' must be integers from 0 to 255 to match the config labelNames, found values in ['+str(labelArray.min())+', '+str(labelArray.max())+']')
+            slicer.util.updateVolumeFromArray(labelmapNode, labelArray.astype(np.uint8))
+
         # create segmentation node from labelVolume
         self.segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'Tumor Segmentation')
         self.segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(self.volNodes[0])
@@ -268,12 +904,16 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
         slicer.mrmlScene.AddNode(self.segmentationNode)
         slicer.vtkSlicerSegmentationsModuleLogic.ImportLabelmapToSegmentationNode(labelmapNode, self.segmentationNode)
         self.segEditorWidget.setSegmentationNode(self.segmentationNode)
+        self.savedLabelArray = slicer.util.arrayFromVolume(labelmapNode).copy()
+        self.savedLabelSignature = self.labelFileSignature()
+        self.loadedLabelArray = self.savedLabelArray
+        self.caseLoadTime = time.time()
         slicer.mrmlScene.RemoveNode(labelmapNode)
 
-        # figure out segment labels
+        # figure out segment labels (and the baseline ROI volumes) in one pass over the labels
         segmentation = self.segmentationNode.GetSegmentation()
-        integerLabels = np.unique(slicer.util.arrayFromVolume(labelmapNode))
-        integerLabels = np.delete(integerLabels, np.argwhere(integerLabels==0))  # remove background label
+        labelCounts = countLabelValues(self.savedLabelArray)
+        integerLabels = [label for label in labelCounts if label != 0]  # remove background label
         segments = [segmentation.GetNthSegment(segInd) for segInd in range(segmentation.GetNumberOfSegments())]
         labelToSegment = {str(label): segment for label, segment in zip(integerLabels, segments)}
         
@@ -298,69 +938,893 @@ class BatchSegmenterWidget(ScriptedLoadableModuleWidget):
             else:  # label is missing from labelmap, create empty segment
                 print('INFO: Adding empty segment for class', labelName)
                 segmentation.AddEmptySegment(str(labelVal), labelName, color)
+        segmentation.CollapseBinaryLabelmaps(False)  # move the empty segments into the shared layer
+
+        # start tracking ROI volumes
+        self.voxelVolumeMl = np.prod(self.volNodes[0].GetSpacing()) / 1000
+        self.setVoxelCounts(labelCounts, baseline=True)
+        self.statsLayers = {}
+        self.updateSegmentLayerCounts(recount=False)
+        self.addObserver(segmentation, slicer.vtkSegmentation.SegmentModified, self.onSegmentModified)
+
+        # list connected components, reusing the loaded array when it's on the reference grid
+        if self.savedLabelArray.shape == slicer.util.arrayFromVolume(self.volNodes[0]).shape:
+            self.updateIslandsTable(self.savedLabelArray)
+        else:
+            self.updateIslandsTable()
                 
 
-    def saveActiveSegmentation(self):
-        if self.active_label_fn:
-            print('INFO: BatchSegmenter.saveActiveSegmentation() invoked', self.active_label_fn)
+    def setVoxelCounts(self, labelCounts, baseline=False):
+        """Set every ROI's voxel count from a full count (``countLabelValues`` of the label array)"""
+        counts = {labelVal: labelCounts.get(int(labelVal), 0) for labelVal in self.config['labelNames']}
+        if baseline:
+            self.baselineVoxelCounts = dict(counts)
+        self.voxelCounts = counts
+        self.updateVolumeStatsTable()
+
+
+    @vtk.calldata_type(vtk.VTK_STRING)
+    def onSegmentModified(self, caller, event, segmentId):
+        self.modifiedSegmentIds.add(segmentId)
+        self.volumeStatsTimer.start()
+        if self.interpolateCheckBox.checked and not self.interpolating:
+            self.interpolationTimer.start()
+
+
+    def updateModifiedSegmentStats(self):
+        """Update the voxel counts of the segments modified since the last update"""
+        if not self.segmentationNode:
+            self.modifiedSegmentIds = set()
+            return
+        segmentation = self.segmentationNode.GetSegmentation()
+        modifiedLayers = {segmentation.GetLayerIndex(segmentId) for segmentId in self.modifiedSegmentIds if segmentation.GetSegment(segmentId) is not None}
+        self.updateSegmentLayerCounts(modifiedLayers)
+        self.modifiedSegmentIds = set()
+        self.updateVolumeStatsTable()
+
+
+    def updateSegmentLayerCounts(self, layerIndices=None, recount=True):
+        """Update ``voxelCounts`` from the segmentation's labelmap layers (all of them if ``layerIndices`` is None)
+
+        The segment-modified event doesn't say which voxels changed, and all segments normally share
+        one layer, so each layer is compared with its copy from the previous update and only the
+        voxels that changed are counted. A layer whose extent or segments changed since then is
+        counted in full. With ``recount=False`` the layers are only copied, for counts that are
+        already known (from the label array at load).
+        """
+        segmentation = self.segmentationNode.GetSegmentation()
+        layerSegments = OrderedDict()  # layer index -> {label value in the layer: segment ID}
+        for segInd in range(segmentation.GetNumberOfSegments()):
+            segmentId = segmentation.GetNthSegmentID(segInd)
+            layerSegments.setdefault(segmentation.GetLayerIndex(segmentId), {})[segmentation.GetSegment(segmentId).GetLabelValue()] = segmentId
+        for layerIndex in (layerSegments if layerIndices is None else layerIndices):
+            segmentIds = layerSegments[layerIndex]
+            extent = tuple(segmentation.GetLayerDataObject(layerIndex).GetExtent())
+            layerArray = slicer.util.arrayFromSegmentInternalBinaryLabelmap(self.segmentationNode, next(iter(segmentIds.values())))
+            if layerArray is None:  # empty layer
+                layerArray = np.zeros((0, 0, 0), np.uint8)
+            previous = self.statsLayers.get(layerIndex)
+            if previous is not None and previous[:2] == (extent, segmentIds):
+                layerCounts = updateLabelCounts(previous[3], previous[2], layerArray)
+            elif recount:
+                layerCounts = countLabelValues(layerArray)
+            else:
+                layerCounts = {labelValue: self.voxelCounts.get(segmentId, 0) for labelValue, segmentId in segmentIds.items()}
+            self.statsLayers[layerIndex] = (extent, segmentIds, layerArray.copy(), layerCounts)
+            for labelValue, segmentId in segmentIds.items():
+                if segmentId in self.voxelCounts:
+                    self.voxelCounts[segmentId] = layerCounts.get(labelValue, 0)
+
+
+    def updateVolumeStatsTable(self):
+        for row, labelVal in enumerate(self.config['labelNames']):
+            count = self.voxelCounts.get(labelVal, 0)
+            change = count - self.baselineVoxelCounts.get(labelVal, 0)
+            self.volumeStatsTable.setItem(row, 1, qt.QTableWidgetItem(str(count)))
+            self.volumeStatsTable.setItem(row, 2, qt.QTableWidgetItem('%.2f' % (count * self.voxelVolumeMl)))
+            self.volumeStatsTable.setItem(row, 3, qt.QTableWidgetItem('%+.2f' % (change * self.voxelVolumeMl)))
+
+
+    def updateIslandsTable(self, labelArray=None):
+        """List the connected components of every ROI, smallest first
 
-            # restore original label values
-            segmentation = self.segmentationNode.GetSegmentation()
-            for segInd in range(segmentation.GetNumberOfSegments()):
-                segment = segmentation.GetNthSegment(segInd)
+        Args:
+            labelArray (np.ndarray): label array on the grid of ``self.volNodes[0]``. If None, each
+                segment is read from the segmentation
+        """
+        ijkToRas = vtk.vtkMatrix4x4()
+        self.volNodes[0].GetIJKToRASMatrix(ijkToRas)
+        self.islands = []
+        for labelVal in self.config['labelNames']:
+            if labelArray is not None:
+                mask = labelArray == int(labelVal)
+            else:
+                mask = slicer.util.arrayFromSegmentBinaryLabelmap(self.segmentationNode, labelVal, self.volNodes[0]) > 0
+            for size, centroidIJK in findConnectedComponents(mask):
+                centroidRAS = ijkToRas.MultiplyPoint(list(centroidIJK) + [1.0])[:3]
+                self.islands.append((labelVal, size, centroidRAS))
+        self.islands.sort(key=lambda island: island[1])
+
+        self.islandsTable.setRowCount(len(self.islands))
+        for row, (labelVal, size, centroidRAS) in enumerate(self.islands):
+            self.islandsTable.setItem(row, 0, qt.QTableWidgetItem(self.config['labelNames'][labelVal]))
+            self.islandsTable.setItem(row, 1, qt.QTableWidgetItem(str(size)))
+            self.islandsTable.setItem(row, 2, qt.QTableWidgetItem('%.1f, %.1f, %.1f' % tuple(centroidRAS)))
+
+
+    def onIslandClicked(self, row, column):
+        """Center the slice views on the clicked connected component"""
+        labelVal, size, centroidRAS = self.islands[row]
+        slicer.modules.markups.logic().JumpSlicesToLocation(centroidRAS[0], centroidRAS[1], centroidRAS[2], True)
+
+
+    def removeIslands(self):
+        """Remove connected components smaller than the minimum island size from every ROI"""
+        if not self.segmentationNode:
+            return
+        minSize = self.minIslandSizeSpinBox.value
+        for labelVal in self.config['labelNames']:
+            mask = slicer.util.arrayFromSegmentBinaryLabelmap(self.segmentationNode, labelVal, self.volNodes[0]) > 0
+            cleaned = removeSmallIslands(mask, minSize)
+            numRemoved = int(mask.sum() - cleaned.sum())
+            if numRemoved:
+                print('INFO: removed '+str(numRemoved)+' island voxels from', self.config['labelNames'][labelVal])
+                slicer.util.updateSegmentBinaryLabelmapFromArray(cleaned.astype(np.uint8), self.segmentationNode, labelVal, self.volNodes[0])
+        self.segmentationNode.GetSegmentation().CollapseBinaryLabelmaps(False)
+        self.updateIslandsTable()
+
+
+    def interpolateSelectedRoi(self):
+        """Fill the slices between the drawn slices of the ROI selected in the segment editor
+
+        Voxels of other ROIs are left alone. The filled slices are part of the segmentation, so
+        they are saved (and audited) like any other edit.
+        """
+        if not self.segmentationNode:
+            return
+        labelVal = self.segEditorWidget.mrmlSegmentEditorNode().GetSelectedSegmentID()
+        if labelVal not in self.config['labelNames']:
+            return
+        startTime = time.perf_counter()
+        labelArray = self.exportSharedLabelmap()
+        if labelArray is not None:
+            mask = labelArray == int(labelVal)
+            allowed = mask | (labelArray == 0)
+        else:
+            mask = slicer.util.arrayFromSegmentBinaryLabelmap(self.segmentationNode, labelVal, self.volNodes[0]) > 0
+            allowed = None
+        if labelVal not in self.sliceInterpolators:
+            loadedMask = None
+            if self.loadedLabelArray is not None and self.loadedLabelArray.shape == mask.shape:
+                loadedMask = self.loadedLabelArray == int(labelVal)
+            self.sliceInterpolators[labelVal] = SliceInterpolator(loadedMask)
+        interpolator = self.sliceInterpolators[labelVal]
+        filled, numGapsComputed = interpolator.interpolate(mask, allowed)
+        if not np.array_equal(filled, mask):
+            self.interpolating = True
+            try:
+                slicer.util.updateSegmentBinaryLabelmapFromArray(filled.astype(np.uint8), self.segmentationNode, labelVal, self.volNodes[0])
+                self.segmentationNode.GetSegmentation().CollapseBinaryLabelmaps(False)
+            finally:
+                self.interpolating = False
+        self.interpolationStatusLabel.text = '%s: %d drawn slices, %d filled (%d gaps recomputed) in %.0f ms' % (
+            self.config['labelNames'][labelVal], len(interpolator.keySlices), len(interpolator.filledHashes),
+            numGapsComputed, 1000 * (time.perf_counter() - startTime))
+
+
+    def removeIslandsInAllCases(self):
+        """Remove small islands from the label file of every selected case, on a thread pool
+
+        The current case is saved first and reloaded afterwards so it shows the cleaned labels.
+        """
+        if not self.image_label_dict:
+            return
+        if self.segmentationNode:
+            if not self.saveActiveSegmentation():
+                return
+            self.clearNodes()
+        minSize = self.minIslandSizeSpinBox.value
+        label_fns = [label_fn for im_fns, label_fn in self.image_label_dict.values()]
+        progressDialog = slicer.util.createProgressDialog(maximum=len(label_fns), labelText='Removing islands')
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(removeSmallIslandsFromFile, label_fn, self.config['labelNames'], minSize): label_fn for label_fn in label_fns}
+            for num, future in enumerate(as_completed(futures)):
                 try:
-                    labelVal = self.labelNameToLabelVal[segment.GetName()]
-                    print('INFO: saving '+segment.GetName()+' segment as '+str(labelVal))
-                    segment.SetName(str(labelVal))
-                except KeyError:
-                    # TODO: create user-visible error here (an alert box or something)
-                    print('ERROR: saving segment number '+str(segInd)+' failed because its name ("'+str(segment.GetName())+'") is not one of '+str(self.labelNameToLabelVal.keys()))
-                    return
+                    numRemoved = future.result()
+                    if numRemoved:
+                        print('INFO: removed '+str(numRemoved)+' island voxels from', futures[future])
+                except Exception as e:
+                    print('ERROR: removing islands failed for '+futures[future]+':', e)
+                progressDialog.setValue(num + 1)
+                slicer.app.processEvents()
+        progressDialog.close()
+        self.onComboboxChanged(self.caseComboBox.currentText)
+
+
+    def saveActiveSegmentation(self, recordHistory=True, skipUnchanged=False):
+        """Write the segmentation to ``self.active_label_fn``
+
+        Args:
+            recordHistory (bool): if True, the difference from the previously saved version is
+                appended to the case's edit history so that it can be undone later
+            skipUnchanged (bool): if True, nothing is written (or audited) when the segmentation
+                is the same as the last saved (or loaded) version
+
+        Returns:
+            bool: False if writing (or uploading) the label file failed. The segmentation is left
+            in the scene, and the user is told where a remote file's edited version is kept
+        """
+        if self.active_label_fn:
+            print('INFO: BatchSegmenter.saveActiveSegmentation() invoked', self.active_label_fn)
 
             # Save to file
             if self.segmentationNode and self.segmentationNode.GetDisplayNode():
                 print('Saving seg to', self.active_label_fn)
 
-                # make a list of segment IDs *that are always ordered correctly*
-                visibleSegmentIds = vtk.vtkStringArray()
-                for labelVal in self.config['labelNames']:  # assumes that the config list of labelNames is in order
-                    visibleSegmentIds.InsertNextValue(labelVal)
-                visibleSegmentIdsList = [visibleSegmentIds.GetValue(ind) for ind in range(visibleSegmentIds.GetNumberOfValues())]
-                
-                labelmapNode = slicer.vtkMRMLLabelMapVolumeNode()
-                slicer.mrmlScene.AddNode(labelmapNode)
-                slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(self.segmentationNode, visibleSegmentIds, labelmapNode, self.volNodes[0])
-                slicer.util.saveNode(labelmapNode, self.active_label_fn)
-                slicer.mrmlScene.RemoveNode(labelmapNode)
+                # segment IDs are the config label values; anything else isn't saved
+                segmentation = self.segmentationNode.GetSegmentation()
+                segmentIds = [segmentation.GetNthSegmentID(segInd) for segInd in range(segmentation.GetNumberOfSegments())]
+                unknownSegmentIds = [segmentId for segmentId in segmentIds if segmentId not in self.config['labelNames']]
+                if unknownSegmentIds:
+                    print('WARNING: not saving segments that are not in the config:', [segmentation.GetSegment(segmentId).GetName() for segmentId in unknownSegmentIds])
+
+                labelArray = self.exportSharedLabelmap()
+                if labelArray is None:
+                    labelArray = self.mergeSegmentsToLabelArray()
+                if skipUnchanged and self.savedLabelArray is not None and np.array_equal(labelArray, self.savedLabelArray):
+                    return True
+                referenceToRas = vtk.vtkMatrix4x4()
+                self.volNodes[0].GetIJKToRASMatrix(referenceToRas)
+                try:
+                    saveCaseArray(labelArray, slicer.util.arrayFromVTKMatrix(referenceToRas), self.active_label_fn)
+                except (OSError, RuntimeError) as e:
+                    self.reportSaveFailure(e)
+                    return False
+                self.savedLabelSignature = self.labelFileSignature()
+                self.setVoxelCounts(countLabelValues(labelArray))
+                self.auditSave(labelArray)
+                self.resampleTargets.pop(self.active_label_fn, None)  # the label file is on the reference grid now
+
+                # record what changed since the last save
+                if recordHistory and self.savedLabelArray is not None and self.savedLabelArray.shape == labelArray.shape:
+                    diff = encodeLabelDiff(self.savedLabelArray, labelArray)
+                    if diff is not None:
+                        self.getEditHistory().push(diff, labelChecksum(self.savedLabelArray), labelChecksum(labelArray))
+                self.savedLabelArray = labelArray
+        return True
+
+
+    def reportSaveFailure(self, error):
+        """Tell the user that the active case couldn't be saved, and where its edited version is kept"""
+        message = 'Saving '+self.active_label_fn+' failed: '+str(error)+'.'
+        if isRemoteUrl(self.active_label_fn) and os.path.exists(RemoteFileCache.shared().stagingPath(self.active_label_fn)):
+            message += ' The edited segmentation is kept in '+RemoteFileCache.shared().stagingPath(self.active_label_fn)+'.'
+        message += ' The case stays open with your edits.'
+        print('ERROR: '+message)
+        slicer.util.showStatusMessage(message, 60000)
+
+
+    def selectActiveCase(self):
+        """Point the case combobox back at the case that is loaded, without reloading it"""
+        if self.active_case_name not in self.image_label_dict:
+            return
+        self.selected_image_ind = list(self.image_label_dict).index(self.active_case_name)
+        self.caseComboBox.blockSignals(True)
+        self.caseComboBox.setCurrentIndex(self.selected_image_ind)
+        self.caseComboBox.blockSignals(False)
+
+
+    def exportSharedLabelmap(self):
+        """Copy the segmentation's shared labelmap layer into a label array on the reference grid
+
+        Returns:
+            uint8 array with the config label value of each voxel, or None if the segments aren't
+            all in one layer on the reference grid (some editor effects split them), in which case
+            the segments have to be merged instead
+        """
+        segmentation = self.segmentationNode.GetSegmentation()
+        if segmentation.GetNumberOfLayers() != 1:
+            return None
+        layer = segmentation.GetLayerDataObject(0)
+        layerToRas = vtk.vtkMatrix4x4()
+        layer.GetImageToWorldMatrix(layerToRas)
+        referenceToRas = vtk.vtkMatrix4x4()
+        self.volNodes[0].GetIJKToRASMatrix(referenceToRas)
+        if not np.allclose(slicer.util.arrayFromVTKMatrix(layerToRas), slicer.util.arrayFromVTKMatrix(referenceToRas), atol=1e-6):
+            return None
+
+        labelArray = np.zeros(slicer.util.arrayFromVolume(self.volNodes[0]).shape, np.uint8)
+        extent = layer.GetExtent()
+        if extent[0] > extent[1] or extent[2] > extent[3] or extent[4] > extent[5]:
+            return labelArray  # empty layer
+        ijkShape = labelArray.shape[::-1]
+        if any(extent[2*axis] < 0 or extent[2*axis+1] >= ijkShape[axis] for axis in range(3)):
+            return None
+
+        # map each segment's value in the layer to its config label value; other segments are dropped
+        layerArray = slicer.util.arrayFromSegmentInternalBinaryLabelmap(self.segmentationNode, segmentation.GetNthSegmentID(0))
+        layerToLabel = np.zeros(max(256, int(layerArray.max()) + 1), np.uint8)
+        for labelVal in self.config['labelNames']:
+            segment = segmentation.GetSegment(labelVal)
+            if segment is not None:
+                layerToLabel[segment.GetLabelValue()] = int(labelVal)
+        labelArray[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1] = layerToLabel[layerArray]
+        return labelArray
+
+
+    def mergeSegmentsToLabelArray(self):
+        """Merge the segments into a label array on the reference grid, in config order (later ROIs win)"""
+        segmentation = self.segmentationNode.GetSegmentation()
+        labelArray = np.zeros(slicer.util.arrayFromVolume(self.volNodes[0]).shape, np.uint8)
+        for labelVal in self.config['labelNames']:
+            if segmentation.GetSegment(labelVal) is not None:
+                segmentArray = slicer.util.arrayFromSegmentBinaryLabelmap(self.segmentationNode, labelVal, self.volNodes[0])
+                labelArray[segmentArray > 0] = int(labelVal)
+        return labelArray
+
+
+    def auditSave(self, labelArray):
+        """Append what changed since the case was loaded to the dataset's audit log"""
+        if self.loadedLabelArray is None or self.loadedLabelArray.shape != labelArray.shape:
+            return
+        startTime = time.perf_counter()
+        changes = summarizeLabelChanges(self.loadedLabelArray, labelArray, self.config['labelNames'])
+        record = OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('case', self.active_case_name),
+            ('labelFilename', self.active_label_fn),
+            ('sessionSeconds', round(time.time() - self.caseLoadTime, 1)),
+        ])
+        record.update(changes)
+        record['voxelsLoaded'] = self.baselineVoxelCounts
+        try:
+            appendAuditRecord(self.auditLogFilename(), record)
+        except OSError as e:
+            print('WARNING: could not write audit log '+self.auditLogFilename()+':', e)
+        for labelVal, removed in changes['removed'].items():
+            before = self.baselineVoxelCounts.get(labelVal, 0)
+            if before and removed > before / 2:
+                print('WARNING: %s lost %d of its %d loaded voxels in %s' % (self.config['labelNames'][labelVal], removed, before, self.active_label_fn))
+        print('INFO: audited save of %s in %.1f ms' % (self.active_label_fn, 1000 * (time.perf_counter() - startTime)))
+
+
+    def getEditHistory(self):
+        """Return the persistent edit history of the active label file, from the config folder or in the cache folder"""
+        historyFolder = self.config.get('editHistoryFolder') or os.path.join(slicer.app.cachePath, 'BatchSegmenter', 'edit-history')
+        labelRef = self.active_label_fn if isRemoteUrl(self.active_label_fn) else os.path.abspath(self.active_label_fn)
+        return EditHistory(os.path.join(historyFolder, hashlib.sha1(labelRef.encode('utf-8')).hexdigest()[:16]))
+
+
+    def labelFileSignature(self):
+        """Size and mtime of the active label file, to notice changes made outside Slicer (None for remote files)"""
+        if not self.active_label_fn or isRemoteUrl(self.active_label_fn):
+            return None
+        try:
+            return fileSignatures([self.active_label_fn])[0][1:]
+        except OSError:
+            return None
+
+
+    def undoSavedEdit(self):
+        """Revert the active label file to the previous saved version"""
+        self.stepEditHistory(undo=True)
+
+
+    def redoSavedEdit(self):
+        """Re-apply the most recently undone saved version of the active label file"""
+        self.stepEditHistory(undo=False)
+
+
+    def stepEditHistory(self, undo):
+        if not self.segmentationNode or not self.active_label_fn or self.savedLabelArray is None:
+            return
+
+        # the history only applies to the label file as it was last loaded or saved here (its
+        # contents can differ from savedLabelArray, e.g. a label resampled onto the image grid)
+        if self.labelFileSignature() != self.savedLabelSignature:
+            print('ERROR: '+self.active_label_fn+' was changed outside Slicer since it was loaded, not stepping its edit history')
+            return
+
+        # unsaved edits become their own history step, so they can be redone after this undo
+        if not self.saveActiveSegmentation(skipUnchanged=True):
+            return
+
+        history = self.getEditHistory()
+        try:
+            diff = history.undo(labelChecksum(self.savedLabelArray)) if undo else history.redo(labelChecksum(self.savedLabelArray))
+        except ValueError as e:
+            print('ERROR: not '+('undoing' if undo else 'redoing')+' a saved edit of '+self.active_label_fn+':', e)
+            return
+        if diff is None:
+            print('INFO: nothing to '+('undo' if undo else 'redo')+' for', self.active_label_fn)
+            return
+        labelArray = self.savedLabelArray.copy()
+        applyLabelDiff(labelArray, diff, reverse=undo)
+
+        # load the restored array into the existing segments and write it out
+        for labelVal in self.config['labelNames']:
+            segmentArray = (labelArray == int(labelVal)).astype(np.uint8)
+            slicer.util.updateSegmentBinaryLabelmapFromArray(segmentArray, self.segmentationNode, labelVal, self.volNodes[0])
+        self.segmentationNode.GetSegmentation().CollapseBinaryLabelmaps(False)
+        self.saveActiveSegmentation(recordHistory=False)
                         
 
     def clearNodes(self):
         print('INFO: BatchSegmenter.clearNodes invoked')
+        before = lifecycleSnapshot(self)
+        self.removeObservers(self.onSegmentModified)
+        self.volumeStatsTimer.stop()
+        self.interpolationTimer.stop()
+        self.modifiedSegmentIds = set()
+        self.statsLayers = {}
+        self.sliceInterpolators = {}
         for volNode in self.volNodes:
             slicer.mrmlScene.RemoveNode(volNode)
         if self.segmentationNode:
+            self.segEditorWidget.setSegmentationNode(None)  # the editor would keep the removed node alive
             slicer.mrmlScene.RemoveNode(self.segmentationNode)
         self.segmentationNode = None
         self.volNodes = []
-
+        self.savedLabelArray = None
+        self.savedLabelSignature = None
+        self.loadedLabelArray = None
+        self.recordLifecycle(before, lifecycleSnapshot(self))
+
+
+    def recordLifecycle(self, before, after):
+        """Log the node/observer/reference counts around ``clearNodes`` and warn when they grow"""
+        self.lifecycleLog.append((before, after))
+        print('INFO: clearNodes: %d -> %d scene nodes, %d -> %d observers, %d -> %d node references, %.0f -> %.0f MB' % (
+            before['sceneNodes'], after['sceneNodes'], before['observers'], after['observers'],
+            before['nodeRefs'], after['nodeRefs'], before['rssMB'], after['rssMB']))
+        if after['detachedNodeRefs']:
+            print('WARNING: %d removed nodes are still referenced by the widget' % after['detachedNodeRefs'])
+        firstAfter = self.lifecycleLog[0][1]
+        if after['sceneNodes'] > firstAfter['sceneNodes']:
+            print('WARNING: %d more scene nodes remain after clearing than after the first clear' % (after['sceneNodes'] - firstAfter['sceneNodes']))
                 
+    def onProfileActionsToggled(self, checked):
+        self.actionProfiler.enabled = checked
+        if checked:
+            print('INFO: profiling user actions into', self.actionProfiler.outputDir)
+
+
+    def updateSlowestActions(self):
+        """List the slowest profiled actions of the session, with their profile files"""
+        self.slowestActionsList.clear()
+        for seconds, action, caseName, profile_fn in self.actionProfiler.slowestActions():
+            item = qt.QListWidgetItem('%.2f s  %s  (%s)' % (seconds, action, caseName))
+            item.setData(qt.Qt.UserRole, profile_fn)
+            item.setToolTip(profile_fn)
+            self.slowestActionsList.addItem(item)
+
+
+    def onSlowestActionClicked(self, item):
+        printProfileHotSpots(item.data(qt.Qt.UserRole))
+
+
     def cleanup(self):
         print('INFO: BatchSegmenter.cleanup() invoked')
         if self.segmentationNode:
             self.saveActiveSegmentation()
         self.clearNodes()
+        self.removeObservers()
+
+
+def matchManifestColumns(imagePatterns, imageColumns):
+    """Manifest column of each image pattern: the pattern itself (as written by ``saveManifest``) or its name without extensions
+
+    For example ``t1ce.nii.gz`` is read from a ``t1ce.nii.gz`` or a ``t1ce`` column.
+
+    Returns:
+        list: one column per pattern, in pattern order; None for patterns without a column
+    """
+    patternColumns = []
+    for pattern in imagePatterns:
+        candidates = [col for col in (pattern, pattern.split('.')[0]) if col in imageColumns]
+        patternColumns.append(candidates[0] if candidates else None)
+    return patternColumns
+
+
+def findConnectedComponents(mask):
+    """Find the connected components of a binary mask, looking only within its bounding box
+
+    Returns:
+        list of tuple: ``(size, centroid)`` per component, with size in voxels and the centroid as
+        IJK (column, row, slice) index coordinates
+    """
+    import SimpleITK as sitk
+    inds = np.nonzero(mask)
+    if len(inds[0]) == 0:
+        return []
+    bboxMin = [int(axisInds.min()) for axisInds in inds]
+    bbox = tuple(slice(lo, int(axisInds.max()) + 1) for lo, axisInds in zip(bboxMin, inds))
+    components = sitk.ConnectedComponent(sitk.GetImageFromArray(mask[bbox].astype(np.uint8)))
+    stats = sitk.LabelShapeStatisticsImageFilter()
+    stats.Execute(components)
+    offsetIJK = np.array(bboxMin[::-1], float)  # numpy arrays are indexed [k, j, i]
+    return [(int(stats.GetNumberOfPixels(label)), tuple(np.array(stats.GetCentroid(label)) + offsetIJK)) for label in stats.GetLabels()]
+
+
+def removeSmallIslands(mask, minSize):
+    """Return a copy of a binary mask without the connected components smaller than ``minSize`` voxels"""
+    import SimpleITK as sitk
+    cleaned = np.zeros(mask.shape, bool)
+    inds = np.nonzero(mask)
+    if len(inds[0]) == 0:
+        return cleaned
+    bbox = tuple(slice(int(axisInds.min()), int(axisInds.max()) + 1) for axisInds in inds)
+    components = sitk.ConnectedComponent(sitk.GetImageFromArray(mask[bbox].astype(np.uint8)))
+    kept = sitk.RelabelComponent(components, minimumObjectSize=minSize)
+    cleaned[bbox] = sitk.GetArrayViewFromImage(kept) > 0
+    return cleaned
+
+
+def removeSmallIslandsFromFile(label_fn, labelNames, minSize):
+    """Remove islands smaller than ``minSize`` voxels from each ROI of a label file, in place
+
+    Runs without the MRML scene, so it can be called from worker threads. The file is only
+    rewritten if something was removed.
+
+    Returns:
+        int: number of voxels that were set to background
+    """
+    import SimpleITK as sitk
+    label = readCaseImage(label_fn)
+    labelArray = sitk.GetArrayFromImage(label)
+    numRemoved = 0
+    for labelVal in labelNames:
+        mask = labelArray == int(labelVal)
+        removed = mask & ~removeSmallIslands(mask, minSize)
+        labelArray[removed] = 0
+        numRemoved += int(removed.sum())
+    if numRemoved:
+        storeDir, member = splitCaseFileRef(label_fn)
+        if member is None:
+            cleaned = sitk.GetImageFromArray(labelArray)
+            cleaned.CopyInformation(label)
+            if isRemoteUrl(label_fn):
+                cache = RemoteFileCache.shared()
+                staged_fn = cache.stagingPath(label_fn)
+                sitk.WriteImage(cleaned, staged_fn, label_fn.endswith('.gz'))
+                cache.upload(label_fn, staged_fn)
+                os.remove(staged_fn)
+            else:
+                sitk.WriteImage(cleaned, label_fn, label_fn.endswith('.gz'))
+        else:
+            CaseStore(storeDir).writeArray(member, labelArray, sitkIJKToRAS(label))
+    return numRemoved
+
+
+def encodeLabelDiff(before, after):
+    """Encode the voxels that differ between two label arrays of the same shape
+
+    Only the bounding box of the changed voxels is scanned for runs, so the encoded diff grows
+    with the size of the edit rather than the size of the volume.
+
+    Returns:
+        dict of numpy arrays (see ``applyLabelDiff``), or None if the arrays are identical
+    """
+    changedInds = np.nonzero(before != after)
+    if len(changedInds[0]) == 0:
+        return None
+    bboxMin = np.array([inds.min() for inds in changedInds], np.int64)
+    bboxMax = np.array([inds.max() for inds in changedInds], np.int64) + 1
+    bbox = tuple(slice(lo, hi) for lo, hi in zip(bboxMin, bboxMax))
+    changed = (before[bbox] != after[bbox]).ravel()
+
+    # runs of changed voxels within the raveled bounding box
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], changed.view(np.int8), [0]))))
+    runStarts, runEnds = edges[0::2], edges[1::2]
+    return {
+        'bboxMin': bboxMin,
+        'bboxMax': bboxMax,
+        'runStarts': runStarts.astype(np.uint32),
+        'runLengths': (runEnds - runStarts).astype(np.uint32),
+        'before': before[bbox].ravel()[changed],
+        'after': after[bbox].ravel()[changed],
+    }
+
+
+def applyLabelDiff(labelArray, diff, reverse=False):
+    """Apply a diff from ``encodeLabelDiff`` to ``labelArray`` in place
+
+    Args:
+        labelArray (np.ndarray): array in the ``before`` state (or ``after`` state if ``reverse``)
+        diff (dict): the encoded diff
+        reverse (bool): restore the ``before`` values instead of applying the ``after`` values
+    """
+    bbox = tuple(slice(int(lo), int(hi)) for lo, hi in zip(diff['bboxMin'], diff['bboxMax']))
+    runStarts = diff['runStarts'].astype(np.int64)
+    runLengths = diff['runLengths'].astype(np.int64)
+    runOffsets = np.cumsum(runLengths) - runLengths
+    inds = np.arange(runLengths.sum()) - np.repeat(runOffsets, runLengths) + np.repeat(runStarts, runLengths)
+    region = labelArray[bbox].copy()
+    region.ravel()[inds] = diff['before'] if reverse else diff['after']
+    labelArray[bbox] = region
+
+
+def labelChecksum(labelArray):
+    """Checksum of a label array's shape and values (not its dtype), to check that history diffs apply to it"""
+    if labelArray.dtype != np.uint8 and labelArray.min() >= 0 and labelArray.max() <= 255:
+        labelArray = labelArray.astype(np.uint8)
+    digest = hashlib.blake2b(repr((labelArray.shape, labelArray.dtype.str)).encode('ascii'), digest_size=16)
+    digest.update(np.ascontiguousarray(labelArray).data)
+    return digest.hexdigest()
+
+
+def countLabelValues(labelArray):
+    """Number of voxels with each value of a label array, as ``{int value: count}``
+
+    Uses ``np.unique``, so negative or large label values don't need special handling; values that
+    aren't in the config are reported by ``createSegmentationFromFile``.
+    """
+    values, counts = np.unique(labelArray, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def updateLabelCounts(counts, before, after):
+    """Turn ``countLabelValues(before)`` into the counts of ``after``, looking only at the voxels that differ
+
+    Returns a new dict; values whose count drops to zero are left out.
+    """
+    if before.shape != after.shape:
+        return countLabelValues(after)
+    changed = before != after
+    counts = dict(counts)
+    for value, count in countLabelValues(before[changed]).items():
+        counts[value] -= count
+    for value, count in countLabelValues(after[changed]).items():
+        counts[value] = counts.get(value, 0) + count
+    return {value: count for value, count in counts.items() if count}
+
+
+def summarizeLabelChanges(before, after, labelNames):
+    """Summarize the voxels that differ between two label arrays of the same shape
+
+    Args:
+        before (np.ndarray): label array as loaded
+        after (np.ndarray): label array as saved
+        labelNames (dict): label value (str) -> ROI name, for the labels to report
+
+    Returns:
+        dict with the number of changed voxels, the voxels added to and removed from each label,
+        and the [min, max] index of the changed voxels along each array axis (None if nothing
+        changed)
+    """
+    changed = before != after
+    numLabels = max(int(before.max()), int(after.max()), *[int(labelVal) for labelVal in labelNames]) + 1
+    added = np.bincount(after[changed], minlength=numLabels)
+    removed = np.bincount(before[changed], minlength=numLabels)
+    bbox = None
+    if added.sum():
+        bbox = []
+        for axis in range(changed.ndim):
+            inds = np.flatnonzero(changed.any(axis=tuple(ax for ax in range(changed.ndim) if ax != axis)))
+            bbox.append([int(inds[0]), int(inds[-1])])
+    return {
+        'changedVoxels': int(added.sum()),
+        'added': {labelVal: int(added[int(labelVal)]) for labelVal in labelNames},
+        'removed': {labelVal: int(removed[int(labelVal)]) for labelVal in labelNames},
+        'changedBoundingBox': bbox,
+    }
+
+
+def appendAuditRecord(auditFilename, record):
+    """Append one JSON record as a line of ``auditFilename``"""
+    os.makedirs(os.path.dirname(os.path.abspath(auditFilename)), exist_ok=True)
+    with open(auditFilename, 'a') as f:
+        f.write(json.dumps(record)+'\n')
+
+
+def interpolateGap(sliceA, sliceB, numSlices, margin=2):
+    """Fill ``numSlices`` slices between two drawn slices by blending their signed distance maps
+
+    Works only within the in-plane bounding box of both slices (plus ``margin``), and computes
+    every slice of the gap at once.
+
+    Returns:
+        bbox (tuple of slice): in-plane bounding box of the filled slices
+        filled (np.ndarray): boolean array of shape ``(numSlices,) + bbox shape``
+    """
+    import SimpleITK as sitk
+    rows, cols = np.nonzero(sliceA | sliceB)
+    bbox = (slice(max(int(rows.min()) - margin, 0), int(rows.max()) + margin + 1), slice(max(int(cols.min()) - margin, 0), int(cols.max()) + margin + 1))
+    distanceA, distanceB = [
+        sitk.GetArrayFromImage(sitk.SignedMaurerDistanceMap(sitk.GetImageFromArray(keySlice[bbox].astype(np.uint8)), insideIsPositive=False, squaredDistance=False, useImageSpacing=False))
+        for keySlice in (sliceA, sliceB)
+    ]
+    weights = (np.arange(1, numSlices + 1, dtype=np.float32) / (numSlices + 1))[:, np.newaxis, np.newaxis]
+    return bbox, (1 - weights) * distanceA + weights * distanceB <= 0
+
+
+def sliceHash(mask2d):
+    return zlib.crc32(np.packbits(mask2d).tobytes())
+
+
+class SliceInterpolator():
+    """Shape-based interpolation of one ROI between the slices the labeler drew
+
+    Slices run along the first array axis (axial for axially acquired images). Drawn ("key")
+    slices are the non-empty slices that the last run didn't fill, or that were edited since, so
+    correcting a filled slice turns it into a key slice. Slices of ``loadedMask`` (the ROI as read
+    from the label file) only become key slices once they are edited, and gaps that contain an
+    unedited loaded slice are left alone, so real gaps in a loaded ROI (e.g. between the foci of a
+    multifocal lesion) are never filled. Each gap between consecutive key slices is filled with
+    ``interpolateGap`` and cached by the two key slices' contents, so a rerun only recomputes the
+    gaps next to key slices that changed.
+    """
+
+    def __init__(self, loadedMask=None):
+        self.keySlices = []
+        self.filledHashes = {}  # slice index -> sliceHash of the slice as filled by the last run
+        self.gapCache = {}  # (slice a, hash a, slice b, hash b) -> (bbox, filled)
+        self.loadedHashes = {}  # slice index -> sliceHash of the non-empty slices of loadedMask
+        if loadedMask is not None:
+            self.loadedHashes = {int(k): sliceHash(loadedMask[k]) for k in np.flatnonzero(loadedMask.reshape(len(loadedMask), -1).any(axis=1))}
+
+
+    def interpolate(self, mask, allowed=None):
+        """Return the mask with the gaps between key slices filled
+
+        Args:
+            mask (np.ndarray): boolean ROI mask, indexed ``[slice, row, column]``
+            allowed (np.ndarray): optional boolean array of the voxels that may be filled
+
+        Returns:
+            filled (np.ndarray): the new mask; slices outside the gaps are unchanged, except
+                previously filled slices that are no longer between key slices, which are cleared
+            numGapsComputed (int): number of gaps that weren't in the cache
+        """
+        hashes = {int(k): sliceHash(mask[k]) for k in np.flatnonzero(mask.reshape(len(mask), -1).any(axis=1))}
+        self.keySlices = [k for k, sliceHashVal in sorted(hashes.items()) if sliceHashVal not in (self.filledHashes.get(k), self.loadedHashes.get(k))]
+        loadedSlices = [k for k, sliceHashVal in hashes.items() if k not in self.filledHashes and sliceHashVal == self.loadedHashes.get(k)]
+        filled = mask.copy()
+        filled[list(set(self.filledHashes) - set(self.keySlices))] = False
+        gapCache, filledHashes = {}, {}
+        numGapsComputed = 0
+        for sliceA, sliceB in zip(self.keySlices[:-1], self.keySlices[1:]):
+            if sliceB - sliceA < 2 or any(sliceA < k < sliceB for k in loadedSlices):
+                continue
+            key = (sliceA, hashes[sliceA], sliceB, hashes[sliceB])
+            if key not in self.gapCache:
+                self.gapCache[key] = interpolateGap(mask[sliceA], mask[sliceB], sliceB - sliceA - 1)
+                numGapsComputed += 1
+            gapCache[key] = bbox, gapFilled = self.gapCache[key]
+            gap = filled[sliceA+1:sliceB]
+            gap[:] = False
+            if allowed is not None:
+                gapFilled = gapFilled & allowed[sliceA+1:sliceB][(slice(None),) + bbox]
+            gap[(slice(None),) + bbox] = gapFilled
+            filledHashes.update((k, sliceHash(filled[k])) for k in range(sliceA + 1, sliceB))
+        self.gapCache = gapCache
+        self.filledHashes = filledHashes
+        return filled, numGapsComputed
+
+
+class EditHistory():
+    """Undo/redo stack of diffs between successive saved versions of one label file
+
+    Each diff is stored as a compressed ``.npz`` file in ``historyDir``; ``history.json`` lists
+    them in order along with the current position in the stack, and the ``labelChecksum`` of the
+    label before and after each diff. A step is only applied to a label with the matching checksum,
+    so a label file that was changed outside the history isn't corrupted by undo/redo.
+    """
+
+    def __init__(self, historyDir):
+        self.historyDir = historyDir
+        self.indexFilename = os.path.join(historyDir, 'history.json')
+        self.steps = []
+        self.position = 0
+        if os.path.exists(self.indexFilename):
+            with open(self.indexFilename) as f:
+                index = json.load(f)
+            self.steps = index['steps']
+            self.position = index['position']
+
+
+    def push(self, diff, beforeChecksum, afterChecksum):
+        """Add a diff after the current position, discarding any undone steps
+
+        Args:
+            diff (dict): diff from ``encodeLabelDiff``
+            beforeChecksum, afterChecksum (str): ``labelChecksum`` of the label before and after the diff
+        """
+        os.makedirs(self.historyDir, exist_ok=True)
+        for step in self.steps[self.position:]:
+            stepFilename = os.path.join(self.historyDir, step['filename'])
+            if os.path.exists(stepFilename):
+                os.remove(stepFilename)
+        self.steps = self.steps[:self.position]
+        stepFilename = 'step-%s-%03d.npz' % (time.strftime('%Y%m%d-%H%M%S'), len(self.steps))
+        np.savez_compressed(os.path.join(self.historyDir, stepFilename), **diff)
+        self.steps.append({'filename': stepFilename, 'time': time.time(), 'changedVoxels': int(len(diff['after'])),
+                           'beforeChecksum': beforeChecksum, 'afterChecksum': afterChecksum})
+        self.position = len(self.steps)
+        self.writeIndex()
+
+
+    def undo(self, labelChecksum):
+        """Step back one diff. Returns the diff to reverse, or None at the start of the history
+
+        Raises:
+            ValueError: if ``labelChecksum`` (of the label as it is now) isn't the one the diff led to
+        """
+        if self.position == 0:
+            return None
+        self.checkStep(self.position - 1, 'afterChecksum', labelChecksum)
+        self.position -= 1
+        self.writeIndex()
+        return self.loadStep(self.position)
+
 
+    def redo(self, labelChecksum):
+        """Step forward one diff. Returns the diff to apply, or None at the end of the history
 
-def loadLabelArrayFromFile(labelFilename):
-    """Load raw numpy array from a label image file"""
-    labelmapNode = slicer.util.loadLabelVolume(labelFilename)
-    labelArray = slicer.util.arrayFromVolume(labelmapNode)
-    slicer.mrmlScene.RemoveNode(labelmapNode)
-    return labelArray
+        Raises:
+            ValueError: if ``labelChecksum`` (of the label as it is now) isn't the one the diff was made from
+        """
+        if self.position >= len(self.steps):
+            return None
+        self.checkStep(self.position, 'beforeChecksum', labelChecksum)
+        self.position += 1
+        self.writeIndex()
+        return self.loadStep(self.position - 1)
+
+
+    def checkStep(self, stepInd, key, labelChecksum):
+        if self.steps[stepInd].get(key) != labelChecksum:
+            raise ValueError('the label file was changed outside the edit history in '+self.historyDir+', so its saved edits no longer apply')
+
+
+    def loadStep(self, stepInd):
+        with np.load(os.path.join(self.historyDir, self.steps[stepInd]['filename'])) as f:
+            return {key: f[key] for key in f.files}
+
+
+    def writeIndex(self):
+        tmpFilename = self.indexFilename + '.tmp'
+        with open(tmpFilename, 'w') as f:
+            json.dump({'position': self.position, 'steps': self.steps}, f, indent=1)
+        os.replace(tmpFilename, self.indexFilename)
+
+
+def saveCaseArray(array, ijkToRas, ref):
+    """Write an array with the given IJK-to-RAS matrix to an image file or case store member, or upload it to a remote url
+
+    Runs without the MRML scene. Image files are written with SimpleITK, which uses the same ITK
+    image IO as ``slicer.util.saveNode`` (compressed only for ``.gz`` names), so a NIfTI label has
+    the same header fields and voxels as exporting the segments to a labelmap node and saving it
+    (``testSaveCaseArray`` checks this).
+
+    Raises:
+        OSError: if a remote file was changed on the server since it was loaded. The new version
+            is kept in the cache folder (``RemoteFileCache.stagingPath``) so it isn't lost
+        RuntimeError: if the image file can't be written
+    """
+    import SimpleITK as sitk
+    if isRemoteUrl(ref):
+        cache = RemoteFileCache.shared()
+        staged_fn = cache.stagingPath(ref)
+        os.makedirs(os.path.dirname(staged_fn), exist_ok=True)
+        sitk.WriteImage(sitkImageFromArray(array, ijkToRas), staged_fn, ref.endswith('.gz'))
+        cache.upload(ref, staged_fn)
+        os.remove(staged_fn)
+        return
+    storeDir, member = splitCaseFileRef(ref)
+    if member is None:
+        sitk.WriteImage(sitkImageFromArray(array, ijkToRas), ref, ref.endswith('.gz'))
+        return
+    if member.startswith('dicom:'):
+        raise ValueError('Cannot save to DICOM series '+ref+', labels must be NIfTI files or case store members')
+    CaseStore(storeDir).writeArray(member, array, ijkToRas)
 
 
 class BatchSegmenterTest():
 
+    # import + widget setup budget for ``testStartupTime``
+    startupTimeBudgetSec = 2.0
+
     def delayDisplay(self, message, msec=150):
         """Display a small dialog and wait
     
@@ -388,17 +1852,37 @@ class BatchSegmenterTest():
     def runTest(self):
         """Run as few or as many tests as needed here."""
         self.setUp()
+        self.testStartupTime()
         self.testBatchSegmenter()
+        self.testEditHistory()
+        self.testChangeAudit()
+        self.testLabelCounts()
+        self.testCohortQC()
+        self.testIslandRemoval()
+        self.testManifestColumns()
+        self.testSaveCaseArray()
+        self.testCaseStore()
+        self.testDicomSeries()
+        self.testRemoteFiles()
+        self.testSliceInterpolation()
+        self.testResampleCache()
+        self.testResampledLabelUndo()
+        self.testActionProfiler()
+        self.testIntegrityCheck()
+        self.testMemorySoak()
 
 
     def testBatchSegmenter(self):
         self.delayDisplay('BatchSegmenter tests')
 
         self.delayDisplay('Creating BatchSegmenter widgets')
-        
-        mainWindow = slicer.util.mainWindow()
-        mainWindow.moduleSelector().selectModule('BatchSegmenter')
-        batchSegmentationWidget = slicer.modules.BatchSegmenterWidget
+
+        # a private widget, so the module's widget (and the dataset loaded in it) isn't touched
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        batchSegmentationWidget = BatchSegmenterWidget(parent)
+        batchSegmentationWidget.setup()
 
         testDataDir = os.path.join(os.path.dirname(__file__), 'Data')
         sampleVolFilenames = [
@@ -432,6 +1916,8 @@ class BatchSegmenterTest():
         originalSeg = loadLabelArrayFromFile(sampleLabelFilename)
         batchSegmentationWidget.loadVolumesFromFiles(sampleVolFilenames)
         batchSegmentationWidget.createSegmentationFromFile(sampleLabelFilename)
+        assert batchSegmentationWidget.segmentationNode.GetSegmentation().GetNumberOfLayers() == 1
+        assert batchSegmentationWidget.exportSharedLabelmap() is not None
         testSegFilename = os.path.join(tempdir, 'tumor-seg-test.nii')
         batchSegmentationWidget.active_label_fn = testSegFilename
         batchSegmentationWidget.saveActiveSegmentation()
@@ -444,6 +1930,954 @@ class BatchSegmenterTest():
             raise e
 
         batchSegmentationWidget.clearNodes()
-        
+
+        # test round-trip through the per-segment merge (a segment in its own layer); segment names
+        # and the scene are left unchanged
+        sampleLabelFilename = os.path.join(testDataDir, 'tumor-seg.nii')
+        originalSeg = loadLabelArrayFromFile(sampleLabelFilename)
+        batchSegmentationWidget.loadVolumesFromFiles(sampleVolFilenames)
+        batchSegmentationWidget.createSegmentationFromFile(sampleLabelFilename)
+        segmentation = batchSegmentationWidget.segmentationNode.GetSegmentation()
+        segmentation.SeparateSegmentLabelmap(segmentation.GetNthSegmentID(0))
+        assert segmentation.GetNumberOfLayers() > 1 and batchSegmentationWidget.exportSharedLabelmap() is None
+        segmentNames = [segmentation.GetNthSegment(segInd).GetName() for segInd in range(segmentation.GetNumberOfSegments())]
+        numNodes = slicer.mrmlScene.GetNumberOfNodes()
+        batchSegmentationWidget.active_label_fn = testSegFilename
+        batchSegmentationWidget.saveActiveSegmentation()
+        assert [segmentation.GetNthSegment(segInd).GetName() for segInd in range(segmentation.GetNumberOfSegments())] == segmentNames
+        assert slicer.mrmlScene.GetNumberOfNodes() == numNodes
+        finalSeg = loadLabelArrayFromFile(testSegFilename)
+        try:
+            np.testing.assert_array_equal(originalSeg, finalSeg)
+            self.delayDisplay('Round trip segmentation read-write-read test 3 successful')
+        except AssertionError as e:
+            self.delayDisplay('Round trip segmentation read-write-read test 3 FAILED')
+            raise e
+
+        batchSegmentationWidget.cleanup()
+        parent.deleteLater()
+        shutil.rmtree(tempdir)
         self.delayDisplay('Tests passed!')
-    
\ No newline at end of file
+
+
+    def testEditHistory(self):
+        self.delayDisplay('Edit history tests')
+
+        original = np.zeros((20, 30, 40), np.uint8)
+        original[5:10, 5:10, 5:10] = 1
+        edited = original.copy()
+        edited[6:8, 6:20, 6:30] = 2  # paint
+        edited[9, 5:10, 5:10] = 0  # erase
+        diff = encodeLabelDiff(original, edited)
+        assert encodeLabelDiff(original, original) is None
+
+        history = EditHistory(tempfile.mkdtemp())
+        history.push(diff, labelChecksum(original), labelChecksum(edited))
+        assert labelChecksum(edited.astype(np.int16)) == labelChecksum(edited) != labelChecksum(original)
+
+        # reload from disk, undo then redo
+        history = EditHistory(history.historyDir)
+        restored = edited.copy()
+        applyLabelDiff(restored, history.undo(labelChecksum(restored)), reverse=True)
+        np.testing.assert_array_equal(restored, original)
+        assert history.undo(labelChecksum(restored)) is None
+        applyLabelDiff(restored, history.redo(labelChecksum(restored)))
+        np.testing.assert_array_equal(restored, edited)
+        assert history.redo(labelChecksum(restored)) is None
+
+        # a label changed outside the history is refused and the position is kept
+        changed = edited.copy()
+        changed[0, 0, 0] = 3
+        try:
+            history.undo(labelChecksum(changed))
+            raise AssertionError('undo applied to a label that was changed outside the history')
+        except ValueError:
+            pass
+        assert history.position == 1 and EditHistory(history.historyDir).position == 1
+        shutil.rmtree(history.historyDir)
+
+        self.delayDisplay('Edit history tests passed!')
+
+
+    def testChangeAudit(self):
+        self.delayDisplay('Change audit tests')
+
+        labelNames = OrderedDict([('1', 'core'), ('2', 'edema'), ('3', 'enhancing')])
+        loaded = np.zeros((20, 30, 40), np.uint8)
+        loaded[5:10, 5:10, 5:10] = 1
+        saved = loaded.copy()
+        saved[6:8, 12:20, 6:30] = 2  # paint 2*8*24 edema voxels
+        saved[9, 5:10, 5:10] = 0  # erase 25 core voxels
+        changes = summarizeLabelChanges(loaded, saved, labelNames)
+        assert changes['added'] == {'1': 0, '2': 384, '3': 0}
+        assert changes['removed'] == {'1': 25, '2': 0, '3': 0}
+        assert changes['changedVoxels'] == 409
+        assert changes['changedBoundingBox'] == [[6, 9], [5, 19], [5, 29]]
+        assert summarizeLabelChanges(loaded, loaded, labelNames)['changedBoundingBox'] is None
+
+        audit_fn = os.path.join(tempfile.mkdtemp(), 'audit', 'audit.jsonl')
+        appendAuditRecord(audit_fn, {'case': 'a'})
+        appendAuditRecord(audit_fn, {'case': 'b'})
+        with open(audit_fn) as f:
+            assert [json.loads(line)['case'] for line in f] == ['a', 'b']
+
+        self.delayDisplay('Change audit tests passed!')
+
+
+    def testLabelCounts(self):
+        self.delayDisplay('Label count tests')
+        labelArray = np.zeros((10, 20, 30), np.uint8)
+        labelArray[2:4, 5:10, 5:10] = 1
+        labelArray[5, :, :] = 3
+        assert countLabelValues(labelArray) == {0: 5350, 1: 50, 3: 600}
+        assert countLabelValues(labelArray.astype(np.int16) - 1) == {-1: 5350, 0: 50, 2: 600}
+        assert countLabelValues(labelArray.astype(np.int32) * 100000) == {0: 5350, 100000: 50, 300000: 600}
+
+        # a stroke only counts the voxels it changed
+        edited = labelArray.copy()
+        edited[2, 5:10, 5:10] = 2  # 25 voxels from 1 to 2
+        edited[8, 0, 0:4] = 1
+        counts = updateLabelCounts(countLabelValues(labelArray), labelArray, edited)
+        assert counts == countLabelValues(edited) == {0: 5346, 1: 29, 2: 25, 3: 600}
+        assert updateLabelCounts(counts, edited, edited) == counts
+        erased = edited.copy()
+        erased[erased == 2] = 0
+        assert updateLabelCounts(counts, edited, erased) == {0: 5371, 1: 29, 3: 600}
+        assert updateLabelCounts(counts, edited, edited[:5]) == countLabelValues(edited[:5])  # layer extent changed
+        self.delayDisplay('Label count tests passed!')
+
+
+    def testCohortQC(self):
+        import SimpleITK as sitk
+        self.delayDisplay('Cohort QC tests')
+        tempDir = tempfile.mkdtemp()
+        labelNames = OrderedDict([('1', 'core'), ('2', 'edema'), ('3', 'enhancing')])
+
+        # skull-stripped brain: a 20x20x20 block of nonzero voxels in a zero background
+        brainArray = np.zeros((30, 30, 30), np.int16)
+        brainArray[5:25, 5:25, 5:25] = 100
+        labelArray = np.zeros(brainArray.shape, np.int16)
+        labelArray[6:10, 6:10, 6:10] = 1  # 64 voxels
+        labelArray[15:17, 15:17, 15:17] = 1  # second component, 8 voxels
+        labelArray[10:20, 10:20, 22:27] = 2  # 500 voxels, 200 outside the brain
+        labelArray[0, 0, 0] = -1  # not in labelNames, and below zero
+        labelArray[29, 29, 29] = 7
+        brain_fn, label_fn = os.path.join(tempDir, 'brain.nii.gz'), os.path.join(tempDir, 'label.nii.gz')
+        for array, fn in [(brainArray, brain_fn), (labelArray, label_fn)]:
+            image = sitk.GetImageFromArray(array)
+            image.SetSpacing((2.0, 1.0, 1.0))
+            sitk.WriteImage(image, fn)
+        qc = computeCaseQC(brain_fn, label_fn, labelNames)
+        assert qc['unknownLabels'] == [-1, 7]
+        assert qc['brainMask'] == 'nonzero'
+        assert np.isclose(qc['rois']['1']['volumeMl'], 72 * 2 / 1000)
+        assert qc['rois']['1']['components'] == 2
+        assert qc['rois']['1']['outsideBrain'] == 0
+        assert np.isclose(qc['rois']['1']['extent'], 11 / 20)
+        assert qc['rois']['2']['components'] == 1
+        assert np.isclose(qc['rois']['2']['outsideBrain'], 0.4)
+        assert qc['rois']['3'] == {'volumeMl': 0.0, 'components': 0, 'extent': 0.0, 'outsideBrain': 0.0}
+        assert 'unknown labels [-1, 7]' in qcSummary(0, qc)
+
+        # an image with a noisy background isn't taken as skull-stripped
+        headArray = np.random.RandomState(0).randint(1, 10, brainArray.shape).astype(np.int16)
+        headArray[5:25, 5:25, 5:25] = 100
+        mask, method = brainMaskFromArray(headArray)
+        assert method == 'otsu'
+        np.testing.assert_array_equal(mask, brainArray > 0)
+        mask, method = brainMaskFromArray(brainArray)
+        assert method == 'nonzero'
+        np.testing.assert_array_equal(mask, brainArray > 0)
+
+        # cases that differ from the rest of the cohort, or have unknown labels, score highest
+        def caseQC(volumeMl, components, unknownLabels=()):
+            roi = {'volumeMl': volumeMl, 'components': components, 'extent': 0.5, 'outsideBrain': 0.0}
+            return {'unknownLabels': list(unknownLabels), 'brainMask': 'nonzero', 'rois': {'1': roi}}
+        qcResults = OrderedDict(('case%d' % ind, caseQC(10 + ind % 3, 1)) for ind in range(10))
+        qcResults['tiny'] = caseQC(0.1, 1)
+        qcResults['fragmented'] = caseQC(11, 9)
+        scores = anomalyScores(qcResults)
+        assert list(scores) == list(qcResults)
+        assert min(scores['tiny'], scores['fragmented']) > max(scores['case%d' % ind] for ind in range(10))
+        qcResults['unknown'] = caseQC(11, 1, [7])
+        scores = anomalyScores(qcResults)
+        assert scores['unknown'] >= 100 > max(scores['case%d' % ind] for ind in range(10))
+        assert anomalyScores({}) == {}
+
+        shutil.rmtree(tempDir)
+        self.delayDisplay('Cohort QC tests passed!')
+
+
+    def testIslandRemoval(self):
+        import SimpleITK as sitk
+        self.delayDisplay('Island removal tests')
+
+        # components of 27, 8 and 1 voxels; the last two only touch diagonally, so they're separate
+        mask = np.zeros((20, 20, 20), bool)
+        mask[2:5, 2:5, 2:5] = True
+        mask[10:12, 10:12, 10:12] = True
+        mask[12, 12, 12] = True
+        components = sorted(findConnectedComponents(mask))
+        assert [size for size, centroid in components] == [1, 8, 27]
+        assert np.allclose(components[0][1], (12, 12, 12))
+        assert np.allclose(components[1][1], (10.5, 10.5, 10.5))
+        assert np.allclose(components[2][1], (3, 3, 3))
+        asymmetric = np.zeros(mask.shape, bool)
+        asymmetric[1, 2, 3:6] = True
+        assert np.allclose(findConnectedComponents(asymmetric)[0][1], (4, 2, 1))  # IJK, not array order
+        assert findConnectedComponents(np.zeros(mask.shape, bool)) == []
+
+        # components smaller than minSize are removed, the rest are kept as they were
+        np.testing.assert_array_equal(removeSmallIslands(mask, 1), mask)
+        cleaned = removeSmallIslands(mask, 8)
+        assert cleaned.sum() == 35 and not cleaned[12, 12, 12]
+        np.testing.assert_array_equal(cleaned[:12, :12, :12], mask[:12, :12, :12])
+        cleaned = removeSmallIslands(mask, 9)
+        assert cleaned.sum() == 27 and cleaned[2:5, 2:5, 2:5].all()
+        assert not removeSmallIslands(np.zeros(mask.shape, bool), 5).any()
+
+        # each ROI in labelNames is cleaned separately, other label values are left alone
+        tempDir = tempfile.mkdtemp()
+        labelArray = np.zeros(mask.shape, np.int16)
+        labelArray[mask] = 2
+        labelArray[2:5, 2:5, 6] = 1  # 9 voxels, touching the label 2 block but a separate ROI
+        labelArray[18, 18, 18] = 1
+        labelArray[0, 0, 18] = 5  # not in labelNames
+        label_fn = os.path.join(tempDir, 'label.nii.gz')
+        image = sitk.GetImageFromArray(labelArray)
+        image.SetSpacing((0.5, 0.75, 2.0))
+        image.SetOrigin((10.0, -5.0, 3.0))
+        sitk.WriteImage(image, label_fn, True)
+        labelNames = OrderedDict([('1', 'core'), ('2', 'edema')])
+        assert removeSmallIslandsFromFile(label_fn, labelNames, 9) == 10
+        cleanedImage = sitk.ReadImage(label_fn)
+        cleanedArray = sitk.GetArrayFromImage(cleanedImage)
+        assert cleanedImage.GetPixelID() == image.GetPixelID()
+        assert np.allclose(cleanedImage.GetSpacing(), image.GetSpacing()) and np.allclose(cleanedImage.GetOrigin(), image.GetOrigin())
+        expected = labelArray.copy()
+        expected[10:13, 10:13, 10:13][expected[10:13, 10:13, 10:13] == 2] = 0
+        expected[18, 18, 18] = 0
+        np.testing.assert_array_equal(cleanedArray, expected)
+        assert cleanedArray[0, 0, 18] == 5 and (cleanedArray[2:5, 2:5, 2:5] == 2).all() and (cleanedArray[2:5, 2:5, 6] == 1).all()
+
+        # nothing left to remove: the file isn't rewritten
+        mtime = os.stat(label_fn).st_mtime_ns
+        assert removeSmallIslandsFromFile(label_fn, labelNames, 9) == 0
+        assert os.stat(label_fn).st_mtime_ns == mtime
+
+        # case store members are cleaned in the store
+        store_dir = os.path.join(tempDir, 'store')
+        CaseStore(store_dir).writeArray('label.nii.gz', labelArray, sitkIJKToRAS(image))
+        assert removeSmallIslandsFromFile(store_dir+'#label.nii.gz', labelNames, 9) == 10
+        np.testing.assert_array_equal(readCaseArray(store_dir+'#label.nii.gz')[0], expected)
+
+        shutil.rmtree(tempDir)
+        self.delayDisplay('Island removal tests passed!')
+
+
+    def testManifestColumns(self):
+        self.delayDisplay('Manifest column tests')
+        patterns = ['t1ce.nii.gz', 't2.nii.gz', 'flair.nii.gz', 't1.nii.gz']
+
+        # columns are put in config order, by pattern or name, and extra columns are ignored
+        assert matchManifestColumns(patterns, ['flair', 'scanner', 't1ce.nii.gz', 't1', 't2']) == ['t1ce.nii.gz', 't2', 'flair', 't1']
+        assert matchManifestColumns(patterns, patterns) == patterns
+        assert matchManifestColumns(patterns, ['t1ce', 't2', 'flair']) == ['t1ce', 't2', 'flair', None]
+
+        # a manifest with reordered and extra columns loads the images in config order
+        tempDir = tempfile.mkdtemp()
+        try:
+            manifest_fn = os.path.join(tempDir, 'manifest.csv')
+            writeManifest(manifest_fn, ['scanner', 'flair', 't1', 't2', 't1ce', 'seg'],
+                          [('case1', {'scanner': 'GE', 'flair': 'c1/flair.nii.gz', 't1': 'c1/t1.nii.gz', 't2': 'c1/t2.nii.gz', 't1ce': 'c1/t1ce.nii.gz', 'seg': 'c1/seg.nii.gz'})])
+            parent = slicer.qMRMLWidget()
+            parent.setLayout(qt.QVBoxLayout())
+            parent.setMRMLScene(slicer.mrmlScene)
+            widget = BatchSegmenterWidget(parent)
+            widget.setup()
+            widget.config['imageFilenamePatterns'] = patterns
+            widget.checkFilesExistCheckBox.checked = False
+            widget.loadManifest(manifest_fn)
+            assert widget.image_label_dict == OrderedDict([('case1', (['c1/t1ce.nii.gz', 'c1/t2.nii.gz', 'c1/flair.nii.gz', 'c1/t1.nii.gz'], 'c1/seg.nii.gz'))])
+
+            # a manifest without a column for every pattern isn't loaded
+            writeManifest(manifest_fn, ['t1ce', 't2', 'flair', 'seg'], [('case2', {'t1ce': 'a', 't2': 'b', 'flair': 'c', 'seg': 'd'})])
+            widget.loadManifest(manifest_fn)
+            assert list(widget.image_label_dict) == ['case1']
+            widget.cleanup()
+            parent.deleteLater()
+        finally:
+            shutil.rmtree(tempDir)
+        self.delayDisplay('Manifest column tests passed')
+
+
+    # NIfTI-1 header layout, to compare the fields written by different writers
+    niftiHeaderDtype = np.dtype([
+        ('sizeof_hdr', '<i4'), ('data_type', 'S10'), ('db_name', 'S18'), ('extents', '<i4'),
+        ('session_error', '<i2'), ('regular', 'S1'), ('dim_info', 'u1'), ('dim', '<i2', 8),
+        ('intent_p', '<f4', 3), ('intent_code', '<i2'), ('datatype', '<i2'), ('bitpix', '<i2'),
+        ('slice_start', '<i2'), ('pixdim', '<f4', 8), ('vox_offset', '<f4'), ('scl_slope', '<f4'),
+        ('scl_inter', '<f4'), ('slice_end', '<i2'), ('slice_code', 'u1'), ('xyzt_units', 'u1'),
+        ('cal_max', '<f4'), ('cal_min', '<f4'), ('slice_duration', '<f4'), ('toffset', '<f4'),
+        ('glmax', '<i4'), ('glmin', '<i4'), ('descrip', 'S80'), ('aux_file', 'S24'),
+        ('qform_code', '<i2'), ('sform_code', '<i2'), ('quatern', '<f4', 6), ('srow', '<f4', (3, 4)),
+        ('intent_name', 'S16'), ('magic', 'S4')])
+
+
+    def readNiftiFile(self, filename):
+        """Header record and voxel bytes of a .nii or .nii.gz file"""
+        with (gzip.open if filename.endswith('.gz') else open)(filename, 'rb') as f:
+            content = f.read()
+        header = np.frombuffer(content[:self.niftiHeaderDtype.itemsize], self.niftiHeaderDtype)[0]
+        return header, content[int(header['vox_offset']):]
+
+
+    def testSaveCaseArray(self):
+        """saveCaseArray writes the same NIfTI file as exporting the segments to a labelmap node and saving it"""
+        self.delayDisplay('Save case array tests')
+        tempDir = tempfile.mkdtemp()
+        labelArray = np.random.default_rng(0).integers(0, 4, (5, 6, 7)).astype(np.uint8)
+        c, s = np.cos(0.3), np.sin(0.3)
+        ijkToRas = np.array([[-0.9*c, -1.1*s, 0, 10], [-0.9*s, 1.1*c, 0, 20], [0, 0, 2.5, -3], [0, 0, 0, 1]])
+        arrayFilename = os.path.join(tempDir, 'array.nii.gz')
+        saveCaseArray(labelArray, ijkToRas, arrayFilename)
+        header, voxels = self.readNiftiFile(arrayFilename)
+        assert np.frombuffer(voxels, np.uint8).tobytes() == labelArray.tobytes()
+        assert header['datatype'] == 2 and header['bitpix'] == 8  # DT_UNSIGNED_CHAR
+        assert list(header['dim'][:4]) == [3, 7, 6, 5]
+        assert np.allclose(header['pixdim'][1:4], [0.9, 1.1, 2.5], atol=1e-5)
+        assert header['qform_code'] > 0 and header['sform_code'] > 0
+        assert np.allclose(header['srow'], ijkToRas[:3], atol=1e-5)  # NIfTI sform is RAS, like the IJK-to-RAS matrix
+
+        # .nii files are written uncompressed
+        plainFilename = os.path.join(tempDir, 'array.nii')
+        saveCaseArray(labelArray, ijkToRas, plainFilename)
+        with open(plainFilename, 'rb') as f:
+            assert f.read(2) != b'\x1f\x8b', 'gzip stream in a .nii file'
+        plainHeader, plainVoxels = self.readNiftiFile(plainFilename)
+        assert plainVoxels == voxels and plainHeader.tobytes() == header.tobytes()
+
+        # the segmentation export + saveNode path this replaced: segments in config order, exported
+        # onto the reference volume and saved as a labelmap node
+        referenceNode = slicer.util.addVolumeFromArray(np.zeros(labelArray.shape, np.int16), ijkToRas, 'saveCaseArray reference')
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceNode)
+        segmentIds = vtk.vtkStringArray()
+        for labelVal in ['1', '2', '3']:
+            segmentationNode.GetSegmentation().AddEmptySegment(labelVal, labelVal)
+            slicer.util.updateSegmentBinaryLabelmapFromArray((labelArray == int(labelVal)).astype(np.uint8), segmentationNode, labelVal, referenceNode)
+            segmentIds.InsertNextValue(labelVal)
+        labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+        slicer.vtkSlicerSegmentationsModuleLogic.ExportSegmentsToLabelmapNode(segmentationNode, segmentIds, labelmapNode, referenceNode)
+        nodeFilename = os.path.join(tempDir, 'node.nii.gz')
+        assert slicer.util.saveNode(labelmapNode, nodeFilename)
+        for node in (labelmapNode, segmentationNode, referenceNode):
+            slicer.mrmlScene.RemoveNode(node)
+
+        # the files are compared field by field: the orientation fields are floats computed along
+        # different paths (VTK matrices vs SimpleITK direction/spacing), and the gzip streams can
+        # differ with the writers' compression settings, so identical bytes aren't guaranteed
+        nodeHeader, nodeVoxels = self.readNiftiFile(nodeFilename)
+        assert nodeVoxels == voxels
+        for field in ['sizeof_hdr', 'dim', 'datatype', 'bitpix', 'qform_code', 'sform_code', 'xyzt_units',
+                      'descrip', 'aux_file', 'intent_code', 'intent_name', 'magic', 'vox_offset']:
+            assert np.array_equal(header[field], nodeHeader[field]), field+' differs from the saveNode header'
+        for field in ['pixdim', 'quatern', 'srow', 'scl_slope', 'scl_inter']:
+            assert np.allclose(header[field], nodeHeader[field], atol=1e-5, equal_nan=True), field+' differs from the saveNode header'
+        shutil.rmtree(tempDir)
+        self.delayDisplay('Save case array tests passed')
+
+
+    def testCaseStore(self):
+        self.delayDisplay('Case store tests')
+
+        storeDir = os.path.join(tempfile.mkdtemp(), 'case1')
+        image = np.random.default_rng(0).normal(size=(37, 20, 30)).astype(np.float32)
+        ijkToRas = np.diag([-1.0, -1.0, 2.5, 1.0])
+        CaseStore(storeDir).writeArray('t1.nii.gz', image, ijkToRas)
+
+        store = CaseStore(storeDir)
+        np.testing.assert_array_equal(store.readArray('t1.nii.gz'), image)
+        np.testing.assert_array_equal(store.readArray('t1.nii.gz', (5, 19)), image[5:19])
+        np.testing.assert_array_equal(store.ijkToRas('t1.nii.gz'), ijkToRas)
+        assert globCaseFiles(storeDir, 't1*') == [storeDir+'#t1.nii.gz']
+        assert caseFileExists(storeDir+'#t1.nii.gz') and not caseFileExists(storeDir+'#t2.nii.gz')
+
+        # only the slab that changed is rewritten
+        slabMtime = os.stat(store.slabFilename('t1.nii.gz', 0)).st_mtime_ns
+        image[-1] = 0
+        time.sleep(0.01)
+        store.writeArray('t1.nii.gz', image, ijkToRas)
+        assert os.stat(store.slabFilename('t1.nii.gz', 0)).st_mtime_ns == slabMtime
+        np.testing.assert_array_equal(CaseStore(storeDir).readArray('t1.nii.gz'), image)
+
+        self.delayDisplay('Case store tests passed')
+
+
+    def testDicomSeries(self):
+        self.delayDisplay('DICOM series tests')
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+        # write small axial series, slices out of order; one series has a slice of a different size
+        caseFolder = tempfile.mkdtemp()
+        pixels = np.arange(4 * 6 * 5, dtype=np.int16).reshape(4, 6, 5)
+        for description in ['AX T1 POST', 'AX FLAIR', 'AX MIXED']:
+            seriesUID = generate_uid()
+            for sliceInd in [2, 0, 3, 1]:
+                slicePixels = pixels[sliceInd, :-1] if description == 'AX MIXED' and sliceInd == 3 else pixels[sliceInd]
+                ds = Dataset()
+                ds.file_meta = FileMetaDataset()
+                ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds.file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+                ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+                ds.SOPClassUID, ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPClassUID, ds.file_meta.MediaStorageSOPInstanceUID
+                ds.SeriesInstanceUID, ds.SeriesDescription, ds.Modality = seriesUID, description, 'MR'
+                ds.ImagePositionPatient = [10.0, 20.0, 30.0 + 2.5 * sliceInd]
+                ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+                ds.PixelSpacing = [0.5, 0.8]  # row spacing, column spacing
+                ds.Rows, ds.Columns = slicePixels.shape
+                if description == 'AX FLAIR':
+                    ds.RescaleSlope, ds.RescaleIntercept = 2, -10
+                ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 16, 15, 1
+                ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+                ds.PixelData = slicePixels.tobytes()
+                ds.save_as(os.path.join(caseFolder, '%s-%d.dcm' % (description.replace(' ', '_'), sliceInd)), write_like_original=False)
+
+        refs = globCaseFiles(caseFolder, 'dicom:SeriesDescription=*t1*post*;Modality=MR')
+        assert len(refs) == 1 and caseFileExists(refs[0])
+        array, ijkToRas = readCaseArray(refs[0])
+        np.testing.assert_array_equal(array, pixels)
+        np.testing.assert_allclose(ijkToRas, [[-0.8, 0, 0, -10], [0, -0.5, 0, -20], [0, 0, 2.5, 30], [0, 0, 0, 1]])
+
+        # the grid comes from the indexed headers, without decoding the pixels
+        import SegCommon
+        decode, SegCommon.readDicomSeries = SegCommon.readDicomSeries, None
+        try:
+            assert readCaseGeometry(refs[0]) == {'shape': list(array.shape), 'ijkToRas': np.round(ijkToRas, 6).tolist()}
+        finally:
+            SegCommon.readDicomSeries = decode
+        flairRefs = globCaseFiles(caseFolder, 'dicom:SeriesDescription=*flair*')
+        assert len(flairRefs) == 1
+        np.testing.assert_array_equal(readCaseArray(flairRefs[0])[0], pixels * 2 - 10)
+        mixedRef = globCaseFiles(caseFolder, 'dicom:SeriesDescription=*mixed*')[0]
+        for read in [readCaseArray, readCaseGeometry]:
+            try:
+                read(mixedRef)
+                raise AssertionError('a series with mixed slice sizes was accepted')
+            except ValueError:
+                pass
+
+        # concurrent first scans of a folder share one scan (and one index file write)
+        indexFilename = DicomIndex.forFolder(caseFolder).indexFilename
+        update, scans = DicomIndex.update, []
+
+        def slowUpdate(index, maxWorkers=16):
+            scans.append(index.folder)
+            time.sleep(0.05)  # widen the window in which other threads ask for the folder
+            update(index, maxWorkers)
+
+        DicomIndex.update = slowUpdate
+        try:
+            DicomIndex.openIndexes.clear()
+            os.remove(indexFilename)
+            assert findMissingFiles(refs * 8 + flairRefs * 8) == set()
+            DicomIndex.openIndexes.clear()
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                indexes = list(executor.map(DicomIndex.forFolder, [caseFolder] * 16))
+        finally:
+            DicomIndex.update = update
+        assert len(scans) == 2 and len({id(index) for index in indexes}) == 1
+        assert os.path.exists(indexFilename)
+        assert not [fn for fn in os.listdir(os.path.dirname(indexFilename)) if fn.endswith('.tmp')]
+        shutil.rmtree(caseFolder)
+
+        self.delayDisplay('DICOM series tests passed')
+
+
+    def startTestFileServer(self, files):
+        """Serve ``files`` (dict of url path -> bytes) on localhost, standing in for an object store
+
+        Supports ``HEAD``, ``GET`` with ``Range`` and ``PUT`` with ``If-Match``/``If-None-Match``
+        over keep-alive connections. The base url is ``'http://127.0.0.1:%d' % server.server_port``.
+        """
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def etag(self):
+                return '"'+hashlib.sha1(files[self.path]).hexdigest()+'"'
+
+            def sendHeaders(self, status, length, extraHeaders=()):
+                self.send_response(status)
+                self.send_header('Content-Length', str(length))
+                for key, value in extraHeaders:
+                    self.send_header(key, value)
+                self.end_headers()
+
+            def do_HEAD(self):
+                if self.path not in files:
+                    return self.sendHeaders(404, 0)
+                self.sendHeaders(200, len(files[self.path]), [('ETag', self.etag()), ('Accept-Ranges', 'bytes')])
+
+            def do_GET(self):
+                if self.path not in files:
+                    return self.sendHeaders(404, 0)
+                data = files[self.path]
+                requestRange = self.headers.get('Range')
+                if requestRange and self.headers.get('If-Range', self.etag()) == self.etag():
+                    start, end = (int(num) for num in requestRange[len('bytes='):].split('-'))
+                    self.server.rangeRequests += 1
+                    self.sendHeaders(206, end - start + 1, [('ETag', self.etag())])
+                    self.wfile.write(data[start:end+1])
+                else:
+                    self.sendHeaders(200, len(data), [('ETag', self.etag())])
+                    self.wfile.write(data)
+
+            def do_PUT(self):
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                ifMatch = self.headers.get('If-Match')
+                if ifMatch and (self.path not in files or ifMatch != self.etag()):
+                    return self.sendHeaders(412, 0)
+                if self.headers.get('If-None-Match') == '*' and self.path in files:
+                    return self.sendHeaders(412, 0)
+                files[self.path] = data
+                self.server.uploads += 1
+                self.sendHeaders(200, 0, [('ETag', self.etag())])
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        server.rangeRequests = 0
+        server.uploads = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+    def testRemoteFiles(self):
+        self.delayDisplay('Remote file tests')
+
+        # parallel range downloads, reuse, revalidation and repair of the cache
+        files = {'/data/case1/t1.nii.gz': os.urandom(3 * 2**20 + 17)}
+        server = self.startTestFileServer(files)
+        baseUrl = 'http://127.0.0.1:%d/data/' % server.server_port
+        cache = RemoteFileCache(tempfile.mkdtemp(), revalidateSec=0)
+        cache.chunkSize = 2**20
+        url = urljoin(baseUrl, 'case1/t1.nii.gz')
+        with open(cache.fetch(url), 'rb') as f:
+            assert f.read() == files['/data/case1/t1.nii.gz']
+        assert server.rangeRequests == 4
+        cache.fetch(url)
+        assert server.rangeRequests == 4, 'unchanged file was downloaded again'
+        files['/data/case1/t1.nii.gz'] = b'changed on the server'
+        with open(cache.fetch(url), 'rb') as f:
+            assert f.read() == b'changed on the server'
+        with open(cache.localPath(url), 'wb') as f:
+            f.write(b'damaged on this computer')
+        with open(cache.fetch(url), 'rb') as f:
+            assert f.read() == b'changed on the server'
+        assert not cache.exists(urljoin(baseUrl, 'case1/missing.nii.gz'))
+        cache.prefetch([url])
+        cache.prefetching[url].result()
+
+        # conditional upload: refused if the server copy changed since it was fetched
+        staged_fn = cache.stagingPath(url)
+        with open(staged_fn, 'wb') as f:
+            f.write(b'edited here')
+        files['/data/case1/t1.nii.gz'] = b'edited by someone else'
+        try:
+            cache.upload(url, staged_fn)
+            raise AssertionError('upload over a changed file should fail')
+        except OSError:
+            pass
+        assert files['/data/case1/t1.nii.gz'] == b'edited by someone else'
+        cache.fetch(url)
+        cache.upload(url, staged_fn)
+        assert files['/data/case1/t1.nii.gz'] == b'edited here'
+        with open(cache.fetch(url), 'rb') as f:
+            assert f.read() == b'edited here'
+        server.shutdown()
+
+        # load a case from a dataset url and save the segmentation back to the server
+        testDataDir = os.path.join(os.path.dirname(__file__), 'Data')
+        sampleFilenames = ['T1-postcontrast.nii', 'T2.nii', 'FLAIR.nii', 'T1-precontrast.nii', 'tumor-seg.nii']
+        files = {}
+        for filename in sampleFilenames:
+            with open(os.path.join(testDataDir, filename), 'rb') as f:
+                files['/data/case1/'+filename] = f.read()
+        files['/data/manifest.csv'] = ('case,t1ce,t2,flair,t1,seg\ncase1,'+','.join('case1/'+fn for fn in sampleFilenames)+'\n').encode('utf-8')
+        server = self.startTestFileServer(files)
+        baseUrl = 'http://127.0.0.1:%d/data' % server.server_port
+        originalSeg = files['/data/case1/tumor-seg.nii']
+
+        # a private widget, so the module's widget (and the dataset loaded in it) isn't touched; loading
+        # the manifest saves a session, so the user's last session setting is put back afterwards
+        lastSession = qt.QSettings().value('BatchSegmenter/lastSession')
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        batchSegmentationWidget = BatchSegmenterWidget(parent)
+        batchSegmentationWidget.setup()
+        batchSegmentationWidget.loadManifest(remoteManifestUrl(baseUrl))
+        assert list(batchSegmentationWidget.image_label_dict) == ['case1']
+        assert batchSegmentationWidget.active_label_fn == baseUrl+'/case1/tumor-seg.nii'
+        assert len(batchSegmentationWidget.volNodes) == 4
+        batchSegmentationWidget.saveActiveSegmentation()
+        assert np.array_equal(loadLabelArrayFromFile(RemoteFileCache.shared().fetch(batchSegmentationWidget.active_label_fn)), loadLabelArrayFromFile(os.path.join(testDataDir, 'tumor-seg.nii')))
+        assert server.uploads == 1
+
+        # a save over a seg that changed on the server is refused and the server copy is kept; the
+        # edited version is staged, and the case isn't switched away from
+        files['/data/case1/tumor-seg.nii'] = originalSeg + b'\0'
+        assert batchSegmentationWidget.saveActiveSegmentation() is False
+        assert server.uploads == 1 and files['/data/case1/tumor-seg.nii'] == originalSeg + b'\0'
+        assert os.path.exists(RemoteFileCache.shared().stagingPath(batchSegmentationWidget.active_label_fn))
+        segmentationNode = batchSegmentationWidget.segmentationNode
+        batchSegmentationWidget.onComboboxChanged('case1')
+        assert batchSegmentationWidget.segmentationNode is segmentationNode
+        batchSegmentationWidget.clearNodes()
+        batchSegmentationWidget.cleanup()
+        parent.deleteLater()
+        if lastSession:
+            qt.QSettings().setValue('BatchSegmenter/lastSession', lastSession)
+        else:
+            qt.QSettings().remove('BatchSegmenter/lastSession')
+        server.shutdown()
+
+        self.delayDisplay('Remote file tests passed')
+
+
+    def testSliceInterpolation(self):
+        self.delayDisplay('Slice interpolation tests')
+
+        # discs of radius 10 on slice 0 and radius 20 on slice 10; slice 5 should get radius ~15
+        rows, cols = np.mgrid[:80, :80]
+        disc = lambda radius: (rows - 40)**2 + (cols - 40)**2 <= radius**2
+        mask = np.zeros((20, 80, 80), bool)
+        mask[0], mask[10] = disc(10), disc(20)
+        interpolator = SliceInterpolator()
+        filled, numGapsComputed = interpolator.interpolate(mask)
+        assert interpolator.keySlices == [0, 10] and numGapsComputed == 1
+        assert filled[1:10].all(axis=(1, 2)).sum() == 0 and filled[1:10].any(axis=(1, 2)).all()
+        assert disc(14).sum() <= filled[5].sum() <= disc(16).sum()
+        assert not filled[11:].any(), 'nothing is filled beyond the last drawn slice'
+
+        # filled slices aren't key slices, so a rerun recomputes nothing
+        refilled, numGapsComputed = interpolator.interpolate(filled)
+        assert numGapsComputed == 0 and np.array_equal(refilled, filled)
+
+        # drawing slice 15 only adds the gap after slice 10; editing filled slice 5 splits its gap
+        filled[15] = disc(10)
+        filled, numGapsComputed = interpolator.interpolate(filled)
+        assert numGapsComputed == 1 and interpolator.keySlices == [0, 10, 15]
+        filled[5] = disc(5)
+        filled, numGapsComputed = interpolator.interpolate(filled)
+        assert numGapsComputed == 2 and interpolator.keySlices == [0, 5, 10, 15]
+        assert filled[5].sum() == disc(5).sum()
+
+        # voxels of other ROIs are not filled
+        allowed = np.ones(mask.shape, bool)
+        allowed[:, :40] = False
+        filled, numGapsComputed = SliceInterpolator().interpolate(mask, allowed)
+        assert not filled[1:10, :40].any() and filled[1:10, 40:].any()
+
+        # a loaded two-focus ROI is left unchanged; only gaps between slices drawn since load are filled
+        loaded = np.zeros((30, 80, 80), bool)
+        loaded[3:6], loaded[12:15] = disc(8), disc(8)
+        interpolator = SliceInterpolator(loaded)
+        filled, numGapsComputed = interpolator.interpolate(loaded)
+        assert interpolator.keySlices == [] and numGapsComputed == 0 and np.array_equal(filled, loaded)
+        drawn = loaded.copy()
+        drawn[18], drawn[25] = disc(10), disc(10)
+        filled, numGapsComputed = interpolator.interpolate(drawn)
+        assert interpolator.keySlices == [18, 25] and numGapsComputed == 1
+        assert filled[19:25].any(axis=(1, 2)).all() and np.array_equal(filled[:18], loaded[:18])
+
+        # drawing around a loaded focus doesn't fill over it
+        filled[8] = disc(10)
+        filled, numGapsComputed = interpolator.interpolate(filled)
+        assert interpolator.keySlices == [8, 18, 25] and numGapsComputed == 0
+        assert np.array_equal(filled[:8], loaded[:8]) and np.array_equal(filled[9:18], loaded[9:18])
+
+        self.delayDisplay('Slice interpolation tests passed')
+
+
+    def testResampleCache(self):
+        self.delayDisplay('Resample cache tests')
+        import SimpleITK as sitk
+        tempDir = tempfile.mkdtemp()
+        try:
+            # a 1 mm image and a 2 mm label covering the same voxels
+            image = sitk.GetImageFromArray(np.arange(20**3, dtype=np.int16).reshape(20, 20, 20))
+            labelArray = np.zeros((10, 10, 10), np.uint8)
+            labelArray[2:5, 3:6, 4:7] = 1
+            label = sitk.GetImageFromArray(labelArray)
+            label.SetSpacing([2.0, 2.0, 2.0])
+            label.SetOrigin([0.5, 0.5, 0.5])
+            image_fn, label_fn = os.path.join(tempDir, 'image.nii.gz'), os.path.join(tempDir, 'label.nii.gz')
+            sitk.WriteImage(image, image_fn)
+            sitk.WriteImage(label, label_fn)
+
+            # only the label is reported, with the image's grid as its target
+            geometryCache_fn = os.path.join(tempDir, 'geometry-cache.json')
+            mismatches = findGeometryMismatches([('case', image_fn, [image_fn, label_fn])], geometryCache_fn)
+            assert list(mismatches) == ['case'] and list(mismatches['case']) == [label_fn]
+            geometry = mismatches['case'][label_fn]
+            assert geometry == readCaseGeometry(image_fn) and geometry['shape'] == [20, 20, 20]
+            assert findGeometryMismatches([('case', image_fn, [label_fn])], geometryCache_fn) == mismatches
+
+            # resampled once, then read from the cache
+            cache = ResampleCache(os.path.join(tempDir, 'resampled'))
+            assert cache.prepare([(label_fn, geometry, True)]) == {}
+            array_fn = cache.filename(label_fn, geometry, True)
+            mtime = os.stat(array_fn).st_mtime_ns
+            assert cache.prepare([(label_fn, geometry, True)]) == {} and os.stat(array_fn).st_mtime_ns == mtime
+            expected = labelArray.repeat(2, axis=0).repeat(2, axis=1).repeat(2, axis=2)
+            assert np.array_equal(cache.load(label_fn, geometry, labelmap=True), expected)
+
+            # a changed label gets a new cache entry
+            labelArray[0, 0, 0] = 2
+            label = sitk.GetImageFromArray(labelArray)
+            label.SetSpacing([2.0, 2.0, 2.0])
+            label.SetOrigin([0.5, 0.5, 0.5])
+            sitk.WriteImage(label, label_fn)
+            assert cache.filename(label_fn, geometry, True) != array_fn
+            assert cache.load(label_fn, geometry, labelmap=True)[1, 1, 1] == 2
+
+            # so does a same-size edit to an uncompressed label
+            bigLabel_fn = os.path.join(tempDir, 'label.nii')
+            sitk.WriteImage(sitk.GetImageFromArray(np.zeros((100, 100, 100), np.uint8)), bigLabel_fn)
+            array_fn = cache.filename(bigLabel_fn, geometry, True)
+            stat = os.stat(bigLabel_fn)
+            with open(bigLabel_fn, 'r+b') as f:
+                f.seek(300000)
+                f.write(b'\x01')
+            os.utime(bigLabel_fn, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))  # saved a second later
+            assert os.path.getsize(bigLabel_fn) == stat.st_size
+            assert cache.filename(bigLabel_fn, geometry, True) != array_fn
+        finally:
+            shutil.rmtree(tempDir)
+        self.delayDisplay('Resample cache tests passed')
+
+
+    def testResampledLabelUndo(self):
+        self.delayDisplay('Resampled label undo tests')
+        import SimpleITK as sitk
+        tempDir = tempfile.mkdtemp()
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = BatchSegmenterWidget(parent)
+        widget.setup()
+        try:
+            # a 2 mm label on a 1 mm image is resampled when it's loaded, so it differs from the file
+            image_fn, label_fn = os.path.join(tempDir, 'image.nii.gz'), os.path.join(tempDir, 'label.nii.gz')
+            sitk.WriteImage(sitk.GetImageFromArray(np.zeros((20, 20, 20), np.int16)), image_fn)
+            labelArray = np.zeros((10, 10, 10), np.uint8)
+            labelArray[2:5, 3:6, 4:7] = 1
+            label = sitk.GetImageFromArray(labelArray)
+            label.SetSpacing([2.0, 2.0, 2.0])
+            label.SetOrigin([0.5, 0.5, 0.5])
+            sitk.WriteImage(label, label_fn)
+            widget.config['editHistoryFolder'] = os.path.join(tempDir, 'edit-history')
+            widget.config['auditLogFilename'] = os.path.join(tempDir, 'audit.jsonl')
+            widget.image_label_dict = OrderedDict([('case', ([image_fn], label_fn))])
+            widget.updateWidgets()
+            assert label_fn in widget.resampleTargets
+            loaded = widget.savedLabelArray.copy()
+
+            # without edits undo neither saves nor audits
+            widget.undoSavedEdit()
+            assert label_fn in widget.resampleTargets and not os.path.exists(widget.config['auditLogFilename'])
+
+            # unsaved edits are saved as their own step and undone, back to the loaded label on the image grid
+            edited = loaded.copy()
+            edited[10:12, 10:12, 10:12] = 1
+            slicer.util.updateSegmentBinaryLabelmapFromArray(edited, widget.segmentationNode, '1', widget.volNodes[0])
+            widget.undoSavedEdit()
+            np.testing.assert_array_equal(widget.savedLabelArray, loaded)
+            np.testing.assert_array_equal(sitk.GetArrayFromImage(sitk.ReadImage(label_fn)), loaded)
+            widget.redoSavedEdit()
+            np.testing.assert_array_equal(widget.savedLabelArray, edited)
+
+            # but not after the file was changed outside Slicer
+            stat = os.stat(label_fn)
+            os.utime(label_fn, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+            widget.undoSavedEdit()
+            np.testing.assert_array_equal(widget.savedLabelArray, edited)
+        finally:
+            widget.cleanup()
+            parent.deleteLater()
+            shutil.rmtree(tempDir)
+        self.delayDisplay('Resampled label undo tests passed')
+
+
+    def testActionProfiler(self):
+        self.delayDisplay('Action profiler tests')
+
+        class Handlers():
+            caseName = 'case1'
+            def onCaseChanged(self, text):
+                self.caseName = text
+                self.save()
+                return text
+            def save(self, recordHistory=True):
+                time.sleep(0.05)
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            handlers = Handlers()
+            profiler = ActionProfiler(tempDir, lambda: handlers.caseName)
+            profiler.wrap(handlers, {'onCaseChanged': 'case change', 'save': 'save'})
+
+            # nothing is recorded while disabled, and extra signal arguments are dropped
+            assert handlers.onCaseChanged('case2', True) == 'case2'
+            assert profiler.records == [] and os.listdir(tempDir) == []
+
+            # the nested save is part of the case change profile
+            profiler.enabled = True
+            handlers.onCaseChanged('case3')
+            handlers.save()
+            assert [(action, caseName) for seconds, action, caseName, profile_fn in profiler.records] == [('case change', 'case3'), ('save', 'case3')]
+            assert all(os.path.exists(profile_fn) and profile_fn.endswith('_case3.prof') for seconds, action, caseName, profile_fn in profiler.records)
+            assert len(profiler.slowestActions(1)) == 1 and profiler.slowestActions()[0][0] >= profiler.slowestActions()[1][0]
+            stats = pstats.Stats(profiler.records[0][3])
+            assert any(function[2] == 'save' for function in stats.stats)
+        finally:
+            shutil.rmtree(tempDir)
+        self.delayDisplay('Action profiler tests passed')
+
+
+    def testIntegrityCheck(self):
+        self.delayDisplay('Integrity check tests')
+        import SimpleITK as sitk
+
+        tempDir = tempfile.mkdtemp()
+        try:
+            image = sitk.GetImageFromArray(np.arange(8000, dtype=np.int16).reshape(20, 20, 20))
+            fns = {name: os.path.join(tempDir, name) for name in ['good.nii.gz', 'good.nii', 'truncated.nii.gz', 'badcrc.nii.gz', 'shortdata.nii.gz']}
+            sitk.WriteImage(image, fns['good.nii.gz'], True)
+            sitk.WriteImage(image, fns['good.nii'])
+            with open(fns['good.nii.gz'], 'rb') as f:
+                data = f.read()
+            with open(fns['truncated.nii.gz'], 'wb') as f:  # e.g. an interrupted copy
+                f.write(data[:len(data)//2])
+            with open(fns['badcrc.nii.gz'], 'wb') as f:  # decodes, but the trailer doesn't match
+                f.write(data[:-8] + bytes([data[-8] ^ 0xff]) + data[-7:])
+            with open(fns['good.nii'], 'rb') as f:
+                raw = f.read()
+            with gzip.open(fns['shortdata.nii.gz'], 'wb') as f:  # valid gzip of a truncated image
+                f.write(raw[:len(raw)-100])
+
+            cacheFilename = os.path.join(tempDir, 'integrity.json')
+            checked = []
+            errors = validateCaseFiles(list(fns.values()), cacheFilename, lambda num, total: checked.append(total))
+            assert sorted(errors) == sorted(fns[name] for name in ['truncated.nii.gz', 'badcrc.nii.gz', 'shortdata.nii.gz']), errors
+            assert checked[-1] == 5
+            index = json.load(open(cacheFilename))
+            assert index[fns['good.nii.gz']][2] and index[fns['good.nii.gz']][3] is None
+
+            # unchanged files are not read again, touched files are
+            checked = []
+            assert validateCaseFiles(list(fns.values()), cacheFilename, lambda num, total: checked.append(total)) == errors
+            assert checked == [0] or checked == []
+            os.utime(fns['good.nii'], ns=(time.time_ns(), time.time_ns() + 10**9))
+            checked = []
+            assert validateCaseFiles(list(fns.values()), cacheFilename, lambda num, total: checked.append(total)) == errors
+            assert checked[-1] == 1
+        finally:
+            shutil.rmtree(tempDir)
+        self.delayDisplay('Integrity check tests passed')
+
+
+    def testMemorySoak(self, numCases=20, numRounds=4, rssToleranceMB=50):
+        """Cycle through synthetic cases; scene nodes, observers and memory must stay flat
+
+        The first round is a warm-up (caches, lazily created nodes), later rounds are compared to it.
+        """
+        self.delayDisplay('Memory soak test')
+        import SimpleITK as sitk
+
+        # write the synthetic cases
+        tempdir = tempfile.mkdtemp()
+        shape = (40, 64, 64)
+        rng = np.random.default_rng(0)
+        image_label_dict = OrderedDict()
+        for caseInd in range(numCases):
+            case_name = 'case%03d' % caseInd
+            im_fns = []
+            for imInd in range(2):
+                im_fn = os.path.join(tempdir, '%s_image%d.nii.gz' % (case_name, imInd))
+                sitk.WriteImage(sitk.GetImageFromArray(rng.normal(100, 20, shape).astype(np.float32)), im_fn)
+                im_fns.append(im_fn)
+            labelArray = np.zeros(shape, np.uint8)
+            for labelInd in range(3):
+                offset = 5 + 5 * labelInd + caseInd % 5
+                labelArray[offset:offset+10, offset:offset+20, offset:offset+20] = labelInd + 1
+            label_fn = os.path.join(tempdir, case_name+'_seg.nii.gz')
+            sitk.WriteImage(sitk.GetImageFromArray(labelArray), label_fn)
+            image_label_dict[case_name] = (im_fns, label_fn)
+
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = BatchSegmenterWidget(parent)
+        widget.setup()
+        widget.config['auditLogFilename'] = os.path.join(tempdir, 'audit.jsonl')
+        widget.image_label_dict = image_label_dict
+        widget.updateWidgets()
+
+        roundSnapshots = []
+        for roundInd in range(numRounds):
+            for case_name in image_label_dict:
+                widget.onComboboxChanged(case_name)
+            widget.saveActiveSegmentation()
+            widget.clearNodes()
+            roundSnapshots.append(widget.lifecycleLog[-1][1])
+            print('TEST: soak round %d: %s' % (roundInd, roundSnapshots[-1]))
+        widget.cleanup()
+        parent.deleteLater()
+
+        warmup = roundSnapshots[0]
+        for snapshot in roundSnapshots[1:]:
+            assert snapshot['sceneNodes'] == warmup['sceneNodes'], 'scene nodes grew: %s' % roundSnapshots
+            assert snapshot['observers'] == warmup['observers'], 'observers grew: %s' % roundSnapshots
+            assert snapshot['detachedNodeRefs'] == 0, 'removed nodes are still referenced: %s' % roundSnapshots
+        rssGrowth = roundSnapshots[-1]['rssMB'] - warmup['rssMB']
+        if rssGrowth > rssToleranceMB:
+            raise AssertionError('memory grew by %.0f MB over %d rounds of %d cases' % (rssGrowth, numRounds - 1, numCases))
+
+        self.delayDisplay('Memory soak test passed')
+
+
+    def testStartupTime(self):
+        """Module import plus widget setup must stay within ``startupTimeBudgetSec``
+
+        Everything here runs on every Slicer launch (import) or on first opening the module (setup),
+        so heavy imports and installs belong in the functions that need them.
+        """
+        self.delayDisplay('Startup time test')
+
+        # execute the module file under a different name so the loaded module isn't replaced
+        startTime = time.perf_counter()
+        spec = importlib.util.spec_from_file_location('BatchSegmenterStartupCheck', __file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        importTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = module.BatchSegmenterWidget(parent)
+        widget.setup()
+        setupTime = time.perf_counter() - startTime
+        widget.cleanup()
+        parent.deleteLater()
+
+        print('TEST: BatchSegmenter import took %.3fs, widget setup took %.3fs' % (importTime, setupTime))
+        if importTime + setupTime > self.startupTimeBudgetSec:
+            raise AssertionError('BatchSegmenter startup took %.3fs (budget is %.3fs)' % (importTime + setupTime, self.startupTimeBudgetSec))
+        self.delayDisplay('Startup time test passed')
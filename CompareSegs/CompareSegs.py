@@ -1,16 +1,36 @@
 import os
+import sys
+import csv
 import json
+import time
+import hashlib
+import tempfile
+import importlib.util
 from glob import glob
+from urllib.parse import urljoin
 from collections import OrderedDict
 from itertools import cycle
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import vtk, qt, ctk, slicer
-import SimpleITK as sitk
-import sitkUtils
 from slicer.ScriptedLoadableModule import *
+# SegCommon (the helpers shared by the three modules) sits next to this module's folder in the repo,
+# so it can be imported even when only this module's folder was added to the module paths
+segCommonDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SegCommon')
+if os.path.isdir(segCommonDir) and segCommonDir not in sys.path:
+    sys.path.append(segCommonDir)
+try:
+    from SegCommon import (findMissingFiles, fileSignatures, fileContentHash, isRemoteUrl,
+        remoteManifestUrl, RemoteFileCache, splitCaseFileRef, caseFileExists, globCaseFiles,
+        loadCaseVolume, caseNodeName, readCaseImage, sitkGeometry, readCaseGeometry, geometriesMatch,
+        findGeometryMismatches, ResampleCache, validateCaseFiles, convertTreeToCaseStores,
+        ActionProfiler, printProfileHotSpots, showCaseLoadTime, lifecycleSnapshot,
+        installMemoryStatusLabel, ThumbnailMosaic)
+except ModuleNotFoundError as e:
+    if e.name != 'SegCommon':
+        raise
+    raise ModuleNotFoundError('SegCommon not found: add the SegCommon folder of this repository to the Slicer module paths', name='SegCommon') from e
 import logging
-slicer.util.pip_install('pandas')
-import pandas as pd
 
 
 # colors for each *labeler*
@@ -20,6 +40,12 @@ COLORS = [
     (0, 0, 1)
 ]
 
+# colors for each consensus method
+CONSENSUS_COLORS = [
+    (1, 1, 1),
+    (1, 1, 0)
+]
+
 
 class CompareSegs(ScriptedLoadableModule):
 
@@ -27,7 +53,7 @@ class CompareSegs(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "Compare Segmentations"
         self.parent.categories = ["Segmentation"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ['SegCommon']
         self.parent.contributors = ["Brian Keating (Cortechs.ai)"]
         self.parent.helpText = """"""
         self.parent.helpText += self.getDefaultModuleDocumentationLink()
@@ -62,6 +88,44 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         self.selectDataButton.enabled = True
         dataFormLayout.addRow('Cases:', self.selectDataButton)
 
+        # Load/save a manifest (csv with one row per case) instead of selecting folders
+        manifestLayout = qt.QHBoxLayout()
+        self.loadManifestButton = qt.QPushButton('Load Manifest')
+        self.loadManifestButton.toolTip = 'Load cases from a csv with columns: case, image columns, seg column(s)'
+        manifestLayout.addWidget(self.loadManifestButton)
+        self.saveManifestButton = qt.QPushButton('Save Manifest')
+        self.saveManifestButton.toolTip = 'Save the loaded cases to a csv so they can be reopened without scanning folders'
+        self.saveManifestButton.enabled = False
+        manifestLayout.addWidget(self.saveManifestButton)
+        self.loadFromUrlButton = qt.QPushButton('Load from URL')
+        self.loadFromUrlButton.toolTip = 'Load cases from a dataset hosted over http(s): a base url with a manifest.csv, or the url of a manifest csv'
+        manifestLayout.addWidget(self.loadFromUrlButton)
+        self.checkFilesExistCheckBox = qt.QCheckBox('Check files exist')
+        self.checkFilesExistCheckBox.toolTip = 'Skip manifest cases whose files are missing (checked in parallel)'
+        manifestLayout.addWidget(self.checkFilesExistCheckBox)
+        dataFormLayout.addRow('Manifest:', manifestLayout)
+
+        # Pre-flight check of the case files (gzip CRC and headers)
+        integrityLayout = qt.QHBoxLayout()
+        self.validateFilesCheckBox = qt.QCheckBox('Validate files on load')
+        self.validateFilesCheckBox.toolTip = 'Check the gzip CRC and header of every case file (in parallel) when cases are loaded; later checks only read files that changed'
+        self.validateFilesCheckBox.checked = self.config.get('validateFiles', False)
+        integrityLayout.addWidget(self.validateFilesCheckBox)
+        self.validateNowButton = qt.QPushButton('Validate Now')
+        self.validateNowButton.toolTip = 'Check the files of all loaded cases and mark the cases with corrupt files'
+        integrityLayout.addWidget(self.validateNowButton)
+        dataFormLayout.addRow(qt.QLabel('Integrity:'), integrityLayout)
+
+        # Convert folders of image files to chunked case stores (which can be selected like data folders)
+        self.convertToCaseStoresButton = qt.QPushButton('Convert Folders to Case Stores')
+        self.convertToCaseStoresButton.toolTip = 'Convert a folder tree of files matching the config patterns into chunked case stores (same folder layout), which load faster'
+        dataFormLayout.addRow('Case Stores:', self.convertToCaseStoresButton)
+
+        # Grid of case thumbnails for a quick overview of the cohort
+        self.thumbnailOverviewButton = qt.QPushButton('Thumbnail Overview')
+        self.thumbnailOverviewButton.toolTip = 'Show every case as a thumbnail of its slice with the largest ROI area (with outlines). Click a thumbnail to open the case'
+        dataFormLayout.addRow('Overview:', self.thumbnailOverviewButton)
+
         # Combobox to display selected folders
         self.caseComboBox = qt.QComboBox()
         self.caseComboBox.enabled = False
@@ -90,6 +154,11 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
             selectRoiLayout.addWidget(button)
         dataFormLayout.addRow('ROI:', selectRoiLayout)
 
+        # Overlay of how many labelers marked each voxel of the selected ROI
+        self.agreementCheckBox = qt.QCheckBox('Show labeler agreement')
+        self.agreementCheckBox.toolTip = 'Overlay the number of labelers that marked each voxel of the selected ROI'
+        dataFormLayout.addRow('Agreement:', self.agreementCheckBox)
+
         # Widget for selecting view orientations
         dataFormLayout.addRow('', qt.QLabel(''))  # empty row, for spacing
         selectViewLayout = qt.QHBoxLayout()
@@ -122,41 +191,121 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         self.yellowViewCombobox.setCurrentIndex(2)
         dataFormLayout.addRow('Yellow View Image:', self.yellowViewCombobox)
 
+        #### Consensus Area ####
+
+        consensusCollapsibleButton = ctk.ctkCollapsibleButton()
+        consensusCollapsibleButton.text = 'Consensus'
+        consensusCollapsibleButton.collapsed = True
+        self.layout.addWidget(consensusCollapsibleButton)
+        consensusFormLayout = qt.QFormLayout(consensusCollapsibleButton)
+
+        consensusButtonsLayout = qt.QHBoxLayout()
+        self.caseConsensusButton = qt.QPushButton('Current Case')
+        self.caseConsensusButton.toolTip = 'Compute, show and save consensus segmentations for the current case'
+        consensusButtonsLayout.addWidget(self.caseConsensusButton)
+        self.cohortConsensusButton = qt.QPushButton('All Cases')
+        self.cohortConsensusButton.toolTip = 'Compute and save consensus segmentations for every case (unchanged cases are skipped)'
+        consensusButtonsLayout.addWidget(self.cohortConsensusButton)
+        consensusFormLayout.addRow('Compute:', consensusButtonsLayout)
+
+        #### Developer Area ####
+
+        developerCollapsibleButton = ctk.ctkCollapsibleButton()
+        developerCollapsibleButton.text = 'Developer'
+        developerCollapsibleButton.collapsed = True
+        self.layout.addWidget(developerCollapsibleButton)
+        developerFormLayout = qt.QFormLayout(developerCollapsibleButton)
+
+        self.profileActionsCheckBox = qt.QCheckBox('Profile user actions')
+        self.profileActionsCheckBox.toolTip = 'Run data selection, case changes, ROI and orientation changes and saves under cProfile and save one profile per action'
+        developerFormLayout.addRow(self.profileActionsCheckBox)
+        self.slowestActionsList = qt.QListWidget()
+        self.slowestActionsList.toolTip = 'Slowest profiled actions of this session. Click one to print its hot spots in the Python console'
+        developerFormLayout.addRow('Slowest actions:', self.slowestActionsList)
+
         ## Add vertical spacer to keep widgets near top
         self.layout.addStretch(1)
         
         ### connections ###
+        # wrap the profiled handlers before they are connected
+        self.actionProfiler = ActionProfiler(
+            self.config.get('profileFolder') or os.path.join(slicer.app.cachePath, 'CompareSegs', 'profiles'),
+            lambda: self.imagePathsDf.index[self.selected_image_ind], self.updateSlowestActions)
+        self.actionProfiler.wrap(self, {
+            'onSelectDataButtonPressed': 'select data',
+            'onLoadManifestButtonPressed': 'select data',
+            'onLoadFromUrlButtonPressed': 'select data',
+            'onCaseComboboxChanged': 'case change',
+            'onRoiChanged': 'ROI change',
+            'onViewOrientationChanged': 'orientation change',
+            'onSaveManifestButtonPressed': 'save manifest',
+            'onCaseConsensusButtonPressed': 'save consensus',
+            'onCohortConsensusButtonPressed': 'save consensus',
+        })
+        self.profileActionsCheckBox.connect('toggled(bool)', self.onProfileActionsToggled)
+        self.slowestActionsList.connect('itemClicked(QListWidgetItem*)', self.onSlowestActionClicked)
         self.selectDataButton.clicked.connect(self.onSelectDataButtonPressed)
         self.previousCaseButton.connect('clicked(bool)', self.previousCase)
         self.nextCaseButton.connect('clicked(bool)', self.nextCase)
         self.caseComboBox.connect('currentIndexChanged(const QString&)', self.onCaseComboboxChanged)
+        self.loadManifestButton.connect('clicked(bool)', self.onLoadManifestButtonPressed)
+        self.loadFromUrlButton.connect('clicked(bool)', self.onLoadFromUrlButtonPressed)
+        self.convertToCaseStoresButton.connect('clicked(bool)', self.onConvertToCaseStoresButtonPressed)
+        self.validateNowButton.connect('clicked(bool)', self.validateCases)
+        self.thumbnailOverviewButton.connect('clicked(bool)', self.onThumbnailOverviewButtonPressed)
+        self.saveManifestButton.connect('clicked(bool)', self.onSaveManifestButtonPressed)
         self.redViewCombobox.connect('currentIndexChanged(const QString&)', self.onRedViewComboboxChanged)
         self.greenViewCombobox.connect('currentIndexChanged(const QString&)', self.onGreenViewComboboxChanged)
         self.yellowViewCombobox.connect('currentIndexChanged(const QString&)', self.onYellowViewComboboxChanged)
         self.viewButtonGroup.buttonClicked.connect(self.onViewOrientationChanged)
         self.roiButtonGroup.buttonClicked.connect(self.onRoiChanged)
+        self.agreementCheckBox.connect('toggled(bool)', self.onAgreementToggled)
+        self.caseConsensusButton.connect('clicked(bool)', self.onCaseConsensusButtonPressed)
+        self.cohortConsensusButton.connect('clicked(bool)', self.onCohortConsensusButtonPressed)
+
+        # process memory and scene size readout in the status bar
+        installMemoryStatusLabel()
 
         ### Logic ###
-        self.imagePathsDf = pd.DataFrame()
+        self.imagePathsDf = CaseTable()
         self.volNodes = OrderedDict()
         self.selected_image_ind = None
         self.seg_fns_dict = {}
         self.segmentationNodes = []
+        self.labelArrays = OrderedDict()  # labeler name -> label array of the current case
+        self.labelIJKToRAS = None  # geometry of the label arrays
+        self.labelGeometry = None  # same, as a ``sitkGeometry`` dict
+        self.labelerMasks = {}  # (labeler name, label value) -> boolean mask, filled on demand
+        self.agreementNode = None
+        self.consensusOutputFolder = self.config.get('consensus', {}).get('outputFolder')
+        self.dataSource = None  # {'folders': [...]} or {'manifest': path or url}, identifies the session
+        self.sessionRestoreAttempted = False
+        self.imageConflicts = {}  # case name -> image names whose copies differ between labeler folders
+        self.lifecycleLog = []  # (before, after) lifecycleSnapshot of each clearNodes call
+        self.thumbnailMosaic = None
+        self.badCaseFiles = {}  # case name -> {file: problem} from the last validation
+        self.resampleCache = ResampleCache(os.path.join(slicer.app.cachePath, 'CompareSegs', 'resampled'))
+        self.resampleTargets = {}  # file -> grid of its case's first image, for files on a different grid
+        self.resampledCases = {}  # case name -> its files that are resampled onto the first image's grid
+        self.geometryCheckedCases = set()
 
 
     def onRedViewComboboxChanged(self, volName):
         """Change which image is displayed in the red view"""
         self.setSliceViewVolume('Red', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onGreenViewComboboxChanged(self, volName):
         """Change which image is displayed in the green view"""
         self.setSliceViewVolume('Green', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onYellowViewComboboxChanged(self, volName):
         """Change which image is displayed in the yellow view"""
         self.setSliceViewVolume('Yellow', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onRoiChanged(self, button):
@@ -168,6 +317,59 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
             displayNode = segmentationNode.GetDisplayNode()
             displayNode.SetAllSegmentsVisibility(False)  # Hide all segments
             displayNode.SetSegmentVisibility(selectedSegmentID, True)  # Show specific segment
+        if self.agreementCheckBox.checked:
+            self.updateAgreementOverlay()
+        self.saveSession()
+
+
+    def onAgreementToggled(self, checked):
+        if checked:
+            self.updateAgreementOverlay()
+        else:
+            for compositeNode in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode'):
+                compositeNode.SetForegroundVolumeID(None)
+
+
+    def computeAgreementArray(self, labelVal):
+        """Count how many labelers marked each voxel with ``labelVal`` (uint8 array)
+
+        Per-labeler masks are cached for the current case, so switching back and forth between
+        ROIs only re-sums them.
+        """
+        agreement = None
+        for labeler_name, labelArray in self.labelArrays.items():
+            key = (labeler_name, labelVal)
+            if key not in self.labelerMasks:
+                self.labelerMasks[key] = labelArray == labelVal
+            mask = self.labelerMasks[key]
+            if agreement is None:
+                agreement = np.zeros(mask.shape, np.uint8)
+            np.add(agreement, mask, out=agreement, casting='unsafe')
+        return agreement
+
+
+    def updateAgreementOverlay(self):
+        """Show the agreement count of the selected ROI as the foreground layer of every slice view"""
+        if not self.labelArrays:
+            return
+        agreement = self.computeAgreementArray(self.labelNameToLabelVal[self.roiButtonGroup.checkedButton().text])
+
+        if self.agreementNode is None:
+            self.agreementNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Labeler agreement')
+            self.agreementNode.SetIJKToRASMatrix(self.labelIJKToRAS)
+            self.agreementNode.CreateDefaultDisplayNodes()
+            displayNode = self.agreementNode.GetDisplayNode()
+            displayNode.SetAndObserveColorNodeID('vtkMRMLColorTableNodeRainbow')
+            displayNode.AutoWindowLevelOff()
+            displayNode.SetWindowLevelMinMax(1, len(self.labelArrays))
+            displayNode.SetApplyThreshold(True)
+            displayNode.SetLowerThreshold(0.5)  # voxels that no labeler marked are transparent
+            displayNode.SetInterpolate(0)
+        slicer.util.updateVolumeFromArray(self.agreementNode, agreement)
+
+        for compositeNode in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode'):
+            compositeNode.SetForegroundVolumeID(self.agreementNode.GetID())
+            compositeNode.SetForegroundOpacity(0.5)
         
 
     def onViewOrientationChanged(self, button):
@@ -189,6 +391,8 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         for volNode, view_name in zip(self.volNodes.values(), ['Red', 'Yellow', 'Green']):
             view = slicer.app.layoutManager().sliceWidget(view_name)
             view.mrmlSliceNode().RotateToVolumePlane(volNode)
+
+        self.saveSession()
         
 
     def onSelectDataButtonPressed(self):
@@ -207,6 +411,9 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         if file_dialog.exec_():
             labeler_folders = file_dialog.selectedFiles()
             self.imagePathsDf = self.loadImagePathsDataFrame(labeler_folders)
+            self.dataSource = {'folders': sorted(labeler_folders)}
+            self.preflightCases()
+            self.checkCaseGeometries()
             self.addCaseNamesToWidgets()
 
 
@@ -222,27 +429,32 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
 
         # Load image and seg paths for each case
         all_paths = []
+        image_replicas = {}  # (case name, image name) -> [(labeler folder, path)] for each copy of the image
         for case_name in sorted(case_names):
             case_paths = OrderedDict()
             case_paths['case'] = case_name
 
-            # images (from any labeler_folder)
+            # images (from any labeler_folder, every copy is kept for deduplication)
             for im_name, im_pattern in self.config['imageFilenamePatterns'].items():
+                replicas = []
                 for labeler_folder in labeler_folders:
                     case_im_pattern = os.path.join(labeler_folder, case_name, im_pattern)
-                    matching_paths = glob(case_im_pattern)
+                    matching_paths = globCaseFiles(os.path.join(labeler_folder, case_name), im_pattern)
                     if len(matching_paths) == 1:
-                        case_paths[im_name] = matching_paths[0]
-                        break
-                    elif len(matching_paths) == 0:
-                        print('No images like ', case_im_pattern)
-                    else:
+                        replicas.append((labeler_folder, matching_paths[0]))
+                    elif len(matching_paths) > 1:
                         print('Multiple images match ', case_im_pattern)
+                if replicas:
+                    case_paths[im_name] = replicas[0][1]
+                    if all(splitCaseFileRef(path)[1] is None for folder, path in replicas):  # case store members aren't hashed
+                        image_replicas[(case_name, im_name)] = replicas
+                else:
+                    print('No images like ', os.path.join('*', case_name, im_pattern))
             
             # segs (from every labeler_folder)
             for labeler_folder in labeler_folders:
                 seg_pattern = os.path.join(labeler_folder, case_name, self.config['segFilenamePattern'])
-                matching_paths = glob(seg_pattern)
+                matching_paths = globCaseFiles(os.path.join(labeler_folder, case_name), self.config['segFilenamePattern'])
                 if len(matching_paths) == 1:
                     labeler_name = os.path.basename(labeler_folder)
                     col_name = labeler_name + '.seg'
@@ -253,46 +465,340 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
                     print('Multiple images match ', seg_pattern)
 
             all_paths.append(case_paths)
+
+        # read identical copies from the fastest folder and flag copies that differ
+        self.imageConflicts = {}
+        if self.config.get('deduplicateImages', True) and any(len(replicas) > 1 for replicas in image_replicas.values()):
+            chosen_paths, self.imageConflicts = self.deduplicateImages(image_replicas, labeler_folders)
+            for case_paths in all_paths:
+                for im_name in self.config['imageFilenamePatterns']:
+                    if (case_paths['case'], im_name) in chosen_paths:
+                        case_paths[im_name] = chosen_paths[(case_paths['case'], im_name)]
             
-        # put everything into a DataFrame
-        df = pd.DataFrame(all_paths)
-        df = df.set_index('case') 
-
-        # drop any rows/cases that are missing MRIs
-        im_names = self.config['imageFilenamePatterns'].keys()
-        df[~df[im_names].isna().any(1)]
-        seg_cols = [col for col in df.columns if col.endswith('seg')]
-        print('Loaded '+str(len(df))+' cases from '+str(len(seg_cols))+' labelers')
+        # put everything into a case table and drop any cases that are missing MRIs
+        df = CaseTable(all_paths, imageColumns=self.config['imageFilenamePatterns'].keys())
+        df = df.completeCases()
+        print('Loaded '+str(len(df))+' cases from '+str(len(df.segColumns))+' labelers')
         
         return df
 
 
-    def addCaseNamesToWidgets(self):
-        """Load selected valid case names into the widget"""
+    def deduplicateImages(self, image_replicas, labeler_folders):
+        """Choose which copy of each image to read, by content hash
+
+        Identical copies are read from the labeler folder with the fastest reads. Copies that differ
+        are flagged (the first one is used, as before), and the storage used by redundant copies
+        is reported.
+
+        Returns:
+            ({(case name, image name): chosen path}, {case name: [image names with differing copies]})
+        """
+        readSeconds = {folder: probeReadSeconds(folder, self.config['imageFilenamePatterns'].values()) for folder in labeler_folders}
+        print('INFO: reading duplicate images from folders in order', sorted(labeler_folders, key=readSeconds.get))
+
+        allReplicas = [path for replicas in image_replicas.values() if len(replicas) > 1 for folder, path in replicas]
+        hash_fn = os.path.join(slicer.app.cachePath, 'CompareSegs', 'content-hashes.json')
+        hashes = contentHashes(allReplicas, hash_fn)
+
+        chosen_paths, conflicts = {}, {}
+        wastedBytes, numRedundant = 0, 0
+        for (case_name, im_name), replicas in image_replicas.items():
+            if len(replicas) < 2:
+                continue
+            if len(set(hashes[path] for folder, path in replicas)) > 1:
+                print('WARNING: copies of '+im_name+' for '+case_name+' differ:', [path for folder, path in replicas])
+                conflicts.setdefault(case_name, []).append(im_name)
+                continue
+            chosen_paths[(case_name, im_name)] = min(replicas, key=lambda replica: readSeconds[replica[0]])[1]
+            numRedundant += len(replicas) - 1
+            wastedBytes += (len(replicas) - 1) * os.path.getsize(replicas[0][1])
+        print('INFO: %d redundant image copies use %.2f GB; %d cases have differing copies' % (numRedundant, wastedBytes / 2**30, len(conflicts)))
+        return chosen_paths, conflicts
+
+
+    def onConvertToCaseStoresButtonPressed(self):
+        """Convert a folder tree of image files into case stores with the same layout, in parallel"""
+        srcRoot = qt.QFileDialog.getExistingDirectory(None, 'Folder Tree to Convert')
+        if not srcRoot:
+            return
+        dstRoot = qt.QFileDialog.getExistingDirectory(None, 'Output Folder for Case Stores')
+        if not dstRoot:
+            return
+        patterns = list(self.config['imageFilenamePatterns'].values()) + [self.config['segFilenamePattern']]
+        progressDialog = slicer.util.createProgressDialog(labelText='Converting to case stores')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        results = convertTreeToCaseStores(srcRoot, dstRoot, patterns, onProgress)
+        progressDialog.close()
+        numFailed = sum(isinstance(result, Exception) for result in results.values())
+        print('INFO: converted %d folders into case stores under %s (%d failed)' % (len(results) - numFailed, dstRoot, numFailed))
+
+
+    def onThumbnailOverviewButtonPressed(self):
+        """Show the thumbnail mosaic of all cases: every labeler's outlines, in the labeler colors"""
+        if len(self.imagePathsDf) == 0:
+            return
+        if self.thumbnailMosaic is None:
+            self.thumbnailMosaic = ThumbnailMosaic('CompareSegs Cases', os.path.join(slicer.app.cachePath, 'CompareSegs', 'thumbnails'), self.openCase)
+        cases = []
+        for case_name in self.imagePathsDf.index:
+            im_fns_dict, seg_fns_dict = self.imagePathsDf.caseFiles(case_name)
+            segs = []
+            for seg_fn, labeler_color in zip(seg_fns_dict.values(), cycle(COLORS)):
+                color = tuple(int(255 * val) for val in labeler_color)
+                segs.append((seg_fn, {labelVal: color for labelVal in self.labelNameToLabelVal.values()}))
+            cases.append((case_name, im_fns_dict, segs))
+        self.thumbnailMosaic.show(cases, list(self.config['imageFilenamePatterns']), self.redViewCombobox.currentText)
+
+
+    def openCase(self, case_name):
+        self.caseComboBox.setCurrentIndex(self.imagePathsDf.getLoc(case_name))
+
+
+    def onLoadManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getOpenFileName(None, 'Load Manifest', '', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.loadManifest(manifest_fn)
+
+
+    def onLoadFromUrlButtonPressed(self):
+        url = qt.QInputDialog.getText(None, 'Load from URL', 'Dataset or manifest URL (http/https):')
+        if url:
+            self.loadManifest(remoteManifestUrl(url.strip()))
+
+
+    def loadManifest(self, manifest_fn):
+        """Load the case table from a manifest csv (the ``image_paths.csv`` layout): one read, no globbing
+
+        ``manifest_fn`` can be an http(s) url (see ``CaseTable.readCsv``).
+        """
+        print('INFO: loading manifest', manifest_fn)
+        df = CaseTable.readCsv(manifest_fn, imageColumns=self.config['imageFilenamePatterns'].keys())
+        df = df.completeCases()
+
+        # optionally drop cases whose files have disappeared
+        if self.checkFilesExistCheckBox.checked:
+            allPaths = [path for pos in range(len(df)) for path in df.imagePaths[pos] + df.segPaths[pos] if path]
+            missing = findMissingFiles(allPaths)
+            if missing:
+                print('WARNING: Skipping cases with missing files:', sorted(missing))
+                keep = [name for pos, name in enumerate(df.index) if not missing.intersection(df.imagePaths[pos] + df.segPaths[pos])]
+                df = df.subset(keep)
+
+        print('Loaded '+str(len(df))+' cases from '+str(len(df.segColumns))+' labelers')
+        self.imagePathsDf = df
+        self.imageConflicts = {}
+        self.dataSource = {'manifest': manifest_fn if isRemoteUrl(manifest_fn) else os.path.abspath(manifest_fn)}
+        self.preflightCases()
+        self.checkCaseGeometries()
+        self.addCaseNamesToWidgets()
+
+
+    def onSaveManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getSaveFileName(None, 'Save Manifest', 'image_paths.csv', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.imagePathsDf.writeCsv(manifest_fn)
+            print('INFO: saved manifest of '+str(len(self.imagePathsDf))+' cases to', manifest_fn)
+
+
+    def enter(self):
+        """Resume the last session the first time the module is opened"""
+        if not self.sessionRestoreAttempted:
+            self.sessionRestoreAttempted = True
+            if len(self.imagePathsDf) == 0:
+                self.restoreLastSession()
+
+
+    def sessionFilename(self):
+        """Session file for the current dataset (one per set of labeler folders or manifest)"""
+        key = hashlib.sha1(json.dumps(self.dataSource, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(slicer.app.cachePath, 'CompareSegs', 'sessions', key+'.json')
+
+
+    def saveSession(self):
+        """Save the case table, active case, ROI and view settings so the session can be resumed"""
+        if not self.dataSource or len(self.imagePathsDf) == 0:
+            return
+        session = {
+            'dataSource': self.dataSource,
+            'cases': self.imagePathsDf.toDict(),
+            'caseIndex': self.selected_image_ind,
+            'ui': {
+                'views': [self.redViewCombobox.currentText, self.greenViewCombobox.currentText, self.yellowViewCombobox.currentText],
+                'orientation': self.viewButtonGroup.checkedButton().text,
+                'roi': self.roiButtonGroup.checkedButton().text,
+            },
+        }
+        session_fn = self.sessionFilename()
+        os.makedirs(os.path.dirname(session_fn), exist_ok=True)
+        with open(session_fn+'.tmp', 'w') as f:
+            json.dump(session, f)
+        os.replace(session_fn+'.tmp', session_fn)
+        qt.QSettings().setValue('CompareSegs/lastSession', session_fn)
+
+
+    def restoreLastSession(self):
+        """Reload the last saved session without rescanning the labeler folders
+
+        Only the files of the active case are checked (when it is loaded).
+        """
+        session_fn = qt.QSettings().value('CompareSegs/lastSession')
+        if not session_fn or not os.path.exists(session_fn):
+            return False
+        print('INFO: resuming session', session_fn)
+        try:
+            with open(session_fn) as f:
+                session = json.load(f)
+            self.dataSource = session['dataSource']
+            imagePathsDf = CaseTable.fromDict(session['cases'])
+            caseIndex = min(max(session['caseIndex'] or 0, 0), len(imagePathsDf) - 1)
+        except (ValueError, KeyError, TypeError) as e:
+            print('WARNING: could not resume session '+session_fn+':', e)
+            return False
+
+        # restore view settings without triggering their callbacks (no volumes are loaded yet)
+        ui = session.get('ui', {})
+        for combobox, volName in zip([self.redViewCombobox, self.greenViewCombobox, self.yellowViewCombobox], ui.get('views', [])):
+            combobox.blockSignals(True)
+            combobox.setCurrentText(volName)
+            combobox.blockSignals(False)
+        for buttonGroup, text in [(self.viewButtonGroup, ui.get('orientation')), (self.roiButtonGroup, ui.get('roi'))]:
+            for button in buttonGroup.buttons():
+                if button.text == text:
+                    button.setChecked(True)
+
+        self.imagePathsDf = imagePathsDf
+        self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+        self.preflightCases()
+        self.addCaseNamesToWidgets(caseIndex)
+        return True
+
+
+    def addCaseNamesToWidgets(self, caseIndex=0):
+        """Load selected valid case names into the widget and load the ``caseIndex``-th case"""
 
         # select data button
         if len(self.imagePathsDf) > 1:
             self.selectDataButton.setText(str(len(self.imagePathsDf))+' cases')
-        elif len(self.image_label_dict) == 1:
+        elif len(self.imagePathsDf) == 1:
             self.selectDataButton.setText(self.imagePathsDf.index[0])
         
         # case combobox
         self.caseComboBox.clear()
         if len(self.imagePathsDf) > 0:
-            case_names = list(self.imagePathsDf.index)
+            case_names = self.imagePathsDf.index
+            self.caseComboBox.blockSignals(True)
             self.caseComboBox.addItems(case_names)  # load names into combobox
+            self.updateCaseTooltips()
+            self.caseComboBox.setCurrentIndex(caseIndex)
+            self.caseComboBox.blockSignals(False)
             self.caseComboBox.enabled = True
+            self.saveManifestButton.enabled = True
             self.nextCaseButton.enabled = True
             self.previousCaseButton.enabled = True
-            self.selected_image_ind = 0
+            self.selected_image_ind = caseIndex
+            self.onCaseComboboxChanged(case_names[caseIndex])
         else:
             self.selectDataButton.setText('Select Data Folders')
             self.caseComboBox.enabled = False
+            self.saveManifestButton.enabled = False
             self.nextCaseButton.enabled = False
             self.previousCaseButton.enabled = False
             self.selected_image_ind = None
 
 
+    def updateCaseTooltips(self):
+        """Show each case's corrupt files, differing image copies and resampled files as the tooltip of its combobox item"""
+        for ind in range(self.caseComboBox.count):
+            case_name = self.caseComboBox.itemText(ind)
+            lines = []
+            if case_name in self.badCaseFiles:
+                lines.append('Corrupt files: '+'; '.join('%s (%s)' % (caseNodeName(fn), error) for fn, error in self.badCaseFiles[case_name].items()))
+            self.caseComboBox.setItemIcon(ind, slicer.app.style().standardIcon(qt.QStyle.SP_MessageBoxWarning) if case_name in self.badCaseFiles else qt.QIcon())
+            if case_name in self.imageConflicts:
+                lines.append('Differing copies across labeler folders: '+', '.join(self.imageConflicts[case_name]))
+            if self.resampledCases.get(case_name):
+                lines.append('Resampled onto the grid of the first image: '+', '.join(caseNodeName(fn) for fn in self.resampledCases[case_name]))
+            if lines:
+                self.caseComboBox.setItemData(ind, '\n'.join(lines), qt.Qt.ToolTipRole)
+
+
+    def preflightCases(self):
+        """Validate the files of the loaded cases if ``Validate files on load`` is checked"""
+        self.badCaseFiles = {}
+        if self.validateFilesCheckBox.checked:
+            self.validateCases()
+
+
+    def validateCases(self):
+        """Check the gzip CRC and header of every local case file in parallel, and mark the cases with corrupt files
+
+        Results and checksums are kept in an integrity index in the cache folder, so later checks
+        (in this or another session) only read the files whose size or mtime changed.
+        """
+        case_files = OrderedDict((name, [path for paths in self.imagePathsDf.caseFiles(name) for path in paths.values()]) for name in self.imagePathsDf.index)
+        progressDialog = slicer.util.createProgressDialog(labelText='Validating case files')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        errors = validateCaseFiles([fn for fns in case_files.values() for fn in fns], os.path.join(slicer.app.cachePath, 'CompareSegs', 'integrity.json'), onProgress)
+        progressDialog.close()
+        self.badCaseFiles = OrderedDict()
+        for case_name, fns in case_files.items():
+            bad = OrderedDict((fn, errors[fn]) for fn in fns if fn in errors)
+            if bad:
+                self.badCaseFiles[case_name] = bad
+                print('WARNING: '+case_name+' has corrupt files:', '; '.join(fn+': '+error for fn, error in bad.items()))
+        print('INFO: validated the files of %d cases, %d have corrupt or missing files' % (len(case_files), len(self.badCaseFiles)))
+        self.updateCaseTooltips()
+
+
+    def checkCaseGeometries(self, case_names=None):
+        """Compare the grid of each case's images and segs with its first image, and resample mismatched files once
+
+        The resampled arrays are kept in ``self.resampleCache``, so loading the case again (in this
+        or a later session) or computing its consensus doesn't resample them. Without ``case_names``
+        all cases are checked, except those with remote files, which are checked when they are loaded.
+        """
+        if case_names is None:
+            self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+            case_names = [name for name in self.imagePathsDf.index if not any(isRemoteUrl(path) for paths in self.imagePathsDf.caseFiles(name) for path in paths.values())]
+        cases, seg_fns = [], set()
+        for name in case_names:
+            im_fns_dict, seg_fns_dict = self.imagePathsDf.caseFiles(name)
+            im_fns = list(im_fns_dict.values())
+            cases.append((name, im_fns[0], im_fns[1:] + list(seg_fns_dict.values())))
+            seg_fns.update(seg_fns_dict.values())
+        mismatches = findGeometryMismatches(cases, os.path.join(slicer.app.cachePath, 'CompareSegs', 'geometry-cache.json'))
+        self.geometryCheckedCases.update(case_names)
+        if not mismatches:
+            return
+        print('WARNING: %d cases have files on a different grid than their first image, resampling them: %s' % (len(mismatches), ', '.join(mismatches)))
+        jobs = [(fn, geometry, fn in seg_fns) for refs in mismatches.values() for fn, geometry in refs.items()]
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Resampling onto the reference grid')
+
+        def onProgress(num, total):
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        failures = self.resampleCache.prepare(jobs, onProgress)
+        progressDialog.close()
+        for case_name, refs in mismatches.items():
+            for fn in sorted(failures.keys() & refs.keys()):
+                print('ERROR: could not resample '+fn+':', failures[fn])
+                del refs[fn]
+            self.resampleTargets.update(refs)
+            self.resampledCases[case_name] = sorted(refs)
+        self.updateCaseTooltips()
+
+
     def nextCase(self):
         self.selected_image_ind += 1
         if self.selected_image_ind > len(self.imagePathsDf) - 1:
@@ -313,23 +819,39 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         This is the main function for loading images from disk, configuring the views, and creating
         segmentations with the correct display names/colors.
         """
+        startTime = time.perf_counter()
         
         if len(self.imagePathsDf) == 0:
             return
 
         try:
-            self.selected_image_ind = self.imagePathsDf.index.get_loc(case_name)
+            self.selected_image_ind = self.imagePathsDf.getLoc(case_name)
         except KeyError:
             raise ValueError('Tried to load non-existent case '+case_name)
 
         # select the filenames for this case
         try:
-            row_dict = self.imagePathsDf.to_dict('index')[case_name]
-            im_fns_dict = {name: path for name, path in row_dict.items() if name in self.config['imageFilenamePatterns']}
-            seg_fns_dict = {name.replace('.seg', ''): path for name, path in row_dict.items() if name.endswith('seg')}
+            im_fns_dict, seg_fns_dict = self.imagePathsDf.caseFiles(case_name)
         except KeyError:
             print('Could not find '+case_name+' among selected images')
             return
+        missing_fns = [fn for fn in im_fns_dict.values() if not caseFileExists(fn)]
+        if missing_fns:
+            print('ERROR: Cannot load '+case_name+' because some of its images are missing:', missing_fns)
+            return
+        badFiles = self.badCaseFiles.get(case_name, {})
+        if any(fn in badFiles for fn in im_fns_dict.values()):
+            print('ERROR: Cannot load '+case_name+' because some of its images are corrupt:', dict(badFiles))
+            return
+        for labeler_name, seg_fn in list(seg_fns_dict.items()):
+            if not caseFileExists(seg_fn):
+                print('WARNING: Skipping '+labeler_name+' segmentation because it is missing:', seg_fn)
+                del seg_fns_dict[labeler_name]
+            elif seg_fn in badFiles:
+                print('WARNING: Skipping '+labeler_name+' segmentation because it is corrupt:', seg_fn, badFiles[seg_fn])
+                del seg_fns_dict[labeler_name]
+        if case_name not in self.geometryCheckedCases:
+            self.checkCaseGeometries([case_name])
 
         # remove existing nodes (if any)
         self.clearNodes()
@@ -340,57 +862,87 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
         # create segmentation
         self.createSegmentationsFromFilenames(seg_fns_dict)
 
-        # set the correct orientation
-        sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
-        selectedOrientation = self.viewButtonGroup.checkedButton().text
-        for sliceNode in sliceNodes:
-            if selectedOrientation == 'axial':
-                sliceNode.SetOrientationToAxial()
-            elif selectedOrientation == 'sagittal':
-                sliceNode.SetOrientationToSagittal()
-            elif selectedOrientation == 'coronal':
-                sliceNode.SetOrientationToCoronal()
+        loadedTime = time.perf_counter()
 
-        # configure views
+        # configure all views as one batch with rendering paused, then render once
         volNames = [
             self.redViewCombobox.currentText,
             self.greenViewCombobox.currentText,
             self.yellowViewCombobox.currentText,
         ]
-        for volName, color in zip(volNames, ['Red', 'Green', 'Yellow']):
-            volNode = self.volNodes[volName]
-            self.setSliceViewVolume(color, volName, volNode)
+        with slicer.util.RenderBlocker():
+            # set the correct orientation
+            sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
+            selectedOrientation = self.viewButtonGroup.checkedButton().text
+            for sliceNode in sliceNodes:
+                if selectedOrientation == 'axial':
+                    sliceNode.SetOrientationToAxial()
+                elif selectedOrientation == 'sagittal':
+                    sliceNode.SetOrientationToSagittal()
+                elif selectedOrientation == 'coronal':
+                    sliceNode.SetOrientationToCoronal()
+
+            for volName, color in zip(volNames, ['Red', 'Green', 'Yellow']):
+                volNode = self.volNodes[volName]
+                self.setSliceViewVolume(color, volName, volNode)
+        slicer.util.forceRenderAllViews()
+        showCaseLoadTime(case_name, startTime, loadedTime)
+
+        self.prefetchUpcomingCases()
+        self.saveSession()
+
+
+    def prefetchUpcomingCases(self):
+        """Download the remote files of the next few cases in the background"""
+        caseNames = self.imagePathsDf.index[self.selected_image_ind+1:self.selected_image_ind+1+self.config.get('prefetchCases', 2)]
+        urls = [path for name in caseNames for paths in self.imagePathsDf.caseFiles(name) for path in paths.values() if isRemoteUrl(path)]
+        if urls:
+            RemoteFileCache.shared().prefetch(urls)
         
 
     def setSliceViewVolume(self, sliceViewColor, volName, volNode):
         """Show the given `volNode` in the `sliceViewColor` slice view"""
         view = slicer.app.layoutManager().sliceWidget(sliceViewColor)
-        view.sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(volNode.GetID())
-        view.sliceLogic().GetSliceCompositeNode().SetLinkedControl(True)
+        compositeNode = view.sliceLogic().GetSliceCompositeNode()
+        wasModifying = compositeNode.StartModify()  # one modified event (and linked-view update) per view
+        compositeNode.SetBackgroundVolumeID(volNode.GetID())
+        compositeNode.SetLinkedControl(True)
+        compositeNode.EndModify(wasModifying)
         view.mrmlSliceNode().RotateToVolumePlane(volNode)
         view.sliceController().setSliceVisible(True)  # show in 3d view
         
 
+    def loadCaseVolume(self, filename, labelmap=False):
+        """Load a case file, from ``self.resampleCache`` if it's on a different grid than the case's first image"""
+        geometry = self.resampleTargets.get(filename)
+        if geometry is None:
+            return loadCaseVolume(filename, labelmap)
+        array = self.resampleCache.load(filename, geometry, labelmap)
+        nodeClassName = 'vtkMRMLLabelMapVolumeNode' if labelmap else 'vtkMRMLScalarVolumeNode'
+        return slicer.util.addVolumeFromArray(array, np.array(geometry['ijkToRas']), caseNodeName(filename), nodeClassName)
+
+
     def loadVolumesFromFiles(self, filename_dict):
         """Read and load images from dict of filenames. Keep references in self.volNodes"""
         self.volNodes = OrderedDict()
         for display_name, filename in filename_dict.items():
-            volNode = slicer.util.loadVolume(filename)
+            volNode = self.loadCaseVolume(filename)
             if volNode:
                 volNode.GetScalarVolumeDisplayNode().SetInterpolate(0)
                 self.volNodes[display_name] = volNode
             else:
                 print('WARNING: Failed to load volume ', filename)
         if len(self.volNodes) == 0:
-            print('Failed to load any volumes ({filenames})!')
+            print('Failed to load any volumes ('+', '.join(filename_dict.values())+')!')
             return
 
 
     def createSegmentationsFromFilenames(self, seg_fns_dict):
         print('INFO: CompareSegs.createSegmentationFromFile invoked', seg_fns_dict)
 
-        referenceVolnode = list(self.volNodes.values())[0]
         self.segmentationNodes = []
+        self.labelArrays = OrderedDict()
+        self.labelerMasks = {}
     
         # create contour segmentations for each seg file
         for (labeler_name, seg_fn), labeler_color in zip(seg_fns_dict.items(), cycle(COLORS)):
@@ -398,7 +950,7 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
 
             # read labelmap from file
             try:
-                labelmapNode = slicer.util.loadLabelVolume(seg_fn)
+                labelmapNode = self.loadCaseVolume(seg_fn, labelmap=True)
                 if not labelmapNode:
                     print('Failed to load label volume ', seg_fn)
                     continue
@@ -407,33 +959,638 @@ class CompareSegsWidget(ScriptedLoadableModuleWidget):
                 continue
             
             # create segmentation for this labeler
-            segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', labeler_name)
-            segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolnode)
-            self.segmentationNodes.append(segmentationNode)
-            slicer.vtkSlicerSegmentationsModuleLogic.ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+            self.createSegmentationFromLabelmapNode(labeler_name, labelmapNode, labeler_color)
+
+            # keep the label array (on the first labeler's grid) for the agreement overlay
+            labelArray = slicer.util.arrayFromVolume(labelmapNode)
+            labelGeometry = volumeNodeGeometry(labelmapNode)
+            if not self.labelArrays:
+                self.labelIJKToRAS = vtk.vtkMatrix4x4()
+                labelmapNode.GetIJKToRASMatrix(self.labelIJKToRAS)
+                self.labelGeometry = labelGeometry
+            if geometriesMatch(labelGeometry, self.labelGeometry):
+                self.labelArrays[labeler_name] = labelArray.astype(np.uint8)
+            else:
+                print('WARNING: '+labeler_name+' segmentation is on a different grid, leaving it out of the agreement overlay')
             slicer.mrmlScene.RemoveNode(labelmapNode)
 
-            # display as outlines
-            displayNode = segmentationNode.GetDisplayNode()
-            displayNode.SetAllSegmentsVisibility2DOutline(True)
-            displayNode.SetOpacity2DFill(0.2)
+        # hide all ROIs except the selected one
+        self.onRoiChanged(self.roiButtonGroup.checkedButton())
 
-            # set name/color
-            segmentation = segmentationNode.GetSegmentation()
-            for segmentInd in range(segmentation.GetNumberOfSegments()):
-                segment = segmentation.GetNthSegment(segmentInd)
-                labelVal = int(segment.GetName())
-                labelName = self.config['labels'][labelVal]
-                segment.SetName(labelName)
-                segment.SetColor(labeler_color)
 
-        # hide all ROIs except the selected one
+    def createSegmentationFromLabelmapNode(self, name, labelmapNode, color):
+        """Add a segmentation (displayed as outlines, one color for all ROIs) made from a labelmap"""
+        referenceVolnode = list(self.volNodes.values())[0]
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', name)
+        segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolnode)
+        self.segmentationNodes.append(segmentationNode)
+        slicer.vtkSlicerSegmentationsModuleLogic.ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+
+        # display as outlines
+        displayNode = segmentationNode.GetDisplayNode()
+        displayNode.SetAllSegmentsVisibility2DOutline(True)
+        displayNode.SetOpacity2DFill(0.2)
+
+        # set name/color
+        segmentation = segmentationNode.GetSegmentation()
+        for segmentInd in range(segmentation.GetNumberOfSegments()):
+            segment = segmentation.GetNthSegment(segmentInd)
+            labelVal = int(segment.GetName())
+            labelName = self.config['labels'][labelVal]
+            segment.SetName(labelName)
+            segment.SetColor(color)
+        return segmentationNode
+
+
+    def consensusSettings(self):
+        """Return ``(methods, tieBreakOrder, outputFilenamePattern)`` from the config"""
+        consensusConfig = self.config.get('consensus', {})
+        methods = consensusConfig.get('methods', ['majority', 'staple'])
+        tieBreakOrder = [int(val) for val in consensusConfig.get('tieBreakOrder', [0])]
+        tieBreakOrder += [val for val in [0] + sorted(self.config['labels']) if val not in tieBreakOrder]
+        outputFilenamePattern = consensusConfig.get('outputFilenamePattern', '{case}_{method}-consensus.nii.gz')
+        return methods, tieBreakOrder, outputFilenamePattern
+
+
+    def getConsensusOutputFolder(self):
+        if not self.consensusOutputFolder:
+            self.consensusOutputFolder = qt.QFileDialog.getExistingDirectory(None, 'Select Consensus Output Folder')
+        return self.consensusOutputFolder
+
+
+    def onCaseConsensusButtonPressed(self):
+        """Compute consensus segmentations for the current case from its already-loaded label arrays"""
+        if not self.labelArrays or self.selected_image_ind is None:
+            return
+        referenceVolnode = list(self.volNodes.values())[0]
+        labelArrays = list(self.labelArrays.values())
+        if not geometriesMatch(self.labelGeometry, volumeNodeGeometry(referenceVolnode)):
+            print('ERROR: segmentations are not on the reference image grid, use "All Cases" to resample them')
+            return
+        outputFolder = self.getConsensusOutputFolder()
+        if not outputFolder:
+            return
+        case_name = self.imagePathsDf.index[self.selected_image_ind]
+        methods, tieBreakOrder, outputFilenamePattern = self.consensusSettings()
+        for method, color in zip(methods, cycle(CONSENSUS_COLORS)):
+            consensus = consensusLabelArray(labelArrays, method, tieBreakOrder)
+            labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', method+' consensus')
+            labelmapNode.CopyOrientation(referenceVolnode)
+            slicer.util.updateVolumeFromArray(labelmapNode, consensus)
+            output_fn = os.path.join(outputFolder, outputFilenamePattern.format(case=case_name, method=method))
+            slicer.util.saveNode(labelmapNode, output_fn)
+            print('INFO: saved '+method+' consensus to', output_fn)
+            self.createSegmentationFromLabelmapNode(method+' consensus', labelmapNode, color)
+            slicer.mrmlScene.RemoveNode(labelmapNode)
         self.onRoiChanged(self.roiButtonGroup.checkedButton())
 
 
+    def onCohortConsensusButtonPressed(self):
+        """Compute consensus segmentations for every case on a thread pool, skipping unchanged cases
+
+        A stamp file in the output folder records the size/mtime of each case's inputs (and the
+        consensus settings) from the last run.
+        """
+        if len(self.imagePathsDf) == 0:
+            return
+        outputFolder = self.getConsensusOutputFolder()
+        if not outputFolder:
+            return
+        methods, tieBreakOrder, outputFilenamePattern = self.consensusSettings()
+        stamp_fn = os.path.join(outputFolder, 'consensus-stamp.json')
+        stamps = {}
+        if os.path.exists(stamp_fn):
+            try:
+                with open(stamp_fn) as f:
+                    stamps = json.load(f)
+            except ValueError:
+                print('WARNING: ignoring unreadable consensus stamp file, recomputing every case:', stamp_fn)
+
+        # find the cases whose inputs/settings changed since the last run
+        jobs = OrderedDict()
+        for case_name in self.imagePathsDf.index:
+            im_fns_dict, seg_fns_dict = self.imagePathsDf.caseFiles(case_name)
+            reference_fn = list(im_fns_dict.values())[0]
+            seg_fns = list(seg_fns_dict.values())
+            output_fns = [os.path.join(outputFolder, outputFilenamePattern.format(case=case_name, method=method)) for method in methods]
+            stamp = {'inputs': fileSignatures([reference_fn] + seg_fns), 'methods': methods, 'tieBreakOrder': tieBreakOrder}
+            if stamps.get(case_name) == stamp and all(os.path.exists(fn) for fn in output_fns):
+                continue
+            jobs[case_name] = (reference_fn, seg_fns, output_fns, stamp)
+        print('INFO: computing consensus for '+str(len(jobs))+' of '+str(len(self.imagePathsDf))+' cases')
+
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Computing consensus segmentations')
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {
+                executor.submit(computeConsensusForCase, reference_fn, seg_fns, methods, tieBreakOrder, output_fns, self.resampleCache): case_name
+                for case_name, (reference_fn, seg_fns, output_fns, stamp) in jobs.items()
+            }
+            for num, future in enumerate(as_completed(futures)):
+                case_name = futures[future]
+                try:
+                    future.result()
+                    stamps[case_name] = jobs[case_name][3]
+                except Exception as e:
+                    print('ERROR: consensus failed for '+case_name+':', e)
+                progressDialog.setValue(num + 1)
+                slicer.app.processEvents()
+        progressDialog.close()
+
+        with open(stamp_fn+'.tmp', 'w') as f:
+            json.dump(stamps, f, indent=1)
+        os.replace(stamp_fn+'.tmp', stamp_fn)
+
+
     def clearNodes(self):
+        before = lifecycleSnapshot(self)
         slicer.mrmlScene.Clear(0)
+        self.volNodes = OrderedDict()
+        self.segmentationNodes = []
+        self.agreementNode = None
+        self.labelArrays = OrderedDict()
+        self.labelerMasks = {}
+        self.recordLifecycle(before, lifecycleSnapshot(self))
+
+
+    def recordLifecycle(self, before, after):
+        """Log the node/observer/reference counts around ``clearNodes`` and warn when they grow"""
+        self.lifecycleLog.append((before, after))
+        print('INFO: clearNodes: %d -> %d scene nodes, %d -> %d observers, %d -> %d node references, %.0f -> %.0f MB' % (
+            before['sceneNodes'], after['sceneNodes'], before['observers'], after['observers'],
+            before['nodeRefs'], after['nodeRefs'], before['rssMB'], after['rssMB']))
+        if after['detachedNodeRefs']:
+            print('WARNING: %d removed nodes are still referenced by the widget' % after['detachedNodeRefs'])
+        firstAfter = self.lifecycleLog[0][1]
+        if after['sceneNodes'] > firstAfter['sceneNodes']:
+            print('WARNING: %d more scene nodes remain after clearing than after the first clear' % (after['sceneNodes'] - firstAfter['sceneNodes']))
+
+
+    def onProfileActionsToggled(self, checked):
+        self.actionProfiler.enabled = checked
+        if checked:
+            print('INFO: profiling user actions into', self.actionProfiler.outputDir)
+
+
+    def updateSlowestActions(self):
+        """List the slowest profiled actions of the session, with their profile files"""
+        self.slowestActionsList.clear()
+        for seconds, action, caseName, profile_fn in self.actionProfiler.slowestActions():
+            item = qt.QListWidgetItem('%.2f s  %s  (%s)' % (seconds, action, caseName))
+            item.setData(qt.Qt.UserRole, profile_fn)
+            item.setToolTip(profile_fn)
+            self.slowestActionsList.addItem(item)
+
+
+    def onSlowestActionClicked(self, item):
+        printProfileHotSpots(item.data(qt.Qt.UserRole))
 
 
     def cleanup(self):
+        if self.thumbnailMosaic:
+            self.thumbnailMosaic.dialog.close()
         self.clearNodes()
+
+
+def volumeNodeGeometry(volumeNode):
+    """Grid of a volume node, in the ``sitkGeometry`` format"""
+    ijkToRas = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRas)
+    return {
+        'shape': list(slicer.util.arrayFromVolume(volumeNode).shape),
+        'ijkToRas': np.round(slicer.util.arrayFromVTKMatrix(ijkToRas), 6).tolist(),
+    }
+
+
+def importPandas():
+    """Import pandas on first use. Returns None if it isn't installed"""
+    try:
+        import pandas
+        return pandas
+    except ImportError:
+        return None
+
+
+class CaseTable():
+    """Table of image/seg paths: rows=cases, cols=ims/segs, values=paths
+
+    Cases can be looked up by name or by position in constant time, and each case's image and seg
+    paths are kept as tuples aligned with ``imageColumns`` / ``segColumns`` (``None`` where a file
+    is missing), so navigating between cases never has to convert or scan the whole table.
+
+    Args:
+        rows (list of dict): one dict per case, with the case name under the ``'case'`` key and
+            a path for each image/seg column that was found
+        imageColumns (list of str): names of the image columns, in display order. If None, every
+            column that doesn't end with ``seg`` is an image column
+    """
+
+    def __init__(self, rows=(), imageColumns=None):
+        self.index = []  # case names in order
+        self.positions = {}  # case name -> position in self.index
+        self.imagePaths = []  # tuple of image paths per case
+        self.segPaths = []  # tuple of seg paths per case
+        self.complete = []  # True for cases that have every image
+
+        rows = [OrderedDict(row) for row in rows]
+        columns = []
+        for row in rows:
+            columns += [col for col in row if col != 'case' and col not in columns]
+        if imageColumns is None:
+            imageColumns = [col for col in columns if not col.endswith('seg')]
+        self.imageColumns = list(imageColumns)
+        self.segColumns = [col for col in columns if col.endswith('seg')]
+
+        for row in rows:
+            self.append(row['case'], row)
+
+
+    def __len__(self):
+        return len(self.index)
+
+
+    def append(self, caseName, paths):
+        """Add a case. ``paths`` maps column names to paths; empty/missing values mean no file"""
+        if caseName in self.positions:
+            raise ValueError('Duplicate case '+caseName)
+        imagePaths = tuple(paths.get(col) or None for col in self.imageColumns)
+        self.positions[caseName] = len(self.index)
+        self.index.append(caseName)
+        self.imagePaths.append(imagePaths)
+        self.segPaths.append(tuple(paths.get(col) or None for col in self.segColumns))
+        self.complete.append(all(imagePaths))
+
+
+    @property
+    def columns(self):
+        return self.imageColumns + self.segColumns
+
+
+    def getLoc(self, caseName):
+        """Position of ``caseName`` in the table. Raises KeyError if it isn't present"""
+        return self.positions[caseName]
+
+
+    def isComplete(self, caseName):
+        return self.complete[self.positions[caseName]]
+
+
+    def row(self, caseName):
+        """Dict of column name -> path for one case (missing files are omitted)"""
+        pos = self.positions[caseName]
+        paths = zip(self.columns, self.imagePaths[pos] + self.segPaths[pos])
+        return OrderedDict((col, path) for col, path in paths if path)
+
+
+    def caseFiles(self, caseName):
+        """Return ``(images, segs)``: dicts of image name -> path and labeler name -> seg path"""
+        pos = self.positions[caseName]
+        imFns = OrderedDict((name, path) for name, path in zip(self.imageColumns, self.imagePaths[pos]) if path)
+        segFns = OrderedDict((col[:-len('.seg')], path) for col, path in zip(self.segColumns, self.segPaths[pos]) if path)
+        return imFns, segFns
+
+
+    def completeCases(self):
+        """Return a new table without the cases that are missing images"""
+        incompleteCases = [name for name, complete in zip(self.index, self.complete) if not complete]
+        if not incompleteCases:
+            return self
+        print('WARNING: Skipping '+str(len(incompleteCases))+' cases that are missing images:', incompleteCases)
+        return self.subset([name for name, complete in zip(self.index, self.complete) if complete])
+
+
+    def subset(self, caseNames):
+        """Return a new table with only ``caseNames`` (in that order), keeping the same columns"""
+        table = CaseTable(imageColumns=self.imageColumns)
+        table.segColumns = list(self.segColumns)
+        for name in caseNames:
+            table.append(name, self.row(name))
+        return table
+
+
+    @classmethod
+    def readCsv(cls, filename, imageColumns=None):
+        """Load a table saved by ``writeCsv`` (the ``image_paths.csv`` layout)
+
+        A csv at an http(s) url is downloaded first, and its relative paths are resolved against
+        the url.
+        """
+        csvUrl = None
+        if isRemoteUrl(filename):
+            csvUrl, filename = filename, RemoteFileCache.shared().fetch(filename)
+        with open(filename, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            if header[0] != 'case':
+                raise ValueError('First column of '+filename+' must be "case", not "'+header[0]+'"')
+            columns = header[1:]
+            if imageColumns is None:
+                imageColumns = [col for col in columns if not col.endswith('seg')]
+            table = cls(imageColumns=imageColumns)
+            table.segColumns = [col for col in columns if col.endswith('seg')]
+            for values in reader:
+                if values:
+                    paths = dict(zip(columns, values[1:]))
+                    if csvUrl:
+                        paths = {col: urljoin(csvUrl, path) if path else path for col, path in paths.items()}
+                    table.append(values[0], paths)
+        return table
+
+
+    def writeCsv(self, filename):
+        """Save in the ``image_paths.csv`` layout: case, image columns, seg columns"""
+        with open(filename, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['case'] + self.columns)
+            for name, imagePaths, segPaths in zip(self.index, self.imagePaths, self.segPaths):
+                writer.writerow([name] + [path or '' for path in imagePaths + segPaths])
+
+
+    def toDict(self):
+        """JSON-serializable form of the table (see ``fromDict``)"""
+        return {
+            'imageColumns': self.imageColumns,
+            'segColumns': self.segColumns,
+            'cases': [[name, list(imagePaths), list(segPaths)] for name, imagePaths, segPaths in zip(self.index, self.imagePaths, self.segPaths)],
+        }
+
+
+    @classmethod
+    def fromDict(cls, tableDict):
+        table = cls(imageColumns=tableDict['imageColumns'])
+        table.segColumns = list(tableDict['segColumns'])
+        for name, imagePaths, segPaths in tableDict['cases']:
+            table.append(name, dict(zip(table.columns, imagePaths + segPaths)))
+        return table
+
+
+    def toDataFrame(self):
+        """Convert to a pandas DataFrame (imports pandas, which must be installed)"""
+        pd = importPandas()
+        if pd is None:
+            raise ImportError('pandas is required to convert a CaseTable to a DataFrame')
+        df = pd.DataFrame(
+            [imagePaths + segPaths for imagePaths, segPaths in zip(self.imagePaths, self.segPaths)],
+            index=pd.Index(self.index, name='case'),
+            columns=self.columns
+        )
+        return df
+
+
+def contentHashes(filenames, cacheFilename, maxWorkers=16):
+    """``fileContentHash`` of every file, on a thread pool
+
+    Hashes are cached in ``cacheFilename`` and reused for files whose size and mtime are unchanged.
+
+    Returns:
+        dict: filename -> hash
+    """
+    cache = {}
+    if os.path.exists(cacheFilename):
+        try:
+            with open(cacheFilename) as f:
+                cache = json.load(f)
+        except ValueError:
+            print('WARNING: ignoring unreadable hash cache', cacheFilename)
+    hashes, toHash = {}, []
+    for filename in sorted(set(filenames)):
+        stat = os.stat(filename)
+        cached = cache.get(filename)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            hashes[filename] = cached[2]
+        else:
+            toHash.append((filename, stat))
+    if toHash:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            for (filename, stat), digest in zip(toHash, executor.map(fileContentHash, [filename for filename, stat in toHash])):
+                hashes[filename] = digest
+                cache[filename] = [stat.st_size, stat.st_mtime_ns, digest]
+        os.makedirs(os.path.dirname(cacheFilename), exist_ok=True)
+        with open(cacheFilename+'.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cacheFilename+'.tmp', cacheFilename)
+    return hashes
+
+
+def probeReadSeconds(folder, patterns, numBytes=1 << 16):
+    """Time to open and read the start of one image under ``folder`` (inf if there is none)"""
+    for pattern in patterns:
+        paths = glob(os.path.join(folder, '*', pattern))
+        if paths:
+            startTime = time.perf_counter()
+            with open(paths[0], 'rb') as f:
+                f.read(numBytes)
+            return time.perf_counter() - startTime
+    return float('inf')
+
+
+def consensusLabelArray(labelArrays, method, tieBreakOrder):
+    """Combine several labelers' label arrays (all the same shape) into one label array
+
+    Args:
+        labelArrays (list of np.ndarray): one integer label array per labeler
+        method (str): ``'majority'`` (per-voxel vote) or ``'staple'`` (multi-label STAPLE)
+        tieBreakOrder (list of int): every label value, including background (0), in order of
+            preference. Tied votes go to the earliest label in the list; STAPLE assigns voxels it
+            can't decide to the first one
+
+    Returns:
+        np.ndarray: uint8 consensus label array
+    """
+    if method == 'majority':
+        votes = np.zeros((len(tieBreakOrder),) + labelArrays[0].shape, np.uint8)
+        for ind, labelVal in enumerate(tieBreakOrder):
+            for labelArray in labelArrays:
+                np.add(votes[ind], labelArray == labelVal, out=votes[ind], casting='unsafe')
+        return np.asarray(tieBreakOrder, np.uint8)[np.argmax(votes, axis=0)]
+    elif method == 'staple':
+        import SimpleITK as sitk
+        images = [sitk.GetImageFromArray(labelArray.astype(np.uint8)) for labelArray in labelArrays]
+        return sitk.GetArrayFromImage(sitk.MultiLabelSTAPLE(images, tieBreakOrder[0])).astype(np.uint8)
+    else:
+        raise ValueError('Unknown consensus method '+str(method))
+
+
+def computeConsensusForCase(reference_fn, seg_fns, methods, tieBreakOrder, output_fns, resampleCache=None):
+    """Read one case's segs, resample them onto the reference image grid and write each consensus
+
+    Every seg file is decoded once and shared by all ``methods``. Segs on another grid are read
+    from ``resampleCache`` (a ``ResampleCache``) if given. Runs without the MRML scene, so it can
+    be called from worker threads.
+    """
+    import SimpleITK as sitk
+    if splitCaseFileRef(reference_fn)[1] is None:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(reference_fn)
+        reader.ReadImageInformation()
+        reference = sitk.Image(reader.GetSize(), sitk.sitkUInt8)
+        reference.SetOrigin(reader.GetOrigin())
+        reference.SetSpacing(reader.GetSpacing())
+        reference.SetDirection(reader.GetDirection())
+    else:
+        reference = readCaseImage(reference_fn)  # only its geometry is used
+
+    labelArrays = []
+    referenceGeometry = sitkGeometry(reference)
+    for seg_fn in seg_fns:
+        if resampleCache and not geometriesMatch(readCaseGeometry(seg_fn), referenceGeometry):
+            labelArrays.append(resampleCache.load(seg_fn, referenceGeometry, labelmap=True).astype(np.uint8))
+            continue
+        seg = readCaseImage(seg_fn)
+        sameGrid = (
+            seg.GetSize() == reference.GetSize() and
+            np.allclose(seg.GetOrigin(), reference.GetOrigin(), atol=1e-3) and
+            np.allclose(seg.GetSpacing(), reference.GetSpacing(), atol=1e-4) and
+            np.allclose(seg.GetDirection(), reference.GetDirection(), atol=1e-4)
+        )
+        if not sameGrid:
+            seg = sitk.Resample(seg, reference, sitk.Transform(), sitk.sitkNearestNeighbor, 0, sitk.sitkUInt8)
+        labelArrays.append(sitk.GetArrayFromImage(seg).astype(np.uint8))
+
+    for method, output_fn in zip(methods, output_fns):
+        consensus = sitk.GetImageFromArray(consensusLabelArray(labelArrays, method, tieBreakOrder))
+        consensus.CopyInformation(reference)
+        sitk.WriteImage(consensus, output_fn, True)
+
+
+class CompareSegsTest():
+
+    # import + widget setup budget for ``testStartupTime``
+    startupTimeBudgetSec = 2.0
+
+    def delayDisplay(self, message, msec=150):
+        """Display a small dialog and wait
+    
+        This does two things: 1) it lets the event loop catch up
+        to the state of the test so that rendering and widget updates
+        have all taken place before the test continues and 2) it
+        shows the user/developer/tester the state of the test
+        so that we'll know when it breaks
+        """
+        print('TEST:', message)
+        self.info = qt.QDialog()
+        self.infoLayout = qt.QVBoxLayout()
+        self.info.setLayout(self.infoLayout)
+        self.label = qt.QLabel(message,self.info)
+        self.infoLayout.addWidget(self.label)
+        qt.QTimer.singleShot(msec, self.info.close)
+        self.info.exec_()
+
+
+    def setUp(self):
+        """ Do whatever is needed to reset the state - typically a scene clear will be enough."""
+        slicer.mrmlScene.Clear(0)
+
+
+    def runTest(self):
+        """Run as few or as many tests as needed here."""
+        self.setUp()
+        self.testStartupTime()
+        self.testCaseTable()
+        self.testConsensus()
+        self.testContentHashes()
+
+    def testStartupTime(self):
+        """Module import plus widget setup must stay within ``startupTimeBudgetSec``
+
+        Everything here runs on every Slicer launch (import) or on first opening the module (setup),
+        so heavy imports and installs belong in the functions that need them.
+        """
+        self.delayDisplay('Startup time test')
+
+        # execute the module file under a different name so the loaded module isn't replaced
+        startTime = time.perf_counter()
+        spec = importlib.util.spec_from_file_location('CompareSegsStartupCheck', __file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        importTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = module.CompareSegsWidget(parent)
+        widget.setup()
+        setupTime = time.perf_counter() - startTime
+        widget.cleanup()
+        parent.deleteLater()
+
+        print('TEST: CompareSegs import took %.3fs, widget setup took %.3fs' % (importTime, setupTime))
+        if importTime + setupTime > self.startupTimeBudgetSec:
+            raise AssertionError('CompareSegs startup took %.3fs (budget is %.3fs)' % (importTime + setupTime, self.startupTimeBudgetSec))
+        self.delayDisplay('Startup time test passed')
+
+
+    def testCaseTable(self):
+        self.delayDisplay('Case table tests')
+
+        # the csv that ships with the module round-trips unchanged
+        csvFilename = os.path.join(os.path.dirname(__file__), 'image_paths.csv')
+        table = CaseTable.readCsv(csvFilename)
+        assert len(table) == 5
+        assert table.segColumns == ['keating.seg', 'smith.seg', 'vidic.seg']
+        caseName = table.index[3]
+        assert table.getLoc(caseName) == 3
+        imFns, segFns = table.caseFiles(caseName)
+        assert list(segFns.keys()) == ['keating', 'smith', 'vidic']
+        testFilename = os.path.join(tempfile.mkdtemp(), 'image_paths.csv')
+        table.writeCsv(testFilename)
+        with open(csvFilename) as f1, open(testFilename) as f2:
+            assert f1.read().splitlines() == f2.read().splitlines()
+
+        # cases missing an image are flagged and dropped
+        table = CaseTable([
+            {'case': 'complete', 'T1': 't1.nii', 'a.seg': 'a.nii'},
+            {'case': 'incomplete', 'b.seg': 'b.nii'},
+        ], imageColumns=['T1'])
+        assert table.complete == [True, False]
+        assert table.completeCases().index == ['complete']
+
+        self.delayDisplay('Case table tests passed')
+
+
+    def testConsensus(self):
+        self.delayDisplay('Consensus tests')
+
+        labeler1 = np.array([[0, 1, 2, 1]], np.uint8)
+        labeler2 = np.array([[1, 1, 3, 2]], np.uint8)
+        labeler3 = np.array([[0, 2, 3, 0]], np.uint8)
+        majority = consensusLabelArray([labeler1, labeler2, labeler3], 'majority', [0, 1, 2, 3])
+        np.testing.assert_array_equal(majority, [[0, 1, 3, 0]])  # last voxel is a 3-way tie -> background
+
+        # ties go to the earliest label in tieBreakOrder
+        majority = consensusLabelArray([labeler1, labeler2], 'majority', [3, 2, 1, 0])
+        np.testing.assert_array_equal(majority, [[1, 1, 3, 2]])
+
+        # two of three labelers agree everywhere, so STAPLE follows them wherever the third one is
+        staple = consensusLabelArray([labeler1, labeler1, labeler2], 'staple', [0, 1, 2, 3])
+        np.testing.assert_array_equal(staple, labeler1)
+        np.testing.assert_array_equal(consensusLabelArray([labeler2, labeler1, labeler1], 'staple', [0, 1, 2, 3]), labeler1)
+
+        self.delayDisplay('Consensus tests passed')
+
+
+    def testContentHashes(self):
+        self.delayDisplay('Content hash tests')
+
+        tempdir = tempfile.mkdtemp()
+        contents = {'a.nii.gz': b'x' * 1000000, 'a-copy.nii.gz': b'x' * 1000000, 'b.nii.gz': b'x' * 999999 + b'y',
+            'c.nii.gz': b'x' * 300000 + b'y' + b'x' * 699999}  # differs away from the start, middle and end
+        for name, content in contents.items():
+            with open(os.path.join(tempdir, name), 'wb') as f:
+                f.write(content)
+        filenames = [os.path.join(tempdir, name) for name in contents]
+        hash_fn = os.path.join(tempdir, 'cache', 'hashes.json')
+        hashes = contentHashes(filenames, hash_fn)
+        assert hashes[filenames[0]] == hashes[filenames[1]]
+        assert hashes[filenames[0]] != hashes[filenames[2]]
+        assert hashes[filenames[0]] != hashes[filenames[3]]
+
+        # unchanged files are not hashed again
+        with open(hash_fn) as f:
+            cache = json.load(f)
+        cache[filenames[0]][2] = 'cached'
+        with open(hash_fn, 'w') as f:
+            json.dump(cache, f)
+        assert contentHashes(filenames, hash_fn)[filenames[0]] == 'cached'
+
+        self.delayDisplay('Content hash tests passed')
@@ -0,0 +1,1610 @@
+import os
+import sys
+import csv
+import json
+import gzip
+import zlib
+import struct
+import time
+import inspect
+import cProfile
+import pstats
+import shutil
+import hashlib
+import threading
+import posixpath
+import http.client
+from glob import glob
+from fnmatch import fnmatch
+from urllib.parse import urljoin, urlsplit
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import qt, slicer
+from slicer.ScriptedLoadableModule import *
+
+
+class SegCommon(ScriptedLoadableModule):
+    """Case file access, caching and diagnostics shared by BatchSegmenter, SegReview and CompareSegs
+
+    This module has no GUI of its own. The other modules import their helpers from it, so its folder
+    must be added to the module paths as well.
+    """
+
+    def __init__(self, parent):
+        ScriptedLoadableModule.__init__(self, parent)
+        self.parent.title = "Segmentation Common"
+        self.parent.categories = ["Segmentation"]
+        self.parent.dependencies = []
+        self.parent.hidden = True
+        self.parent.contributors = ["Brian Keating (Cortechs.ai)"]
+        self.parent.helpText = """Helpers shared by the Batch Segmentation Editor, Segmentation reviewer and Compare Segmentations modules."""
+        self.parent.acknowledgementText = """"""
+
+
+def loadLabelArrayFromFile(labelFilename):
+    """Load raw numpy array from a label image file"""
+    labelmapNode = slicer.util.loadLabelVolume(labelFilename)
+    labelArray = slicer.util.arrayFromVolume(labelmapNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    return labelArray
+
+
+def readManifest(manifestFilename):
+    """Read a manifest in the ``image_paths.csv`` layout (case, image columns, seg columns)
+
+    Returns:
+        imageColumns (list of str): columns that don't end with ``seg``, in file order
+        segColumns (list of str): columns that end with ``seg``, in file order
+        rows (list of tuple): ``(caseName, {column: path})`` per case. Empty cells are omitted
+
+    A manifest at an http(s) url is downloaded first, and its relative paths are resolved against
+    the url.
+    """
+    manifestUrl = None
+    if isRemoteUrl(manifestFilename):
+        manifestUrl, manifestFilename = manifestFilename, RemoteFileCache.shared().fetch(manifestFilename)
+    with open(manifestFilename, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header[0] != 'case':
+            raise ValueError('First column of '+manifestFilename+' must be "case", not "'+header[0]+'"')
+        columns = header[1:]
+        rows = [(values[0], {col: path for col, path in zip(columns, values[1:]) if path}) for values in reader if values]
+    if manifestUrl:
+        rows = [(caseName, {col: urljoin(manifestUrl, path) for col, path in paths.items()}) for caseName, paths in rows]
+    imageColumns = [col for col in columns if not col.endswith('seg')]
+    segColumns = [col for col in columns if col.endswith('seg')]
+    return imageColumns, segColumns, rows
+
+
+def writeManifest(manifestFilename, columns, rows):
+    """Write ``(caseName, {column: path})`` rows in the ``image_paths.csv`` layout"""
+    with open(manifestFilename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['case'] + list(columns))
+        for caseName, paths in rows:
+            writer.writerow([caseName] + [paths.get(col, '') for col in columns])
+
+
+def findMissingFiles(filenames, maxWorkers=16):
+    """Return the set of ``filenames`` that don't exist, checking them on a thread pool"""
+    filenames = list(filenames)
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        exists = executor.map(caseFileExists, filenames)
+    return {filename for filename, fileExists in zip(filenames, exists) if not fileExists}
+
+
+def fileSignatures(filenames):
+    """``[path, size, mtime]`` for each file, to detect inputs that changed between runs"""
+    signatures = []
+    for filename in filenames:
+        stat = os.stat(caseFileStatPath(filename))
+        signatures.append([filename, stat.st_size, stat.st_mtime_ns])
+    return signatures
+
+
+def fileContentHash(filename, chunkSize=1 << 20):
+    """Content hash: the file size plus a hash of all of its bytes, read ``chunkSize`` bytes at a time
+
+    Callers cache the result by file size and mtime, so each version of a file is only read once.
+    """
+    size = os.path.getsize(filename)
+    digest = hashlib.blake2b(str(size).encode('ascii'), digest_size=16)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            digest.update(chunk)
+    return '%d-%s' % (size, digest.hexdigest())
+
+
+def brainMaskFromArray(imageArray, minBackgroundFraction=0.2):
+    """Brain mask of an image array: its nonzero voxels if it looks skull-stripped, else its Otsu foreground
+
+    An image counts as skull-stripped if at least ``minBackgroundFraction`` of its voxels are exactly
+    zero. Otherwise its nonzero voxels would include the background noise, so the voxels above the
+    Otsu threshold are used instead (the head rather than the brain).
+
+    Returns:
+        mask (bool array), method (``'nonzero'`` or ``'otsu'``)
+    """
+    import SimpleITK as sitk
+    nonzero = imageArray != 0
+    if nonzero.size == 0 or 1 - nonzero.mean() >= minBackgroundFraction:
+        return nonzero, 'nonzero'
+    otsu = sitk.OtsuThreshold(sitk.GetImageFromArray(imageArray.astype(np.float32)), 0, 1)
+    return sitk.GetArrayFromImage(otsu) > 0, 'otsu'
+
+
+def computeCaseQC(brain_fn, label_fn, labelNames):
+    """Measure each ROI of a label file and flag label values that aren't in ``labelNames``
+
+    The brain mask is taken from ``brain_fn`` with ``brainMaskFromArray``. Runs without the MRML
+    scene, so it can be called from worker threads.
+
+    Returns:
+        dict: ``unknownLabels`` (list of int, including any negative values), ``brainMask`` (how the
+        brain mask was found) and, under ``rois``, per label value: ``volumeMl``, ``components``
+        (number of connected components), ``extent`` (largest ratio of ROI to brain bounding box
+        size along an axis) and ``outsideBrain`` (fraction of ROI voxels outside the brain mask)
+    """
+    import SimpleITK as sitk
+    label = readCaseImage(label_fn)
+    labelArray = sitk.GetArrayFromImage(label).astype(np.int64)
+    brain, brainMaskMethod = brainMaskFromArray(sitk.GetArrayFromImage(readCaseImage(brain_fn)))
+    if brain.shape != labelArray.shape:
+        raise ValueError(brain_fn+' and '+label_fn+' have different dimensions')
+    voxelVolumeMl = np.prod(label.GetSpacing()) / 1000
+    brainInds = np.nonzero(brain)
+    brainSize = np.array([inds.max() - inds.min() + 1 for inds in brainInds]) if len(brainInds[0]) else np.array(brain.shape)
+
+    # counts[val - minLabel] is the number of voxels labeled val (np.bincount doesn't take negative values)
+    minLabel = min(int(labelArray.min()), 0) if labelArray.size else 0
+    counts = np.bincount((labelArray - minLabel).ravel())
+    presentLabels = [int(ind) + minLabel for ind in np.flatnonzero(counts) if ind + minLabel != 0]
+    qc = {'unknownLabels': [val for val in presentLabels if str(val) not in labelNames], 'brainMask': brainMaskMethod, 'rois': {}}
+    for labelVal in labelNames:
+        roi = {'volumeMl': 0.0, 'components': 0, 'extent': 0.0, 'outsideBrain': 0.0}
+        countInd = int(labelVal) - minLabel
+        if 0 <= countInd < len(counts) and counts[countInd] > 0:
+            # connected components within the ROI's bounding box only
+            roiInds = np.nonzero(labelArray == int(labelVal))
+            bbox = tuple(slice(inds.min(), inds.max() + 1) for inds in roiInds)
+            mask = labelArray[bbox] == int(labelVal)
+            components = sitk.ConnectedComponent(sitk.GetImageFromArray(mask.astype(np.uint8)))
+            roi['volumeMl'] = float(counts[countInd] * voxelVolumeMl)
+            roi['components'] = int(sitk.GetArrayViewFromImage(components).max())
+            roi['extent'] = float(max((s.stop - s.start) / size for s, size in zip(bbox, brainSize)))
+            roi['outsideBrain'] = float(1 - brain[roiInds].mean())
+        qc['rois'][labelVal] = roi
+    return qc
+
+
+def anomalyScores(qcResults):
+    """Score how unusual each case's QC measurements are within the cohort (higher = more suspicious)
+
+    Each measurement is compared to the cohort with a robust z-score (median/MAD); a case's score is
+    its largest z-score, plus a large penalty per unknown label value.
+    """
+    case_names = list(qcResults)
+    if not case_names:
+        return {}
+    features = []
+    for case_name in case_names:
+        rois = qcResults[case_name]['rois']
+        features.append([
+            value
+            for labelVal in sorted(rois)
+            for value in (np.log1p(rois[labelVal]['volumeMl']), rois[labelVal]['components'], rois[labelVal]['extent'], rois[labelVal]['outsideBrain'])
+        ])
+    features = np.array(features, float)
+    median = np.median(features, axis=0)
+    mad = np.median(np.abs(features - median), axis=0) * 1.4826
+    zScores = np.abs(features - median) / np.maximum(mad, 1e-3)
+    scores = zScores.max(axis=1) if features.shape[1] else np.zeros(len(case_names))
+    return {
+        case_name: float(score + 100 * len(qcResults[case_name]['unknownLabels']))
+        for case_name, score in zip(case_names, scores)
+    }
+
+
+def qcSummary(score, qc):
+    """One-line description of a case's QC results (for tooltips)"""
+    parts = ['anomaly score %.1f' % score]
+    if qc['unknownLabels']:
+        parts.append('unknown labels '+str(qc['unknownLabels']))
+    if qc.get('brainMask') == 'otsu':
+        parts.append('brain mask from an Otsu threshold (image not skull-stripped)')
+    for labelVal, roi in sorted(qc['rois'].items()):
+        parts.append('label %s: %.1f mL, %d components' % (labelVal, roi['volumeMl'], roi['components']))
+    return '; '.join(parts)
+
+
+class CaseStore():
+    """Folder of arrays stored as zlib-compressed slabs of slices, with their geometry
+
+    An alternative to one ``.nii.gz`` per image: ``casestore.json`` lists each array's shape, dtype,
+    IJK-to-RAS matrix, slab size and a CRC of every slab, and slab ``n`` of array ``name`` is the
+    file ``name/n.zlib``. Slabs are (de)compressed on a thread pool, a range of slices only reads
+    the slabs it overlaps, and rewriting an array skips the slabs that didn't change. Members are
+    named after the files they were converted from, and referred to as ``storeDir#member``.
+    """
+    indexName = 'casestore.json'
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.indexFilename = os.path.join(storeDir, self.indexName)
+        self.arrays = {}
+        if os.path.exists(self.indexFilename):
+            with open(self.indexFilename) as f:
+                self.arrays = json.load(f)['arrays']
+
+
+    @classmethod
+    def isStore(cls, path):
+        return os.path.isfile(os.path.join(path, cls.indexName))
+
+
+    def slabFilename(self, name, slabInd):
+        return os.path.join(self.storeDir, name, '%d.zlib' % slabInd)
+
+
+    def ijkToRas(self, name):
+        return np.array(self.arrays[name]['ijkToRas'])
+
+
+    def readArray(self, name, sliceRange=None, maxWorkers=8):
+        """Read array ``name``, or only the slices ``sliceRange=(start, stop)`` of its first axis"""
+        info = self.arrays[name]
+        shape, slabSize, dtype = info['shape'], info['slabSize'], np.dtype(info['dtype'])
+        start, stop = sliceRange if sliceRange else (0, shape[0])
+        array = np.empty([max(stop - start, 0)] + shape[1:], dtype)
+
+        def readSlab(slabInd):
+            with open(self.slabFilename(name, slabInd), 'rb') as f:
+                slab = np.frombuffer(zlib.decompress(f.read()), dtype).reshape([-1] + shape[1:])
+            lo, hi = max(start, slabInd * slabSize), min(stop, (slabInd + 1) * slabSize)
+            array[lo - start:hi - start] = slab[lo - slabInd * slabSize:hi - slabInd * slabSize]
+
+        if stop > start:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                list(executor.map(readSlab, range(start // slabSize, (stop - 1) // slabSize + 1)))
+        return array
+
+
+    def writeArray(self, name, array, ijkToRas, slabSize=8, compressLevel=1, maxWorkers=8):
+        """Write array ``name``; slabs whose contents didn't change are not rewritten"""
+        array = np.ascontiguousarray(array)
+        previous = self.arrays.get(name)
+        if previous and (previous['shape'] != list(array.shape) or np.dtype(previous['dtype']) != array.dtype or previous['slabSize'] != slabSize):
+            previous = None
+        os.makedirs(os.path.join(self.storeDir, name), exist_ok=True)
+
+        def writeSlab(slabInd):
+            data = array[slabInd * slabSize:(slabInd + 1) * slabSize].tobytes()
+            crc = zlib.crc32(data)
+            if previous is None or previous['crcs'][slabInd] != crc:
+                slab_fn = self.slabFilename(name, slabInd)
+                with open(slab_fn+'.tmp', 'wb') as f:
+                    f.write(zlib.compress(data, compressLevel))
+                os.replace(slab_fn+'.tmp', slab_fn)
+            return crc
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            crcs = list(executor.map(writeSlab, range(-(-array.shape[0] // slabSize))))
+        self.arrays[name] = {
+            'shape': list(array.shape),
+            'dtype': array.dtype.str,
+            'slabSize': slabSize,
+            'ijkToRas': np.asarray(ijkToRas, float).tolist(),
+            'crcs': crcs,
+        }
+        with open(self.indexFilename+'.tmp', 'w') as f:
+            json.dump({'version': 1, 'arrays': self.arrays}, f)
+        os.replace(self.indexFilename+'.tmp', self.indexFilename)
+
+
+class DicomIndex():
+    """Header index of the DICOM files under a folder, grouped by series
+
+    Headers are read without pixel data on a thread pool. The index is kept in the Slicer cache
+    folder (shared by all modules), so later scans only read files that are new or changed.
+    Series are referred to as ``folder#dicom:<SeriesInstanceUID>``.
+    """
+    headerTags = ['SeriesInstanceUID', 'SeriesDescription', 'SeriesNumber', 'Modality', 'ProtocolName', 'ImageType']
+    geometryTags = ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'SliceThickness', 'Rows', 'Columns']
+    maxAgeSec = 30  # reuse a scan for this long (each config pattern queries the same folder)
+    openIndexes = {}  # folder -> (scan time, DicomIndex)
+    folderLocks = {}  # folder -> lock held while the folder is scanned
+    folderLocksLock = threading.Lock()
+
+    def __init__(self, folder, maxWorkers=16):
+        self.folder = os.path.abspath(folder)
+        key = hashlib.sha1(self.folder.encode('utf-8')).hexdigest()[:16]
+        self.indexFilename = os.path.join(slicer.app.cachePath, 'DicomIndex', key+'.json')
+        self.files = {}  # filename -> [size, mtime, header tags (None if not DICOM)]
+        if os.path.exists(self.indexFilename):
+            try:
+                with open(self.indexFilename) as f:
+                    self.files = json.load(f)
+            except ValueError:
+                print('WARNING: ignoring unreadable DICOM index', self.indexFilename)
+        self.update(maxWorkers)
+
+
+    @classmethod
+    def forFolder(cls, folder):
+        """Index of ``folder``, rescanned if the last scan is older than ``maxAgeSec``
+
+        Safe to call from several threads: concurrent callers for one folder wait for a single scan
+        and share its index.
+        """
+        folder = os.path.abspath(folder)
+        with cls.folderLocksLock:
+            folderLock = cls.folderLocks.setdefault(folder, threading.Lock())
+        with folderLock:
+            scanTime, index = cls.openIndexes.get(folder, (0, None))
+            if index is None or time.time() - scanTime > cls.maxAgeSec:
+                index = cls(folder)
+                cls.openIndexes[folder] = (time.time(), index)
+        return index
+
+
+    def update(self, maxWorkers=16):
+        """Read the headers of files that were added or changed since the index was written"""
+        files, toRead = {}, []
+        for root, dirs, filenames in os.walk(self.folder):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                cached = self.files.get(path)
+                if (cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns
+                        and (cached[2] is None or 'Rows' in cached[2])):  # indexes written before geometryTags lack them
+                    files[path] = cached
+                else:
+                    toRead.append((path, stat))
+        if toRead:
+            with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+                for (path, stat), tags in zip(toRead, executor.map(readDicomHeader, [path for path, stat in toRead])):
+                    files[path] = [stat.st_size, stat.st_mtime_ns, tags]
+        changed = bool(toRead) or len(files) != len(self.files)
+        self.files = files
+        if changed:
+            os.makedirs(os.path.dirname(self.indexFilename), exist_ok=True)
+            tmp_fn = '%s.%d.%d.tmp' % (self.indexFilename, os.getpid(), threading.get_ident())  # other Slicer instances may scan the folder too
+            with open(tmp_fn, 'w') as f:
+                json.dump(self.files, f)
+            os.replace(tmp_fn, self.indexFilename)
+
+
+    def series(self):
+        """dict: SeriesInstanceUID -> header tags of one of its files"""
+        return {tags['SeriesInstanceUID']: tags for size, mtime, tags in self.files.values() if tags}
+
+
+    def seriesFiles(self, seriesUID):
+        return sorted(path for path, (size, mtime, tags) in self.files.items() if tags and tags['SeriesInstanceUID'] == seriesUID)
+
+
+    def seriesGeometry(self, seriesUID):
+        """Grid (see ``sitkGeometry``) of a series, computed from the indexed headers without decoding pixels
+
+        Raises:
+            ValueError: if the slices differ in size or orientation, or lack geometry tags
+        """
+        slices = [self.files[path][2] for path in self.seriesFiles(seriesUID)]
+        if not slices or any(tags[tag] is None for tags in slices for tag in ['ImagePositionPatient', 'ImageOrientationPatient', 'PixelSpacing', 'Rows', 'Columns']):
+            raise ValueError('DICOM series %s in %s has no image geometry' % (seriesUID, self.folder))
+        shapes = sorted({(int(tags['Rows']), int(tags['Columns'])) for tags in slices})
+        orientations = sorted({tuple(np.round(tags['ImageOrientationPatient'], 4)) for tags in slices})
+        if len(shapes) > 1 or len(orientations) > 1:
+            raise ValueError('DICOM series mixes slice sizes %s or orientations %s (%s)' % (shapes, orientations, self.folder))
+        order, ijkToRas = dicomSeriesGrid([tags['ImagePositionPatient'] for tags in slices], slices[0]['ImageOrientationPatient'],
+                                          slices[0]['PixelSpacing'], slices[0]['SliceThickness'] or 1)
+        return {'shape': [len(slices)] + list(shapes[0]), 'ijkToRas': np.round(ijkToRas, 6).tolist()}
+
+
+    def matchSeries(self, rule):
+        """UIDs of the series whose tags match ``rule``, e.g. ``SeriesDescription=*t1*post*;Modality=MR``
+
+        Values are matched case-insensitively with shell-style wildcards.
+        """
+        conditions = [condition.split('=', 1) for condition in rule.split(';') if condition]
+        return sorted(uid for uid, tags in self.series().items()
+                      if all(fnmatch(str(tags.get(tag.strip(), '')).lower(), pattern.strip().lower()) for tag, pattern in conditions))
+
+
+def readDicomHeader(filename):
+    """``DicomIndex.headerTags`` of a file as strings and ``DicomIndex.geometryTags`` as numbers, or None if it isn't DICOM"""
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    try:
+        ds = pydicom.dcmread(filename, stop_before_pixels=True, specific_tags=DicomIndex.headerTags+DicomIndex.geometryTags)
+        if 'SeriesInstanceUID' not in ds:
+            return None
+        tags = {tag: str(ds.get(tag, '')) for tag in DicomIndex.headerTags}
+        for tag in DicomIndex.geometryTags:
+            value = ds[tag].value if tag in ds else None
+            if value is None or value == '':
+                tags[tag] = None
+            else:
+                tags[tag] = [float(item) for item in value] if ds[tag].VM > 1 else float(value)
+    except (InvalidDicomError, OSError, ValueError, TypeError):
+        return None
+    return tags
+
+
+def readDicomSeries(filenames, maxWorkers=8):
+    """Decode the slices of a DICOM series on a thread pool
+
+    Returns:
+        (array, ijkToRas): ``(slices, rows, columns)`` array, with rescale slope/intercept applied,
+        and its 4x4 IJK-to-RAS matrix
+
+    Raises:
+        ValueError: if the slices differ in size or orientation
+    """
+    import pydicom
+
+    def readSlice(filename):
+        ds = pydicom.dcmread(filename)
+        try:
+            pixels = ds.pixel_array
+        except (NotImplementedError, RuntimeError):  # no pydicom decoder for this transfer syntax
+            import SimpleITK as sitk
+            pixels = sitk.GetArrayFromImage(sitk.ReadImage(filename))[0]  # GDCM already applies the rescale
+        else:
+            slope, intercept = float(ds.get('RescaleSlope', 1)), float(ds.get('RescaleIntercept', 0))
+            if slope != 1 or intercept != 0:
+                pixels = pixels.astype(np.float32) * slope + intercept
+        geometry = (np.array(ds.ImagePositionPatient, float), np.array(ds.ImageOrientationPatient, float),
+                    [float(spacing) for spacing in ds.PixelSpacing], float(ds.get('SliceThickness', 1) or 1))
+        return geometry, pixels
+
+    with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+        slices = list(executor.map(readSlice, filenames))
+    shapes = sorted({pixels.shape for geometry, pixels in slices})
+    orientations = sorted({tuple(np.round(geometry[1], 4)) for geometry, pixels in slices})
+    if len(shapes) > 1 or len(orientations) > 1:
+        raise ValueError('DICOM series mixes slice sizes %s or orientations %s (%s)' % (shapes, orientations, os.path.dirname(filenames[0])))
+    order, ijkToRas = dicomSeriesGrid([geometry[0] for geometry, pixels in slices], *slices[0][0][1:])
+    return np.stack([slices[ind][1] for ind in order]), ijkToRas
+
+
+def dicomSeriesGrid(positions, orientation, pixelSpacing, sliceThickness=1):
+    """Slice order and 4x4 IJK-to-RAS matrix of a DICOM series
+
+    Args:
+        positions: ImagePositionPatient of every slice
+        orientation, pixelSpacing, sliceThickness: ImageOrientationPatient, PixelSpacing (row, column)
+            and SliceThickness, shared by the slices
+    """
+    rowDirection, columnDirection = np.array(orientation[:3], float), np.array(orientation[3:], float)
+    normal = np.cross(rowDirection, columnDirection)
+    sliceOffsets = [np.dot(position, normal) for position in positions]
+    order = sorted(range(len(positions)), key=lambda ind: sliceOffsets[ind])
+    sliceSpacing = float(np.median(np.diff([sliceOffsets[ind] for ind in order]))) if len(positions) > 1 else sliceThickness
+    rowSpacing, columnSpacing = pixelSpacing
+
+    ijkToLps = np.eye(4)
+    ijkToLps[:3, 0] = rowDirection * columnSpacing
+    ijkToLps[:3, 1] = columnDirection * rowSpacing
+    ijkToLps[:3, 2] = normal * sliceSpacing
+    ijkToLps[:3, 3] = positions[order[0]]
+    return order, np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijkToLps
+
+
+def isRemoteUrl(ref):
+    return ref.startswith(('http://', 'https://'))
+
+
+def remoteManifestUrl(url):
+    """Manifest of a dataset hosted at ``url``: the url itself if it's a csv, else ``<url>/manifest.csv``"""
+    if urlsplit(url).path.endswith('.csv'):
+        return url
+    return url.rstrip('/')+'/manifest.csv'
+
+
+class RemoteFileCache():
+    """Local disk cache of case files served over HTTP(S), e.g. by an object store
+
+    Requests go over pooled keep-alive connections (one pool per host). Files larger than
+    ``chunkSize`` are downloaded as byte ranges in parallel when the server supports ``Range``
+    requests. Each cached file has a ``.meta.json`` sidecar with the server's ETag/Last-Modified,
+    the size and the sha256 of the download; a cached copy is only used if its size and checksum
+    still match, and it's revalidated with a ``HEAD`` request once it's older than
+    ``revalidateSec``. ``upload`` sends a conditional ``PUT`` so that a save never overwrites a
+    file that changed on the server after it was downloaded.
+
+    Args:
+        cacheDir (str): where cached files are kept, as ``<cacheDir>/<url hash>/<basename>``
+        maxWorkers (int): number of parallel range requests
+        revalidateSec (float): how long a cached file is used without checking the server
+    """
+
+    chunkSize = 8 * 1024 * 1024
+    sharedCache = None
+
+    def __init__(self, cacheDir, maxWorkers=8, revalidateSec=60, timeout=30):
+        self.cacheDir = cacheDir
+        self.revalidateSec = revalidateSec
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idleConnections = {}  # (scheme, host) -> idle keep-alive connections
+        self.fetchLocks = {}  # url -> lock, so a prefetch and a load never download the same file twice
+        self.prefetching = {}  # url -> future of the background download
+        self.rangeExecutor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.prefetchExecutor = ThreadPoolExecutor(max_workers=2)
+
+
+    @classmethod
+    def shared(cls):
+        """The cache under Slicer's cache folder, created on first use"""
+        if cls.sharedCache is None:
+            cls.sharedCache = cls(os.path.join(slicer.app.cachePath, 'RemoteFiles'))
+        return cls.sharedCache
+
+
+    def request(self, method, url, headers=None, body=None):
+        """Send a request on a pooled connection
+
+        Returns:
+            tuple: ``(status, response headers, response body bytes)``
+        """
+        parts = urlsplit(url)
+        key = parts.scheme, parts.netloc
+        path = (parts.path or '/') + ('?'+parts.query if parts.query else '')
+        for attempt in range(2):
+            with self.lock:
+                idle = self.idleConnections.setdefault(key, [])
+                connection = idle.pop() if idle else None
+            reused = connection is not None
+            if connection is None:
+                connectionClass = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+                connection = connectionClass(parts.netloc, timeout=self.timeout)
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (http.client.HTTPException, OSError):
+                connection.close()
+                if reused and attempt == 0:
+                    continue  # the server closed the idle connection, retry once on a new one
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                with self.lock:
+                    self.idleConnections[key].append(connection)
+            return response.status, response.headers, data
+
+
+    def localPath(self, url):
+        """Cache path of ``url``. The basename is kept so loaded nodes get the usual names"""
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cacheDir, key, posixpath.basename(urlsplit(url).path))
+
+
+    def stagingPath(self, url):
+        """Where a new version of ``url`` is written before it's uploaded"""
+        path = self.localPath(url)
+        return os.path.join(os.path.dirname(path), 'unsaved-'+os.path.basename(path))
+
+
+    def readMeta(self, url):
+        try:
+            with open(self.localPath(url)+'.meta.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+
+    def writeMeta(self, url, meta):
+        meta_fn = self.localPath(url)+'.meta.json'
+        with open(meta_fn+'.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_fn+'.tmp', meta_fn)
+
+
+    def head(self, url):
+        """ETag, Last-Modified, size and range support of ``url``, or None if it doesn't exist"""
+        status, headers, _ = self.request('HEAD', url)
+        if status == 404:
+            return None
+        if status >= 400:
+            raise OSError('HEAD '+url+' failed with HTTP '+str(status))
+        return {
+            'etag': headers.get('ETag'),
+            'lastModified': headers.get('Last-Modified'),
+            'size': int(headers.get('Content-Length', -1)),
+            'acceptRanges': headers.get('Accept-Ranges') == 'bytes',
+        }
+
+
+    def isIntact(self, url, meta):
+        """True if the cached copy of ``url`` is the file that was downloaded (size and sha256)"""
+        path = self.localPath(url)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_size != meta['size']:
+            return False
+        if stat.st_mtime == meta['mtime']:
+            return True
+        with open(path, 'rb') as f:
+            intact = hashlib.sha256(f.read()).hexdigest() == meta['sha256']
+        if intact:
+            meta['mtime'] = stat.st_mtime  # touched but unchanged
+            self.writeMeta(url, meta)
+        return intact
+
+
+    def exists(self, url):
+        meta = self.readMeta(url)
+        if meta is not None and time.time() - meta['checked'] < self.revalidateSec and self.isIntact(url, meta):
+            return True
+        return self.head(url) is not None
+
+
+    def fetch(self, url):
+        """Local path of ``url``, downloading it unless the cached copy is intact and up to date"""
+        with self.lock:
+            fetchLock = self.fetchLocks.setdefault(url, threading.Lock())
+        with fetchLock:
+            meta = self.readMeta(url)
+            if meta is not None and self.isIntact(url, meta):
+                if time.time() - meta['checked'] < self.revalidateSec:
+                    return self.localPath(url)
+                remote = self.head(url)
+                if remote is not None and all(remote[key] == meta[key] for key in ('etag', 'lastModified', 'size')):
+                    meta['checked'] = time.time()
+                    self.writeMeta(url, meta)
+                    return self.localPath(url)
+                print('INFO: '+url+' changed on the server, downloading it again')
+            elif meta is not None:
+                print('WARNING: cached copy of '+url+' is damaged or was modified, downloading it again')
+            return self.download(url)
+
+
+    def download(self, url):
+        startTime = time.perf_counter()
+        remote = self.head(url)
+        if remote is None:
+            raise FileNotFoundError('No such remote file: '+url)
+        path = self.localPath(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_fn = '%s.%d.part' % (path, threading.get_ident())
+        size = remote['size']
+        digest = hashlib.sha256()
+        if remote['acceptRanges'] and size > self.chunkSize:
+            with open(part_fn, 'wb') as f:
+                f.truncate(size)
+
+            def fetchRange(start):
+                end = min(start + self.chunkSize, size) - 1
+                headers = {'Range': 'bytes=%d-%d' % (start, end)}
+                if remote['etag']:
+                    headers['If-Range'] = remote['etag']  # full response (not 206) if the file changed meanwhile
+                status, _, data = self.request('GET', url, headers)
+                if status != 206 or len(data) != end - start + 1:
+                    raise OSError('Range request for '+url+' failed with HTTP '+str(status)+' (file changed during download?)')
+                with open(part_fn, 'r+b') as f:
+                    f.seek(start)
+                    f.write(data)
+                return data
+
+            for data in self.rangeExecutor.map(fetchRange, range(0, size, self.chunkSize)):
+                digest.update(data)
+        else:
+            status, _, data = self.request('GET', url)
+            if status != 200:
+                raise OSError('GET '+url+' failed with HTTP '+str(status))
+            if size >= 0 and len(data) != size:
+                raise OSError('Download of '+url+' is truncated (%d of %d bytes)' % (len(data), size))
+            size = len(data)
+            with open(part_fn, 'wb') as f:
+                f.write(data)
+            digest.update(data)
+        os.replace(part_fn, path)
+        meta = dict(remote, url=url, size=size, sha256=digest.hexdigest(), checked=time.time(), mtime=os.path.getmtime(path))
+        self.writeMeta(url, meta)
+        print('INFO: downloaded %s (%.1f MB) in %.2f s' % (url, size / 2**20, time.perf_counter() - startTime))
+        return path
+
+
+    def prefetch(self, urls):
+        """Start downloading ``urls`` in the background, e.g. the files of the next cases"""
+        for url in urls:
+            future = self.prefetching.get(url)
+            if future is None or future.done():
+                self.prefetching[url] = self.prefetchExecutor.submit(self.prefetchOne, url)
+
+
+    def prefetchOne(self, url):
+        try:
+            self.fetch(url)
+        except (OSError, http.client.HTTPException) as e:
+            print('WARNING: could not prefetch '+url+':', e)
+
+
+    def upload(self, url, filename):
+        """``PUT`` a new version of ``url`` unless the server copy changed since it was downloaded
+
+        The request is conditional on the ETag (or Last-Modified) of the cached copy; a file that
+        was never downloaded is only created, never overwritten. On success the uploaded file
+        becomes the cached copy.
+
+        Raises:
+            OSError: if the server copy changed (HTTP 412) or the upload failed
+        """
+        meta = self.readMeta(url)
+        headers = {'Content-Type': 'application/octet-stream'}
+        if meta is not None and meta.get('etag'):
+            headers['If-Match'] = meta['etag']
+        elif meta is not None and meta.get('lastModified'):
+            headers['If-Unmodified-Since'] = meta['lastModified']
+        else:
+            headers['If-None-Match'] = '*'
+        with open(filename, 'rb') as f:
+            data = f.read()
+        status, responseHeaders, _ = self.request('PUT', url, headers, data)
+        if status == 412:
+            raise OSError('Not uploading '+url+' because it was changed on the server after it was loaded')
+        if status >= 300:
+            raise OSError('PUT '+url+' failed with HTTP '+str(status))
+
+        with self.lock:
+            fetchLock = self.fetchLocks.setdefault(url, threading.Lock())
+        with fetchLock:
+            path = self.localPath(url)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(filename, path)
+            remote = {'etag': responseHeaders.get('ETag'), 'lastModified': responseHeaders.get('Last-Modified')}
+            if not remote['etag'] and not remote['lastModified']:
+                remote = self.head(url) or remote
+            meta = dict(
+                remote, url=url, size=len(data), sha256=hashlib.sha256(data).hexdigest(),
+                acceptRanges=bool(meta and meta.get('acceptRanges')), checked=time.time(), mtime=os.path.getmtime(path)
+            )
+            self.writeMeta(url, meta)
+        print('INFO: uploaded %s (%.1f MB)' % (url, len(data) / 2**20))
+
+
+def splitCaseFileRef(ref):
+    """Split a ``folder#member`` reference to a case store member or DICOM series
+
+    Plain filenames give ``(filename, None)``.
+    """
+    folder, sep, member = ref.rpartition('#')
+    if sep and (member.startswith('dicom:') or CaseStore.isStore(folder)):
+        return folder, member
+    return ref, None
+
+
+def caseFileExists(ref):
+    if isRemoteUrl(ref):
+        return RemoteFileCache.shared().exists(ref)
+    folder, member = splitCaseFileRef(ref)
+    if member is None:
+        return os.path.exists(ref)
+    if member.startswith('dicom:'):
+        return os.path.isdir(folder) and member[len('dicom:'):] in DicomIndex.forFolder(folder).series()
+    return member in CaseStore(folder).arrays
+
+
+def caseFileStatPath(ref):
+    """File whose size/mtime change when ``ref`` changes (the index for stores and DICOM series)"""
+    if isRemoteUrl(ref):
+        return RemoteFileCache.shared().fetch(ref)
+    folder, member = splitCaseFileRef(ref)
+    if member is None:
+        return ref
+    if member.startswith('dicom:'):
+        return DicomIndex.forFolder(folder).indexFilename
+    return os.path.join(folder, CaseStore.indexName)
+
+
+def globCaseFiles(folder, pattern):
+    """Files in ``folder`` matching ``pattern``, as paths or ``folder#member`` references
+
+    ``pattern`` matches member names if ``folder`` is a case store. Patterns like
+    ``dicom:SeriesDescription=*t1*`` match the DICOM series under ``folder`` (see ``DicomIndex``).
+    """
+    if pattern.startswith('dicom:'):
+        return [folder+'#dicom:'+uid for uid in DicomIndex.forFolder(folder).matchSeries(pattern[len('dicom:'):])]
+    if CaseStore.isStore(folder):
+        return [folder+'#'+member for member in sorted(CaseStore(folder).arrays) if fnmatch(member, pattern)]
+    return glob(os.path.join(folder, pattern))
+
+
+def readCaseArray(ref):
+    """Array and IJK-to-RAS matrix of a case store member or DICOM series reference"""
+    folder, member = splitCaseFileRef(ref)
+    if member.startswith('dicom:'):
+        return readDicomSeries(DicomIndex.forFolder(folder).seriesFiles(member[len('dicom:'):]))
+    store = CaseStore(folder)
+    return store.readArray(member), store.ijkToRas(member)
+
+
+def loadCaseVolume(ref, labelmap=False):
+    """Load an image file, case store member, DICOM series or remote file into the scene as a volume node"""
+    if isRemoteUrl(ref):
+        ref = RemoteFileCache.shared().fetch(ref)
+    folder, member = splitCaseFileRef(ref)
+    if member is None:
+        return slicer.util.loadLabelVolume(ref) if labelmap else slicer.util.loadVolume(ref)
+    array, ijkToRas = readCaseArray(ref)
+    nodeClassName = 'vtkMRMLLabelMapVolumeNode' if labelmap else 'vtkMRMLScalarVolumeNode'
+    return slicer.util.addVolumeFromArray(array, ijkToRas, caseNodeName(ref), nodeClassName)
+
+
+def caseNodeName(ref):
+    """Node name for a case file: the file or case store member name without extensions, or the series description"""
+    if isRemoteUrl(ref):
+        ref = urlsplit(ref).path
+    folder, member = splitCaseFileRef(ref)
+    if member and member.startswith('dicom:'):
+        return DicomIndex.forFolder(folder).series()[member[len('dicom:'):]]['SeriesDescription'] or os.path.basename(folder)
+    return os.path.basename(member or ref).split('.')[0]
+
+
+def sitkIJKToRAS(image):
+    """IJK-to-RAS matrix (4x4 numpy array) of a SimpleITK image"""
+    ijkToLps = np.eye(4)
+    ijkToLps[:3, :3] = np.array(image.GetDirection()).reshape(3, 3) * np.array(image.GetSpacing())
+    ijkToLps[:3, 3] = image.GetOrigin()
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijkToLps
+
+
+def readCaseImage(ref):
+    """Read an image file, case store member, DICOM series or remote file as a SimpleITK image (no MRML scene)"""
+    import SimpleITK as sitk
+    if isRemoteUrl(ref):
+        ref = RemoteFileCache.shared().fetch(ref)
+    folder, member = splitCaseFileRef(ref)
+    if member is None:
+        return sitk.ReadImage(ref)
+    return sitkImageFromArray(*readCaseArray(ref))
+
+
+def sitkImageFromArray(array, ijkToRas):
+    """SimpleITK image of a ``(slices, rows, columns)`` array with the given 4x4 IJK-to-RAS matrix"""
+    import SimpleITK as sitk
+    image = sitk.GetImageFromArray(array)
+    ijkToLps = np.diag([-1.0, -1.0, 1.0, 1.0]) @ ijkToRas
+    spacing = np.linalg.norm(ijkToLps[:3, :3], axis=0)
+    image.SetSpacing(spacing.tolist())
+    image.SetOrigin(ijkToLps[:3, 3].tolist())
+    image.SetDirection((ijkToLps[:3, :3] / spacing).ravel().tolist())
+    return image
+
+
+def sitkGeometry(image):
+    """``{'shape': [slices, rows, columns], 'ijkToRas': 4x4 list}`` of a SimpleITK image or image file reader"""
+    return {
+        'shape': [int(n) for n in image.GetSize()[::-1]],
+        'ijkToRas': np.round(sitkIJKToRAS(image), 6).tolist(),
+    }
+
+
+def readCaseGeometry(ref):
+    """Grid (see ``sitkGeometry``) of a case file, reading only the header of image files
+
+    The grid of a DICOM series comes from the slice headers in its ``DicomIndex``.
+    """
+    import SimpleITK as sitk
+    if isRemoteUrl(ref):
+        ref = RemoteFileCache.shared().fetch(ref)
+    folder, member = splitCaseFileRef(ref)
+    if member is None:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(ref)
+        reader.ReadImageInformation()
+        return sitkGeometry(reader)
+    if member.startswith('dicom:'):
+        return DicomIndex.forFolder(folder).seriesGeometry(member[len('dicom:'):])
+    store = CaseStore(folder)
+    shape, ijkToRas = store.arrays[member]['shape'], store.ijkToRas(member)
+    return {'shape': [int(n) for n in shape], 'ijkToRas': np.round(ijkToRas, 6).tolist()}
+
+
+def geometriesMatch(geometryA, geometryB, tolerance=1e-3):
+    return geometryA['shape'] == geometryB['shape'] and np.allclose(geometryA['ijkToRas'], geometryB['ijkToRas'], atol=tolerance)
+
+
+def readCaseGeometries(refs, cacheFilename, maxWorkers=16):
+    """``readCaseGeometry`` of every case file, on a thread pool
+
+    Geometries are cached in ``cacheFilename`` and reused for files whose size and mtime are
+    unchanged. Files that can't be read are left out (with a warning).
+
+    Returns:
+        dict: ref -> geometry
+    """
+    cache = {}
+    if os.path.exists(cacheFilename):
+        try:
+            with open(cacheFilename) as f:
+                cache = json.load(f)
+        except ValueError:
+            print('WARNING: ignoring unreadable geometry cache', cacheFilename)
+    geometries, toRead = {}, []
+    for ref in sorted(set(refs)):
+        try:
+            stat = os.stat(caseFileStatPath(ref))
+        except OSError:
+            continue
+        cached = cache.get(ref)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            geometries[ref] = cached[2]
+        else:
+            toRead.append((ref, stat))
+    if toRead:
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            futures = {executor.submit(readCaseGeometry, ref): (ref, stat) for ref, stat in toRead}
+            for future in as_completed(futures):
+                ref, stat = futures[future]
+                try:
+                    geometries[ref] = future.result()
+                except Exception as e:
+                    print('WARNING: could not read the geometry of '+ref+':', e)
+                    continue
+                cache[ref] = [stat.st_size, stat.st_mtime_ns, geometries[ref]]
+        os.makedirs(os.path.dirname(cacheFilename), exist_ok=True)
+        with open(cacheFilename+'.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cacheFilename+'.tmp', cacheFilename)
+    return geometries
+
+
+def findGeometryMismatches(cases, cacheFilename, maxWorkers=16):
+    """Find the files that are on a different grid than their case's reference image
+
+    Args:
+        cases: ``(case name, reference ref, [other refs])`` for each case
+
+    Returns:
+        OrderedDict: case name -> {ref: reference geometry} for the cases with mismatched files
+    """
+    cases = list(cases)
+    geometries = readCaseGeometries([ref for name, reference, others in cases for ref in [reference] + list(others)], cacheFilename, maxWorkers)
+    mismatches = OrderedDict()
+    for name, reference, others in cases:
+        target = geometries.get(reference)
+        if target is None:
+            continue
+        mismatched = {ref: target for ref in others if ref in geometries and not geometriesMatch(geometries[ref], target)}
+        if mismatched:
+            mismatches[name] = mismatched
+    return mismatches
+
+
+def resampleCaseImage(ref, geometry, labelmap=False):
+    """Array of a case file resampled onto ``geometry`` (nearest neighbor for labels, else linear)"""
+    import SimpleITK as sitk
+    image = readCaseImage(ref)
+    ijkToLps = np.diag([-1.0, -1.0, 1.0, 1.0]) @ np.array(geometry['ijkToRas'])
+    spacing = np.linalg.norm(ijkToLps[:3, :3], axis=0)
+    resampled = sitk.Resample(
+        image, geometry['shape'][::-1], sitk.Transform(), sitk.sitkNearestNeighbor if labelmap else sitk.sitkLinear,
+        ijkToLps[:3, 3].tolist(), spacing.tolist(), (ijkToLps[:3, :3] / spacing).ravel().tolist(), 0, image.GetPixelID())
+    return sitk.GetArrayFromImage(resampled)
+
+
+class ResampleCache():
+    """Case files resampled onto another grid, kept as ``.npy`` files in ``cacheDir``
+
+    Entries are keyed by the size, mtime and content hash of the source (see ``fileContentHash``)
+    and the target geometry, so a file is resampled again whenever it or its reference image changes.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.sourceHashes = {}  # ref -> (stat path, size, mtime, hash)
+        self.lock = threading.Lock()
+
+
+    def sourceHash(self, ref):
+        statPath = caseFileStatPath(ref)
+        stat = os.stat(statPath)
+        with self.lock:
+            cached = self.sourceHashes.get(ref)
+        if cached and cached[:3] == (statPath, stat.st_size, stat.st_mtime_ns):
+            return cached[3]
+        member = splitCaseFileRef(ref)[1]
+        digest = '%d-%s' % (stat.st_mtime_ns, fileContentHash(statPath)) + ('#'+member if member else '')
+        with self.lock:
+            self.sourceHashes[ref] = (statPath, stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+
+
+    def filename(self, ref, geometry, labelmap=False):
+        key = json.dumps([self.sourceHash(ref), geometry, bool(labelmap)], sort_keys=True)
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest()+'.npy')
+
+
+    def load(self, ref, geometry, labelmap=False):
+        """``ref`` resampled onto ``geometry``, resampling (and caching) it now if it isn't cached"""
+        array_fn = self.filename(ref, geometry, labelmap)
+        if os.path.exists(array_fn):
+            try:
+                return np.load(array_fn)
+            except (OSError, ValueError) as e:
+                print('WARNING: ignoring unreadable resampled array', array_fn, e)
+        array = resampleCaseImage(ref, geometry, labelmap)
+        os.makedirs(self.cacheDir, exist_ok=True)
+        tmp_fn = array_fn[:-len('.npy')]+'.%d.tmp.npy' % threading.get_ident()
+        np.save(tmp_fn, array)
+        os.replace(tmp_fn, array_fn)
+        return array
+
+
+    def prepare(self, jobs, progressCallback=None, maxWorkers=None):
+        """Resample the ``(ref, geometry, labelmap)`` jobs that aren't cached yet, on a thread pool
+
+        Returns:
+            dict: ref -> exception, for the files that couldn't be resampled
+        """
+        jobs = [job for job in jobs if not os.path.exists(self.filename(*job))]
+        failures = {}
+        with ThreadPoolExecutor(max_workers=maxWorkers or os.cpu_count()) as executor:
+            futures = {executor.submit(self.load, *job): job[0] for job in jobs}
+            for num, future in enumerate(as_completed(futures)):
+                try:
+                    future.result()
+                except Exception as e:
+                    failures[futures[future]] = e
+                if progressCallback:
+                    progressCallback(num + 1, len(jobs))
+        return failures
+
+
+class HashingReader():
+    """File wrapper that hashes the bytes read through it"""
+
+    def __init__(self, f, digest):
+        self.f = f
+        self.digest = digest
+
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.digest.update(data)
+        return data
+
+
+def checkImageHeader(filename, header, dataSize):
+    """Problem with a NIfTI or NRRD header (the first bytes of the uncompressed file), or None
+
+    ``dataSize`` is the uncompressed file size, used to detect NIfTI files with truncated voxel data.
+    """
+    name = filename.lower()
+    if name.endswith(('.nii', '.nii.gz')):
+        if len(header) < 4:
+            return 'NIfTI header is truncated'
+        sizes = {struct.unpack(endian+'i', header[:4])[0]: endian for endian in '<>'}
+        if 540 in sizes:
+            return None  # NIfTI-2, only the header size is checked
+        if 348 not in sizes:
+            return 'not a NIfTI file (header size %d)' % struct.unpack('<i', header[:4])[0]
+        if len(header) < 348:
+            return 'NIfTI header is truncated'
+        endian = sizes[348]
+        if header[344:348] not in (b'n+1\0', b'ni1\0'):
+            return 'not a NIfTI-1 file (bad magic)'
+        dims = struct.unpack(endian+'8h', header[40:56])
+        bitpix = struct.unpack(endian+'h', header[72:74])[0]
+        voxOffset = struct.unpack(endian+'f', header[108:112])[0]
+        if not 1 <= dims[0] <= 7 or min(dims[1:dims[0]+1]) < 1:
+            return 'invalid NIfTI dimensions %s' % (dims[1:dims[0]+1],)
+        expectedSize = int(voxOffset) + int(np.prod(dims[1:dims[0]+1], dtype=np.int64)) * bitpix // 8
+        if header[344:348] == b'n+1\0' and dataSize < expectedSize:
+            return 'NIfTI voxel data is truncated (%d of %d bytes)' % (dataSize, expectedSize)
+    elif name.endswith(('.nrrd', '.nhdr')):
+        if not header.startswith(b'NRRD'):
+            return 'not a NRRD file'
+    return None
+
+
+def validateCaseFile(ref, chunkSize=1 << 20):
+    """Stream a case file through the gzip CRC/length checks and a header check
+
+    Case store members are checked against the CRC of every slab. DICOM series are not checked.
+
+    Returns:
+        (checksum, error): a hash of the file (of the slab CRCs for case store members) and a
+        description of the problem, or None if the file is intact
+    """
+    folder, member = splitCaseFileRef(ref)
+    if member is not None:
+        if member.startswith('dicom:'):
+            return None, None
+        store = CaseStore(folder)
+        info = store.arrays[member]
+        checksum = hashlib.blake2b(json.dumps(info['crcs']).encode('ascii'), digest_size=16).hexdigest()
+        for slabInd, crc in enumerate(info['crcs']):
+            try:
+                with open(store.slabFilename(member, slabInd), 'rb') as f:
+                    if zlib.crc32(zlib.decompress(f.read())) != crc:
+                        return checksum, 'slab %d has a wrong CRC' % slabInd
+            except (OSError, zlib.error) as e:
+                return checksum, 'slab %d is unreadable (%s)' % (slabInd, e)
+        return checksum, None
+
+    digest = hashlib.blake2b(digest_size=16)
+    header, dataSize = b'', 0
+    try:
+        with open(ref, 'rb') as f:
+            stream = gzip.GzipFile(fileobj=HashingReader(f, digest)) if ref.endswith('.gz') else HashingReader(f, digest)
+            for data in iter(lambda: stream.read(chunkSize), b''):
+                if len(header) < 348:
+                    header += data[:348 - len(header)]
+                dataSize += len(data)
+    except EOFError:
+        return digest.hexdigest(), 'gzip data is truncated'
+    except (OSError, zlib.error) as e:  # gzip.BadGzipFile is an OSError
+        return digest.hexdigest(), 'corrupt gzip data (%s)' % e
+    return digest.hexdigest(), checkImageHeader(ref, header, dataSize)
+
+
+def validateCaseFiles(refs, cacheFilename, progressCallback=None, maxWorkers=None):
+    """``validateCaseFile`` for every case file, on a thread pool
+
+    Checksums and results are kept in ``cacheFilename``, and only files whose size or mtime
+    changed since their last check are read again. Remote files are not checked.
+
+    Returns:
+        dict: ref -> description of the problem, for the files that are missing or corrupt
+    """
+    cache = {}
+    if os.path.exists(cacheFilename):
+        try:
+            with open(cacheFilename) as f:
+                cache = json.load(f)
+        except ValueError:
+            print('WARNING: ignoring unreadable integrity index', cacheFilename)
+    errors, toCheck = {}, []
+    for ref in sorted(set(refs)):
+        if isRemoteUrl(ref):
+            continue
+        try:
+            stat = os.stat(caseFileStatPath(ref))
+        except OSError:
+            errors[ref] = 'file is missing'
+            continue
+        cached = cache.get(ref)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            if cached[3]:
+                errors[ref] = cached[3]
+        else:
+            toCheck.append((ref, stat))
+    if toCheck:
+        with ThreadPoolExecutor(max_workers=maxWorkers or os.cpu_count()) as executor:
+            futures = {executor.submit(validateCaseFile, ref): (ref, stat) for ref, stat in toCheck}
+            for num, future in enumerate(as_completed(futures)):
+                ref, stat = futures[future]
+                try:
+                    checksum, error = future.result()
+                except Exception as e:
+                    checksum, error = None, 'unreadable (%s)' % e
+                cache[ref] = [stat.st_size, stat.st_mtime_ns, checksum, error]
+                if error:
+                    errors[ref] = error
+                if progressCallback:
+                    progressCallback(num + 1, len(toCheck))
+        os.makedirs(os.path.dirname(cacheFilename), exist_ok=True)
+        with open(cacheFilename+'.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cacheFilename+'.tmp', cacheFilename)
+    return errors
+
+
+def convertFolderToCaseStore(srcFolder, storeDir, patterns):
+    """Copy the files in ``srcFolder`` that match any of ``patterns`` into a case store
+
+    Returns:
+        int: number of files converted
+    """
+    import SimpleITK as sitk
+    filenames = sorted(set(fn for pattern in patterns for fn in glob(os.path.join(srcFolder, pattern))))
+    store = CaseStore(storeDir)
+    for filename in filenames:
+        image = sitk.ReadImage(filename)
+        store.writeArray(os.path.basename(filename), sitk.GetArrayFromImage(image), sitkIJKToRAS(image), maxWorkers=1)
+    return len(filenames)
+
+
+def convertTreeToCaseStores(srcRoot, dstRoot, patterns, progressCallback=None, maxWorkers=None):
+    """Convert every folder under ``srcRoot`` that has files matching ``patterns``, in parallel
+
+    Each folder becomes a case store at the same relative path under ``dstRoot``, so data folders,
+    case names and labeler folders stay the same.
+
+    Returns:
+        dict: source folder -> number of files converted, or the exception if conversion failed
+    """
+    caseFolders = [folder for folder, dirs, files in os.walk(srcRoot) if any(fnmatch(fn, pattern) for fn in files for pattern in patterns)]
+    results = {}
+    with ThreadPoolExecutor(max_workers=maxWorkers or os.cpu_count()) as executor:
+        futures = {executor.submit(convertFolderToCaseStore, folder, os.path.join(dstRoot, os.path.relpath(folder, srcRoot)), patterns): folder for folder in caseFolders}
+        for num, future in enumerate(as_completed(futures)):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print('ERROR: converting '+futures[future]+' failed:', e)
+                results[futures[future]] = e
+            if progressCallback:
+                progressCallback(num + 1, len(caseFolders))
+    return results
+
+
+class ActionProfiler():
+    """Run user actions (widget handlers) under cProfile while ``enabled``
+
+    Each action's profile is saved in ``outputDir`` as ``<timestamp>_<action>_<case>.prof`` (read
+    it with ``pstats`` or snakeviz), and its duration is kept for ``slowestActions``. Actions
+    started by another profiled action are part of the outer profile.
+    """
+
+    def __init__(self, outputDir, caseNameGetter, onProfiled=None):
+        self.outputDir = outputDir
+        self.caseNameGetter = caseNameGetter
+        self.onProfiled = onProfiled
+        self.enabled = False
+        self.running = False
+        self.records = []  # (seconds, action, case name, profile filename) of this session
+
+
+    def wrap(self, obj, actions):
+        """Replace methods of ``obj`` by profiled versions; ``actions`` maps method name -> action name
+
+        Signals must be connected after this. Like a Qt slot, a wrapped method ignores extra
+        positional arguments (e.g. the ``checked`` argument of ``clicked(bool)``).
+        """
+        for methodName, action in actions.items():
+            setattr(obj, methodName, self.profiled(action, getattr(obj, methodName)))
+
+
+    def profiled(self, action, func):
+        parameters = inspect.signature(func).parameters.values()
+        numArgs = None if any(param.kind == param.VAR_POSITIONAL for param in parameters) else len(parameters)
+
+        def wrapper(*args, **kwargs):
+            args = args[:numArgs]
+            if not self.enabled or self.running:
+                return func(*args, **kwargs)
+            return self.run(action, func, *args, **kwargs)
+
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+    def run(self, action, func, *args, **kwargs):
+        profiler = cProfile.Profile()
+        self.running = True
+        startTime = time.perf_counter()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - startTime
+            self.running = False
+            self.save(action, profiler, seconds)
+
+
+    def save(self, action, profiler, seconds):
+        try:
+            caseName = self.caseNameGetter()
+        except (IndexError, KeyError, TypeError, AttributeError):
+            caseName = None
+        caseName = str(caseName or 'no-case').replace(os.sep, '_')
+        timestamp = time.strftime('%Y%m%d-%H%M%S') + '.%03d' % (time.time() % 1 * 1000)
+        os.makedirs(self.outputDir, exist_ok=True)
+        profile_fn = os.path.join(self.outputDir, '%s_%s_%s.prof' % (timestamp, action.replace(' ', '-'), caseName))
+        profiler.dump_stats(profile_fn)
+        self.records.append((seconds, action, caseName, profile_fn))
+        print('INFO: profiled %s (%s) in %.2f s:' % (action, caseName, seconds), profile_fn)
+        if self.onProfiled:
+            self.onProfiled()
+
+
+    def slowestActions(self, num=10):
+        return sorted(self.records, key=lambda record: -record[0])[:num]
+
+
+def printProfileHotSpots(profile_fn, numLines=25):
+    """Print the functions with the most cumulative time in a saved profile"""
+    print('INFO: hot spots of', profile_fn)
+    pstats.Stats(profile_fn).strip_dirs().sort_stats('cumulative').print_stats(numLines)
+
+
+def showCaseLoadTime(caseName, startTime, loadedTime):
+    """Report the time from selecting a case to fully rendered views, in the log and status bar
+
+    Args:
+        startTime (float): ``time.perf_counter()`` when the case was selected
+        loadedTime (float): ``time.perf_counter()`` when its files were loaded into the scene
+    """
+    endTime = time.perf_counter()
+    message = 'Loaded %s in %.2f s (files %.2f s, views %.2f s)' % (caseName, endTime - startTime, loadedTime - startTime, endTime - loadedTime)
+    print('INFO: '+message)
+    slicer.util.showStatusMessage(message, 5000)
+
+
+def processMemoryMB():
+    """Resident set size of this (Slicer) process in MB
+
+    Falls back to the peak resident size where the current one isn't available, or NaN.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / 2**20
+    except ImportError:
+        pass
+    try:
+        import resource
+        maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxRss / 2**20 if sys.platform == 'darwin' else maxRss / 2**10  # bytes on macOS, kB elsewhere
+    except ImportError:
+        return float('nan')
+
+
+def countNodeReferences(obj):
+    """Count the MRML nodes referenced by ``obj``'s attributes (directly or in lists/tuples/dicts)
+
+    Returns:
+        (total, detached) where detached nodes are no longer in the scene, so only the Python
+        reference keeps them alive
+    """
+    total, detached = 0, 0
+    pending = list(vars(obj).values())
+    while pending:
+        value = pending.pop()
+        if isinstance(value, (list, tuple, set)):
+            pending.extend(value)
+        elif isinstance(value, dict):
+            pending.extend(value.values())
+        elif isinstance(value, slicer.vtkMRMLNode):
+            total += 1
+            if value.GetScene() is None:
+                detached += 1
+    return total, detached
+
+
+def lifecycleSnapshot(widget):
+    """Scene node, observer and node reference counts plus process memory, for leak tracking"""
+    nodeRefs, detachedNodeRefs = countNodeReferences(widget)
+    return {
+        'sceneNodes': slicer.mrmlScene.GetNumberOfNodes(),
+        'observers': len(getattr(widget, 'Observations', ())),
+        'nodeRefs': nodeRefs,
+        'detachedNodeRefs': detachedNodeRefs,
+        'rssMB': processMemoryMB(),
+    }
+
+
+def installMemoryStatusLabel(intervalMs=2000):
+    """Show process memory and the scene node count in the main window status bar
+
+    The label is shared by all modules, so it's only created once.
+    """
+    mainWindow = slicer.util.mainWindow()
+    if mainWindow is None:
+        return None
+    statusBar = mainWindow.statusBar()
+    label = statusBar.findChild(qt.QLabel, 'MemoryStatusLabel')
+    if label:
+        return label
+    label = qt.QLabel()
+    label.objectName = 'MemoryStatusLabel'
+    statusBar.addPermanentWidget(label)
+    timer = qt.QTimer(label)
+    timer.setInterval(intervalMs)
+    timer.connect('timeout()', lambda: label.setText('RSS %.0f MB | %d scene nodes' % (processMemoryMB(), slicer.mrmlScene.GetNumberOfNodes())))
+    timer.start()
+    return label
+
+
+def maskOutline(mask):
+    """Pixels of a 2D boolean mask that have a 4-neighbor outside the mask"""
+    padded = np.pad(mask, 1)
+    interior = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return mask & ~interior
+
+
+def renderThumbnail(image_fn, segs, thumbnail_fn, size=128):
+    """Write a PNG of the slice with the largest ROI area, with the ROI outlines drawn on top
+
+    Slices are taken along the first array axis (axial for axially acquired images) and scaled
+    to fit ``size`` x ``size`` pixels. Runs without the MRML scene, so it can be called from
+    worker threads.
+
+    Args:
+        image_fn (str): the background image
+        segs (list of tuple): ``(label_fn, {labelVal: (r, g, b)})`` per segmentation. Each ROI is
+            outlined in its 0-255 color
+        thumbnail_fn (str): the PNG to write
+        size (int): thumbnail width and height in pixels
+    """
+    import SimpleITK as sitk
+    image = sitk.GetArrayFromImage(readCaseImage(image_fn))
+    labelArrays = [sitk.GetArrayFromImage(readCaseImage(label_fn)) for label_fn, colors in segs]
+    for (label_fn, colors), labelArray in zip(segs, labelArrays):
+        if labelArray.shape != image.shape:
+            raise ValueError('Label '+label_fn+' has shape '+str(labelArray.shape)+' but '+image_fn+' has shape '+str(image.shape))
+    if labelArrays:
+        sliceInd = int(np.argmax(sum(np.count_nonzero(labelArray.reshape(len(labelArray), -1), axis=1) for labelArray in labelArrays)))
+    else:
+        sliceInd = len(image) // 2
+
+    # nearest-neighbor downsampling that keeps the aspect ratio, centered on a black square
+    height, width = image.shape[1:]
+    scale = size / max(height, width)
+    rows = np.minimum((np.arange(max(1, round(height * scale))) / scale).astype(int), height - 1)
+    cols = np.minimum((np.arange(max(1, round(width * scale))) / scale).astype(int), width - 1)
+    imageSlice = image[sliceInd][np.ix_(rows, cols)].astype(np.float32)
+    low, high = np.percentile(imageSlice, [1, 99])
+    gray = np.clip((imageSlice - low) / max(high - low, 1e-6) * 255, 0, 255).astype(np.uint8)
+    rgb = np.zeros((size, size, 3), np.uint8)
+    top, left = (size - len(rows)) // 2, (size - len(cols)) // 2
+    view = rgb[top:top+len(rows), left:left+len(cols)]
+    view[:] = gray[..., np.newaxis]
+    for (label_fn, colors), labelArray in zip(segs, labelArrays):
+        labelSlice = labelArray[sliceInd][np.ix_(rows, cols)]
+        for labelVal, color in colors.items():
+            view[maskOutline(labelSlice == labelVal)] = color
+
+    tmp_fn = '%s.%d.tmp.png' % (os.path.splitext(thumbnail_fn)[0], threading.get_ident())
+    sitk.WriteImage(sitk.GetImageFromArray(rgb, isVector=True), tmp_fn)
+    os.replace(tmp_fn, thumbnail_fn)
+
+
+class ThumbnailMosaic():
+    """Window with a grid of case thumbnails (see ``renderThumbnail``); clicking one opens the case
+
+    Thumbnails are cached as PNGs in ``cacheDir``, named by the content hashes of the image and
+    label files (see ``fileContentHash``), so only new or changed cases are rendered when the mosaic
+    is shown again, and renamed or copied cases aren't. The hashes are cached by file size and mtime
+    in ``cacheDir``. Files are checked (and remote ones downloaded) on a thread pool.
+
+    Args:
+        title (str): window title
+        cacheDir (str): folder for the cached thumbnails
+        onCaseClicked (callable): called with the name of the clicked case
+        size (int): thumbnail width and height in pixels
+    """
+
+    def __init__(self, title, cacheDir, onCaseClicked, size=128):
+        self.cacheDir = cacheDir
+        self.size = size
+        self.cases = []
+        self.contentHashes = {}  # ref -> [stat path, size, mtime, hash]
+        self.lock = threading.Lock()
+        os.makedirs(cacheDir, exist_ok=True)
+        if os.path.exists(self.hashCacheFilename()):
+            try:
+                with open(self.hashCacheFilename()) as f:
+                    self.contentHashes = json.load(f)
+            except ValueError:
+                print('WARNING: ignoring unreadable hash cache', self.hashCacheFilename())
+        self.dialog = qt.QDialog(slicer.util.mainWindow())
+        self.dialog.setWindowTitle(title)
+        self.dialog.resize(1000, 700)
+        layout = qt.QVBoxLayout(self.dialog)
+        imageLayout = qt.QHBoxLayout()
+        imageLayout.addWidget(qt.QLabel('Image:'))
+        self.imageCombobox = qt.QComboBox()
+        imageLayout.addWidget(self.imageCombobox)
+        imageLayout.addStretch(1)
+        layout.addLayout(imageLayout)
+        self.listWidget = qt.QListWidget()
+        self.listWidget.setViewMode(qt.QListView.IconMode)
+        self.listWidget.setIconSize(qt.QSize(size, size))
+        self.listWidget.setResizeMode(qt.QListView.Adjust)
+        self.listWidget.setMovement(qt.QListView.Static)
+        self.listWidget.setUniformItemSizes(True)
+        layout.addWidget(self.listWidget)
+        self.listWidget.connect('itemClicked(QListWidgetItem*)', lambda item: onCaseClicked(item.text()))
+        self.imageCombobox.connect('currentIndexChanged(const QString&)', lambda text: self.render())
+
+
+    def show(self, cases, imageNames, imageName=None):
+        """Show thumbnails of ``cases``: ``(caseName, {imageName: filename}, segs)`` per case"""
+        self.cases = cases
+        self.imageCombobox.blockSignals(True)
+        self.imageCombobox.clear()
+        self.imageCombobox.addItems(imageNames)
+        if imageName in imageNames:
+            self.imageCombobox.setCurrentIndex(imageNames.index(imageName))
+        self.imageCombobox.blockSignals(False)
+        self.dialog.show()
+        self.dialog.raise_()
+        self.render()
+
+
+    def hashCacheFilename(self):
+        return os.path.join(self.cacheDir, 'content-hashes.json')
+
+
+    def contentHash(self, ref):
+        """``fileContentHash`` of a case file, cached by the size and mtime of the file (the index for stores and DICOM series)"""
+        statPath = caseFileStatPath(ref)
+        stat = os.stat(statPath)
+        with self.lock:
+            cached = self.contentHashes.get(ref)
+        if cached and cached[:3] == [statPath, stat.st_size, stat.st_mtime_ns]:
+            return cached[3]
+        member = splitCaseFileRef(ref)[1]
+        digest = fileContentHash(statPath) + ('#'+member if member else '')
+        with self.lock:
+            self.contentHashes[ref] = [statPath, stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+
+    def thumbnailFilename(self, image_fn, segs):
+        hashes = [self.contentHash(fn) for fn in [image_fn] + [label_fn for label_fn, colors in segs]]
+        key = json.dumps([hashes, [sorted(colors.items()) for label_fn, colors in segs], self.size])
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]+'.png')
+
+
+    def thumbnail(self, image_fn, segs):
+        """Cached thumbnail of a case, rendered now if it isn't cached. Runs on a worker thread.
+
+        Returns:
+            tuple: the thumbnail filename, and whether it was rendered
+        """
+        thumbnail_fn = self.thumbnailFilename(image_fn, segs)
+        if os.path.exists(thumbnail_fn):
+            return thumbnail_fn, False
+        renderThumbnail(image_fn, segs, thumbnail_fn, self.size)
+        return thumbnail_fn, True
+
+
+    def render(self):
+        """Fill the grid, finding (or rendering) each case's thumbnail on a thread pool"""
+        startTime = time.perf_counter()
+        imageName = self.imageCombobox.currentText
+        os.makedirs(self.cacheDir, exist_ok=True)
+        self.listWidget.clear()
+        jobs = []
+        for caseName, image_fns, segs in self.cases:
+            item = qt.QListWidgetItem(caseName)
+            self.listWidget.addItem(item)
+            if imageName not in image_fns:
+                item.setToolTip('No thumbnail: no '+imageName+' image')
+                continue
+            jobs.append((item, image_fns[imageName], segs))
+
+        numRendered = 0
+        if jobs:
+            progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Rendering thumbnails')
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                futures = {executor.submit(self.thumbnail, image_fn, segs): item for item, image_fn, segs in jobs}
+                for num, future in enumerate(as_completed(futures)):
+                    item = futures[future]
+                    try:
+                        thumbnail_fn, rendered = future.result()
+                        item.setIcon(qt.QIcon(thumbnail_fn))
+                        numRendered += rendered
+                    except Exception as e:
+                        print('WARNING: could not render thumbnail of '+item.text()+':', e)
+                        item.setToolTip('No thumbnail: '+str(e))
+                    progressDialog.setValue(num + 1)
+                    slicer.app.processEvents()
+            progressDialog.close()
+            with open(self.hashCacheFilename()+'.tmp', 'w') as f:
+                json.dump(self.contentHashes, f)
+            os.replace(self.hashCacheFilename()+'.tmp', self.hashCacheFilename())
+        print('INFO: thumbnail mosaic of %d cases (%d rendered) in %.2f s' % (len(self.cases), numRendered, time.perf_counter() - startTime))
+
+
+def readCaseArrayAndGeometry(ref):
+    """Array and IJK-to-RAS matrix of any case file reference, without the MRML scene"""
+    import SimpleITK as sitk
+    image = readCaseImage(ref)
+    return sitk.GetArrayFromImage(image), sitkIJKToRAS(image)
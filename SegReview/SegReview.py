@@ -1,12 +1,33 @@
 import os
+import sys
 import json
-from glob import glob
+import time
+import shutil
+import hashlib
+import importlib.util
 import tempfile
 import traceback
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
+# SegCommon (the helpers shared by the three modules) sits next to this module's folder in the repo,
+# so it can be imported even when only this module's folder was added to the module paths
+segCommonDir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'SegCommon')
+if os.path.isdir(segCommonDir) and segCommonDir not in sys.path:
+    sys.path.append(segCommonDir)
+try:
+    from SegCommon import (readManifest, writeManifest, findMissingFiles, fileSignatures,
+        computeCaseQC, anomalyScores, qcSummary, isRemoteUrl, remoteManifestUrl, RemoteFileCache,
+        caseFileExists, globCaseFiles, loadCaseVolume, caseNodeName, findGeometryMismatches,
+        ResampleCache, validateCaseFiles, convertTreeToCaseStores, ActionProfiler,
+        printProfileHotSpots, showCaseLoadTime, lifecycleSnapshot, installMemoryStatusLabel,
+        renderThumbnail, ThumbnailMosaic, readCaseArrayAndGeometry)
+except ModuleNotFoundError as e:
+    if e.name != 'SegCommon':
+        raise
+    raise ModuleNotFoundError('SegCommon not found: add the SegCommon folder of this repository to the Slicer module paths', name='SegCommon') from e
 import logging
 
 
@@ -16,7 +37,7 @@ class SegReview(ScriptedLoadableModule):
         ScriptedLoadableModule.__init__(self, parent)
         self.parent.title = "Segmentation reviewer"
         self.parent.categories = ["Segmentation"]
-        self.parent.dependencies = []
+        self.parent.dependencies = ['SegCommon']
         self.parent.contributors = ["Brian Keating (Cortechs.ai)"]
         self.parent.helpText = """"""
         self.parent.helpText += self.getDefaultModuleDocumentationLink()
@@ -50,6 +71,44 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         self.selectDataButton.enabled = True
         dataFormLayout.addRow('Cases:', self.selectDataButton)
 
+        # Load/save a manifest (csv with one row per case) instead of selecting folders
+        manifestLayout = qt.QHBoxLayout()
+        self.loadManifestButton = qt.QPushButton('Load Manifest')
+        self.loadManifestButton.toolTip = 'Load cases from a csv with columns: case, image columns, seg column(s)'
+        manifestLayout.addWidget(self.loadManifestButton)
+        self.saveManifestButton = qt.QPushButton('Save Manifest')
+        self.saveManifestButton.toolTip = 'Save the loaded cases to a csv so they can be reopened without scanning folders'
+        self.saveManifestButton.enabled = False
+        manifestLayout.addWidget(self.saveManifestButton)
+        self.loadFromUrlButton = qt.QPushButton('Load from URL')
+        self.loadFromUrlButton.toolTip = 'Load cases from a dataset hosted over http(s): a base url with a manifest.csv, or the url of a manifest csv'
+        manifestLayout.addWidget(self.loadFromUrlButton)
+        self.checkFilesExistCheckBox = qt.QCheckBox('Check files exist')
+        self.checkFilesExistCheckBox.toolTip = 'Skip manifest cases whose files are missing (checked in parallel)'
+        manifestLayout.addWidget(self.checkFilesExistCheckBox)
+        dataFormLayout.addRow('Manifest:', manifestLayout)
+
+        # Pre-flight check of the case files (gzip CRC and headers)
+        integrityLayout = qt.QHBoxLayout()
+        self.validateFilesCheckBox = qt.QCheckBox('Validate files on load')
+        self.validateFilesCheckBox.toolTip = 'Check the gzip CRC and header of every case file (in parallel) when cases are loaded; later checks only read files that changed'
+        self.validateFilesCheckBox.checked = self.config.get('validateFiles', False)
+        integrityLayout.addWidget(self.validateFilesCheckBox)
+        self.validateNowButton = qt.QPushButton('Validate Now')
+        self.validateNowButton.toolTip = 'Check the files of all loaded cases and mark the cases with corrupt files'
+        integrityLayout.addWidget(self.validateNowButton)
+        dataFormLayout.addRow(qt.QLabel('Integrity:'), integrityLayout)
+
+        # Convert folders of image files to chunked case stores (which can be selected like data folders)
+        self.convertToCaseStoresButton = qt.QPushButton('Convert Folders to Case Stores')
+        self.convertToCaseStoresButton.toolTip = 'Convert a folder tree of files matching the config patterns into chunked case stores (same folder layout), which load faster'
+        dataFormLayout.addRow('Case Stores:', self.convertToCaseStoresButton)
+
+        # Grid of case thumbnails for a quick overview of the cohort
+        self.thumbnailOverviewButton = qt.QPushButton('Thumbnail Overview')
+        self.thumbnailOverviewButton.toolTip = 'Show every case as a thumbnail of its slice with the largest ROI area (with outlines). Click a thumbnail to open the case'
+        dataFormLayout.addRow('Overview:', self.thumbnailOverviewButton)
+
         # Combobox to display selected folders
         self.caseComboBox = qt.QComboBox()
         self.caseComboBox.enabled = False
@@ -119,18 +178,99 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         self.segEditorWidget.setReadOnly(True)
         segFormLayout.addRow(self.segEditorWidget)
 
+        #### Triage Area ####
+
+        triageCollapsibleButton = ctk.ctkCollapsibleButton()
+        triageCollapsibleButton.text = 'Triage'
+        triageCollapsibleButton.collapsed = True
+        self.layout.addWidget(triageCollapsibleButton)
+        triageFormLayout = qt.QFormLayout(triageCollapsibleButton)
+
+        triageKeys = self.triageKeys()
+        self.triageModeCheckBox = qt.QCheckBox('Triage mode')
+        self.triageModeCheckBox.toolTip = 'Record verdicts with single keys (%s accept, %s reject, %s flag, %s comment) and jump to the next unreviewed case' % (
+            triageKeys['accept'], triageKeys['reject'], triageKeys['flag'], triageKeys['comment'])
+        triageFormLayout.addRow(self.triageModeCheckBox)
+        self.verdictCommentLineEdit = qt.QLineEdit()
+        self.verdictCommentLineEdit.placeholderText = 'Optional comment, saved with the next verdict'
+        triageFormLayout.addRow('Comment:', self.verdictCommentLineEdit)
+        self.verdictStatusLabel = qt.QLabel('')
+        triageFormLayout.addRow('Verdicts:', self.verdictStatusLabel)
+
+        #### Cohort QC Area ####
+
+        qcCollapsibleButton = ctk.ctkCollapsibleButton()
+        qcCollapsibleButton.text = 'Cohort QC'
+        qcCollapsibleButton.collapsed = True
+        self.layout.addWidget(qcCollapsibleButton)
+        qcFormLayout = qt.QFormLayout(qcCollapsibleButton)
+
+        self.runQCButton = qt.QPushButton('Run Cohort QC')
+        self.runQCButton.toolTip = 'Measure ROI volumes, connected components and extents of every case, and flag unknown labels'
+        qcFormLayout.addRow(self.runQCButton)
+        self.orderByAnomalyCheckBox = qt.QCheckBox('Most suspicious cases first')
+        self.orderByAnomalyCheckBox.toolTip = 'Order the cases by QC anomaly score instead of by name'
+        qcFormLayout.addRow('Case order:', self.orderByAnomalyCheckBox)
+
+        #### Developer Area ####
+
+        developerCollapsibleButton = ctk.ctkCollapsibleButton()
+        developerCollapsibleButton.text = 'Developer'
+        developerCollapsibleButton.collapsed = True
+        self.layout.addWidget(developerCollapsibleButton)
+        developerFormLayout = qt.QFormLayout(developerCollapsibleButton)
+
+        self.profileActionsCheckBox = qt.QCheckBox('Profile user actions')
+        self.profileActionsCheckBox.toolTip = 'Run data selection, case changes, orientation changes, verdicts and saves under cProfile and save one profile per action'
+        developerFormLayout.addRow(self.profileActionsCheckBox)
+        self.slowestActionsList = qt.QListWidget()
+        self.slowestActionsList.toolTip = 'Slowest profiled actions of this session. Click one to print its hot spots in the Python console'
+        developerFormLayout.addRow('Slowest actions:', self.slowestActionsList)
+
         ## Add vertical spacer to keep widgets near top
         self.layout.addStretch(1)
         
         ### connections ###
+        # wrap the profiled handlers before they are connected
+        self.actionProfiler = ActionProfiler(
+            self.config.get('profileFolder') or os.path.join(slicer.app.cachePath, 'SegReview', 'profiles'),
+            lambda: list(self.image_label_dict)[self.selected_image_ind], self.updateSlowestActions)
+        self.actionProfiler.wrap(self, {
+            'onSelectDataButtonPressed': 'select data',
+            'onLoadManifestButtonPressed': 'select data',
+            'onLoadFromUrlButtonPressed': 'select data',
+            'onCaseComboboxChanged': 'case change',
+            'onViewOrientationChanged': 'orientation change',
+            'recordVerdict': 'verdict',
+            'onSaveManifestButtonPressed': 'save manifest',
+        })
+        self.profileActionsCheckBox.connect('toggled(bool)', self.onProfileActionsToggled)
+        self.slowestActionsList.connect('itemClicked(QListWidgetItem*)', self.onSlowestActionClicked)
         self.selectDataButton.clicked.connect(self.onSelectDataButtonPressed)
         self.previousImageButton.connect('clicked(bool)', self.previousImage)
         self.nextImageButton.connect('clicked(bool)', self.nextImage)
         self.caseComboBox.connect('currentIndexChanged(const QString&)', self.onCaseComboboxChanged)
+        self.loadManifestButton.connect('clicked(bool)', self.onLoadManifestButtonPressed)
+        self.loadFromUrlButton.connect('clicked(bool)', self.onLoadFromUrlButtonPressed)
+        self.convertToCaseStoresButton.connect('clicked(bool)', self.onConvertToCaseStoresButtonPressed)
+        self.validateNowButton.connect('clicked(bool)', self.validateCases)
+        self.thumbnailOverviewButton.connect('clicked(bool)', self.onThumbnailOverviewButtonPressed)
+        self.runQCButton.connect('clicked(bool)', self.onRunQCButtonPressed)
+        self.orderByAnomalyCheckBox.connect('toggled(bool)', self.onOrderByAnomalyToggled)
+        self.saveManifestButton.connect('clicked(bool)', self.onSaveManifestButtonPressed)
         self.redViewCombobox.connect('currentIndexChanged(const QString&)', self.onRedViewComboboxChanged)
         self.greenViewCombobox.connect('currentIndexChanged(const QString&)', self.onGreenViewComboboxChanged)
         self.yellowViewCombobox.connect('currentIndexChanged(const QString&)', self.onYellowViewComboboxChanged)
         self.viewButtonGroup.buttonClicked.connect(self.onViewOrientationChanged)
+        self.triageModeCheckBox.connect('toggled(bool)', self.onTriageModeToggled)
+        self.verdictCommentLineEdit.connect('returnPressed()', self.verdictCommentLineEdit.clearFocus)
+        self.verdictSyncTimer = qt.QTimer()
+        self.verdictSyncTimer.setSingleShot(True)
+        self.verdictSyncTimer.setInterval(2000)
+        self.verdictSyncTimer.connect('timeout()', self.syncVerdicts)
+
+        # process memory and scene size readout in the status bar
+        installMemoryStatusLabel()
 
         ### Logic ###
         self.image_label_dict = OrderedDict()
@@ -138,19 +278,39 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         self.volNodes = OrderedDict()
         self.selected_image_ind = None
         self.active_label_fn = None
+        self.active_case_name = None
         self.dataFolders = None
+        self.dataSource = None  # {'folders': [...]} or {'manifest': path or url}, identifies the session
+        self.sessionRestoreAttempted = False
+        self.lifecycleLog = []  # (before, after) lifecycleSnapshot of each clearNodes call
+        self.qcResults = {}  # case name -> output of computeCaseQC
+        self.qcScores = {}  # case name -> anomaly score
+        self.loadedCaseOrder = None  # case names in the order they were loaded, while ordered by anomaly score
+        self.verdictLog = None  # VerdictLog of the current dataset, opened by triage mode
+        self.triageShortcuts = []
+        self.casePrefetcher = CasePrefetcher()
+        self.thumbnailMosaic = None
+        self.caseLoadTime = None
+        self.badCaseFiles = {}  # case name -> {file: problem} from the last validation
+        self.resampleCache = ResampleCache(os.path.join(slicer.app.cachePath, 'SegReview', 'resampled'))
+        self.resampleTargets = {}  # file -> grid of its case's first image, for files on a different grid
+        self.resampledCases = {}  # case name -> its files that are resampled onto the first image's grid
+        self.geometryCheckedCases = set()
 
 
     def onRedViewComboboxChanged(self, volName):
         self.setSliceViewVolume('Red', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onGreenViewComboboxChanged(self, volName):
         self.setSliceViewVolume('Green', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onYellowViewComboboxChanged(self, volName):
         self.setSliceViewVolume('Yellow', volName, self.volNodes[volName])
+        self.saveSession()
 
 
     def onViewOrientationChanged(self, button):
@@ -171,6 +331,8 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         for volNode, view_name in zip(self.volNodes.values(), ['Red', 'Yellow', 'Green']):
             view = slicer.app.layoutManager().sliceWidget(view_name)
             view.mrmlSliceNode().RotateToVolumePlane(volNode)
+
+        self.saveSession()
         
 
     def onSelectDataButtonPressed(self):
@@ -188,6 +350,7 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         if file_dialog.exec_():
             data_folders = file_dialog.selectedFiles()
             self.image_label_dict = OrderedDict()
+            self.loadedCaseOrder = None
             for data_folder in data_folders:
                 im_fns, label_fn = self.findImageFilesInFolder(data_folder)
                 if im_fns and label_fn:
@@ -196,45 +359,419 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
                 else:
                     print('WARNING: Skipping '+data_folder+' because it is missing (or contains multiple) required input images')
             print('image_label_dict =', self.image_label_dict)
+            self.dataSource = {'folders': sorted(data_folders)}
+            self.qcResults, self.qcScores = {}, {}
+            self.preflightCases()
+            self.checkCaseGeometries()
             self.updateWidgets()
 
 
     def findImageFilesInFolder(self, data_folder):
         imageFilenamePatterns = self.config['imageFilenamePatterns'].values()
-        folder_ims = [glob(os.path.join(data_folder, im_fn)) for im_fn in imageFilenamePatterns]
+        folder_ims = [globCaseFiles(data_folder, im_fn) for im_fn in imageFilenamePatterns]
         has_required_ims = all(len(ims)==1 for ims in folder_ims)
-        has_label = len(glob(os.path.join(data_folder, self.config['labelFilenamePattern']))) == 1
+        has_label = len(globCaseFiles(data_folder, self.config['labelFilenamePattern'])) == 1
         if has_required_ims and has_label:
             imageDisplayNames = self.config['imageFilenamePatterns'].keys()
             im_fns_dict = OrderedDict()
             for ims, displayName in zip(folder_ims, imageDisplayNames):
                 im_fns_dict[displayName] = ims[0]
-            label_fn = glob(os.path.join(data_folder, self.config['labelFilenamePattern']))[0]
+            label_fn = globCaseFiles(data_folder, self.config['labelFilenamePattern'])[0]
             return im_fns_dict, label_fn
         else:
             return None, None
 
 
-    def updateWidgets(self):
-        """Load selected valid case names into the widget"""
+    def enter(self):
+        """Resume the last session the first time the module is opened, and install the triage hotkeys"""
+        if not self.sessionRestoreAttempted:
+            self.sessionRestoreAttempted = True
+            if not self.image_label_dict:
+                self.restoreLastSession()
+        self.installTriageShortcuts()
+
+
+    def exit(self):
+        """Remove the triage hotkeys, so they don't record verdicts (or take keys) in other modules"""
+        self.removeTriageShortcuts()
+
+
+    def datasetKey(self):
+        """Short hash identifying the current dataset (set of data folders or manifest)"""
+        return hashlib.sha1(json.dumps(self.dataSource, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+    def sessionFilename(self):
+        """Session file for the current dataset (one per set of data folders or manifest)"""
+        return os.path.join(slicer.app.cachePath, 'SegReview', 'sessions', self.datasetKey()+'.json')
+
+
+    def verdictFilename(self):
+        """Triage verdict file (JSONL) for the current dataset, from the config or in the cache folder"""
+        if self.config.get('verdictFilename'):
+            return self.config['verdictFilename']
+        return os.path.join(slicer.app.cachePath, 'SegReview', 'verdicts', self.datasetKey()+'.jsonl')
+
+
+    def saveSession(self):
+        """Save the case list, active case and view settings so the session can be resumed"""
+        if not self.dataSource or not self.image_label_dict:
+            return
+        session = {
+            'dataSource': self.dataSource,
+            'cases': [[name, im_fns_dict, label_fn] for name, (im_fns_dict, label_fn) in self.image_label_dict.items()],
+            'caseIndex': self.selected_image_ind,
+            'ui': {
+                'views': [self.redViewCombobox.currentText, self.greenViewCombobox.currentText, self.yellowViewCombobox.currentText],
+                'orientation': self.viewButtonGroup.checkedButton().text,
+            },
+        }
+        session_fn = self.sessionFilename()
+        os.makedirs(os.path.dirname(session_fn), exist_ok=True)
+        with open(session_fn+'.tmp', 'w') as f:
+            json.dump(session, f)
+        os.replace(session_fn+'.tmp', session_fn)
+        qt.QSettings().setValue('SegReview/lastSession', session_fn)
+
+
+    def restoreLastSession(self):
+        """Reload the last saved session without rescanning the data folders
+
+        Only the files of the active case are checked (when it is loaded).
+        """
+        session_fn = qt.QSettings().value('SegReview/lastSession')
+        if not session_fn or not os.path.exists(session_fn):
+            return False
+        print('INFO: resuming session', session_fn)
+        try:
+            with open(session_fn) as f:
+                session = json.load(f)
+            self.dataSource = session['dataSource']
+            image_label_dict = OrderedDict((name, (OrderedDict(im_fns_dict), label_fn)) for name, im_fns_dict, label_fn in session['cases'])
+            caseIndex = min(max(session['caseIndex'] or 0, 0), len(image_label_dict) - 1)
+        except (ValueError, KeyError, TypeError) as e:
+            print('WARNING: could not resume session '+session_fn+':', e)
+            return False
+
+        # restore view settings without triggering their callbacks (no volumes are loaded yet)
+        ui = session.get('ui', {})
+        for combobox, volName in zip([self.redViewCombobox, self.greenViewCombobox, self.yellowViewCombobox], ui.get('views', [])):
+            combobox.blockSignals(True)
+            combobox.setCurrentText(volName)
+            combobox.blockSignals(False)
+        for button in self.viewButtonGroup.buttons():
+            if button.text == ui.get('orientation'):
+                button.setChecked(True)
+
+        self.image_label_dict = image_label_dict
+        self.loadedCaseOrder = None
+        self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+        self.preflightCases()
+        self.updateWidgets(caseIndex)
+        return True
+
+
+    def onConvertToCaseStoresButtonPressed(self):
+        """Convert a folder tree of image files into case stores with the same layout, in parallel"""
+        srcRoot = qt.QFileDialog.getExistingDirectory(None, 'Folder Tree to Convert')
+        if not srcRoot:
+            return
+        dstRoot = qt.QFileDialog.getExistingDirectory(None, 'Output Folder for Case Stores')
+        if not dstRoot:
+            return
+        patterns = list(self.config['imageFilenamePatterns'].values()) + [self.config['labelFilenamePattern']]
+        progressDialog = slicer.util.createProgressDialog(labelText='Converting to case stores')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        results = convertTreeToCaseStores(srcRoot, dstRoot, patterns, onProgress)
+        progressDialog.close()
+        numFailed = sum(isinstance(result, Exception) for result in results.values())
+        print('INFO: converted %d folders into case stores under %s (%d failed)' % (len(results) - numFailed, dstRoot, numFailed))
+
+
+    def onThumbnailOverviewButtonPressed(self):
+        """Show the thumbnail mosaic of all cases, with the red view's image as background"""
+        if not self.image_label_dict:
+            return
+        if self.thumbnailMosaic is None:
+            self.thumbnailMosaic = ThumbnailMosaic('SegReview Cases', os.path.join(slicer.app.cachePath, 'SegReview', 'thumbnails'), self.openCase)
+        labelColors = {int(labelVal): tuple(color) for labelVal, color in self.config['labelColors'].items()}
+        cases = [(case_name, im_fns_dict, [(label_fn, labelColors)]) for case_name, (im_fns_dict, label_fn) in self.image_label_dict.items()]
+        self.thumbnailMosaic.show(cases, list(self.config['imageFilenamePatterns']), self.redViewCombobox.currentText)
+
+
+    def openCase(self, case_name):
+        self.caseComboBox.setCurrentIndex(list(self.image_label_dict).index(case_name))
+
+
+    def onLoadManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getOpenFileName(None, 'Load Manifest', '', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.loadManifest(manifest_fn)
+
+
+    def onLoadFromUrlButtonPressed(self):
+        url = qt.QInputDialog.getText(None, 'Load from URL', 'Dataset or manifest URL (http/https):')
+        if url:
+            self.loadManifest(remoteManifestUrl(url.strip()))
+
+
+    def loadManifest(self, manifest_fn):
+        """Load cases from a manifest csv: one read, no globbing
+
+        Image columns are matched to the config's image names and the first seg column is the
+        label file. ``manifest_fn`` can be an http(s) url, in which case relative paths in the
+        manifest are resolved against it and the case files are fetched through the
+        ``RemoteFileCache``.
+        """
+        print('INFO: loading manifest', manifest_fn)
+        imageColumns, segColumns, rows = readManifest(manifest_fn)
+        imageDisplayNames = list(self.config['imageFilenamePatterns'].keys())
+        missingColumns = [name for name in imageDisplayNames if name not in imageColumns]
+        if missingColumns or not segColumns:
+            print('ERROR: manifest '+manifest_fn+' needs columns '+str(imageDisplayNames)+' and a seg column')
+            return
+        image_label_dict = OrderedDict()
+        for case_name, paths in rows:
+            im_fns_dict = OrderedDict((name, paths.get(name)) for name in imageDisplayNames)
+            label_fn = paths.get(segColumns[0])
+            if all(im_fns_dict.values()) and label_fn:
+                image_label_dict[case_name] = im_fns_dict, label_fn
+            else:
+                print('WARNING: Skipping '+case_name+' because it is missing required input images')
+
+        # optionally drop cases whose files have disappeared
+        if self.checkFilesExistCheckBox.checked:
+            missing = findMissingFiles(fn for im_fns_dict, label_fn in image_label_dict.values() for fn in list(im_fns_dict.values()) + [label_fn])
+            for case_name, (im_fns_dict, label_fn) in list(image_label_dict.items()):
+                if missing.intersection(list(im_fns_dict.values()) + [label_fn]):
+                    print('WARNING: Skipping '+case_name+' because some of its files are missing')
+                    del image_label_dict[case_name]
+
+        self.image_label_dict = image_label_dict
+        self.loadedCaseOrder = None
+        self.dataSource = {'manifest': manifest_fn if isRemoteUrl(manifest_fn) else os.path.abspath(manifest_fn)}
+        self.qcResults, self.qcScores = {}, {}
+        self.preflightCases()
+        self.checkCaseGeometries()
+        self.updateWidgets()
+
+
+    def onSaveManifestButtonPressed(self):
+        manifest_fn = qt.QFileDialog.getSaveFileName(None, 'Save Manifest', 'image_paths.csv', 'Manifest (*.csv)')
+        if manifest_fn:
+            self.saveManifest(manifest_fn)
+
+
+    def saveManifest(self, manifest_fn):
+        """Write the loaded cases (e.g. from a folder scan) to a manifest csv"""
+        imageColumns = list(self.config['imageFilenamePatterns'].keys())
+        rows = []
+        for case_name, (im_fns_dict, label_fn) in self.image_label_dict.items():
+            paths = {name: fn if isRemoteUrl(fn) else os.path.abspath(fn) for name, fn in im_fns_dict.items()}
+            paths['seg'] = label_fn if isRemoteUrl(label_fn) else os.path.abspath(label_fn)
+            rows.append((case_name, paths))
+        writeManifest(manifest_fn, imageColumns + ['seg'], rows)
+        print('INFO: saved manifest of '+str(len(rows))+' cases to', manifest_fn)
+
+
+    def onRunQCButtonPressed(self):
+        """Run (or load cached) QC for every case, then score and optionally reorder the cases"""
+        if not self.image_label_dict:
+            return
+        cache_fn = os.path.join(slicer.app.cachePath, 'SegReview', 'qc-cache.json')
+        cache = {}
+        if os.path.exists(cache_fn):
+            with open(cache_fn) as f:
+                cache = json.load(f)
+
+        # only cases whose files changed since they were last measured need to be read
+        jobs = OrderedDict()
+        for case_name, (im_fns_dict, label_fn) in self.image_label_dict.items():
+            brain_fn = list(im_fns_dict.values())[0]
+            signature = fileSignatures([brain_fn, label_fn])
+            cached = cache.get(label_fn)
+            if cached and cached['signature'] == signature and 'brainMask' in cached['qc']:  # older results used another brain mask
+                self.qcResults[case_name] = cached['qc']
+            else:
+                jobs[case_name] = brain_fn, label_fn, signature
+        print('INFO: running QC on '+str(len(jobs))+' of '+str(len(self.image_label_dict))+' cases')
+
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Running cohort QC')
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = {executor.submit(computeCaseQC, brain_fn, label_fn, self.config['labelNames']): case_name for case_name, (brain_fn, label_fn, signature) in jobs.items()}
+            for num, future in enumerate(as_completed(futures)):
+                case_name = futures[future]
+                brain_fn, label_fn, signature = jobs[case_name]
+                try:
+                    self.qcResults[case_name] = future.result()
+                    cache[label_fn] = {'signature': signature, 'qc': self.qcResults[case_name]}
+                except Exception as e:
+                    print('ERROR: QC failed for '+case_name+':', e)
+                progressDialog.setValue(num + 1)
+                slicer.app.processEvents()
+        progressDialog.close()
+        os.makedirs(os.path.dirname(cache_fn), exist_ok=True)
+        with open(cache_fn, 'w') as f:
+            json.dump(cache, f)
+
+        self.qcScores = anomalyScores(self.qcResults)
+        for case_name, score in sorted(self.qcScores.items(), key=lambda item: -item[1])[:10]:
+            print('INFO: QC anomaly score %.1f for %s' % (score, case_name), self.qcResults[case_name])
+        if self.orderByAnomalyCheckBox.checked:
+            self.onOrderByAnomalyToggled(True)
+        else:
+            self.updateCaseTooltips()
+
+
+    def updateCaseTooltips(self):
+        """Show each case's QC summary (and corrupt or resampled files) as the tooltip of its combobox item"""
+        for ind in range(self.caseComboBox.count):
+            case_name = self.caseComboBox.itemText(ind)
+            lines = []
+            if case_name in self.badCaseFiles:
+                lines.append('Corrupt files: '+'; '.join('%s (%s)' % (caseNodeName(fn), error) for fn, error in self.badCaseFiles[case_name].items()))
+            self.caseComboBox.setItemIcon(ind, slicer.app.style().standardIcon(qt.QStyle.SP_MessageBoxWarning) if case_name in self.badCaseFiles else qt.QIcon())
+            if case_name in self.qcScores:
+                lines.append(qcSummary(self.qcScores[case_name], self.qcResults[case_name]))
+            if self.resampledCases.get(case_name):
+                lines.append('Resampled onto the grid of the first image: '+', '.join(caseNodeName(fn) for fn in self.resampledCases[case_name]))
+            if lines:
+                self.caseComboBox.setItemData(ind, '\n'.join(lines), qt.Qt.ToolTipRole)
+
+
+    def preflightCases(self):
+        """Validate the files of the loaded cases if ``Validate files on load`` is checked"""
+        self.badCaseFiles = {}
+        if self.validateFilesCheckBox.checked:
+            self.validateCases()
+
+
+    def validateCases(self):
+        """Check the gzip CRC and header of every local case file in parallel, and mark the cases with corrupt files
+
+        Results and checksums are kept in an integrity index in the cache folder, so later checks
+        (in this or another session) only read the files whose size or mtime changed.
+        """
+        case_files = OrderedDict((name, list(im_fns_dict.values()) + [label_fn]) for name, (im_fns_dict, label_fn) in self.image_label_dict.items())
+        progressDialog = slicer.util.createProgressDialog(labelText='Validating case files')
+
+        def onProgress(num, total):
+            progressDialog.maximum = total
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        errors = validateCaseFiles([fn for fns in case_files.values() for fn in fns], os.path.join(slicer.app.cachePath, 'SegReview', 'integrity.json'), onProgress)
+        progressDialog.close()
+        self.badCaseFiles = OrderedDict()
+        for case_name, fns in case_files.items():
+            bad = OrderedDict((fn, errors[fn]) for fn in fns if fn in errors)
+            if bad:
+                self.badCaseFiles[case_name] = bad
+                print('WARNING: '+case_name+' has corrupt files:', '; '.join(fn+': '+error for fn, error in bad.items()))
+        print('INFO: validated the files of %d cases, %d have corrupt or missing files' % (len(case_files), len(self.badCaseFiles)))
+        self.updateCaseTooltips()
+
+
+    def checkCaseGeometries(self, case_names=None):
+        """Compare the grid of each case's files with its first image, and resample mismatched files once
+
+        The resampled arrays are kept in ``self.resampleCache``, so loading the case again (in this
+        or a later session) doesn't resample them. Without ``case_names`` all cases are checked,
+        except those with remote files, which are checked when they are loaded.
+        """
+        if case_names is None:
+            self.resampleTargets, self.resampledCases, self.geometryCheckedCases = {}, {}, set()
+            case_names = [name for name, (im_fns_dict, label_fn) in self.image_label_dict.items() if not any(isRemoteUrl(fn) for fn in list(im_fns_dict.values()) + [label_fn])]
+        cases = []
+        for name in case_names:
+            im_fns_dict, label_fn = self.image_label_dict[name]
+            im_fns = list(im_fns_dict.values())
+            cases.append((name, im_fns[0], im_fns[1:] + [label_fn]))
+        mismatches = findGeometryMismatches(cases, os.path.join(slicer.app.cachePath, 'SegReview', 'geometry-cache.json'))
+        self.geometryCheckedCases.update(case_names)
+        if not mismatches:
+            return
+        print('WARNING: %d cases have files on a different grid than their first image, resampling them: %s' % (len(mismatches), ', '.join(mismatches)))
+        label_fns = {self.image_label_dict[name][1] for name in mismatches}
+        jobs = [(fn, geometry, fn in label_fns) for refs in mismatches.values() for fn, geometry in refs.items()]
+        progressDialog = slicer.util.createProgressDialog(maximum=len(jobs), labelText='Resampling onto the reference grid')
+
+        def onProgress(num, total):
+            progressDialog.setValue(num)
+            slicer.app.processEvents()
+
+        failures = self.resampleCache.prepare(jobs, onProgress)
+        progressDialog.close()
+        for case_name, refs in mismatches.items():
+            for fn in sorted(failures.keys() & refs.keys()):
+                print('ERROR: could not resample '+fn+':', failures[fn])
+                del refs[fn]
+            self.resampleTargets.update(refs)
+            self.resampledCases[case_name] = sorted(refs)
+        self.updateCaseTooltips()
+
+
+    def onOrderByAnomalyToggled(self, checked):
+        """Reorder the cases: highest QC anomaly score first, or back in the order they were loaded"""
+        if not self.image_label_dict:
+            return
+        if checked:
+            if self.loadedCaseOrder is None:
+                self.loadedCaseOrder = list(self.image_label_dict)
+            case_names = sorted(self.loadedCaseOrder, key=lambda case_name: -self.qcScores.get(case_name, 0))
+        else:
+            if self.loadedCaseOrder is None:
+                return
+            case_names, self.loadedCaseOrder = self.loadedCaseOrder, None
+        self.image_label_dict = OrderedDict((case_name, self.image_label_dict[case_name]) for case_name in case_names)
+        if self.active_label_fn and self.active_case_name in self.image_label_dict:
+            # the open case stays open (and selected) at its new position
+            self.updateWidgets(case_names.index(self.active_case_name), loadCase=False)
+            self.saveSession()
+        else:
+            self.updateWidgets()
+
+
+    def updateWidgets(self, caseIndex=0, loadCase=True):
+        """Load selected valid case names into the widget and load the ``caseIndex``-th case
+
+        With ``loadCase`` false the ``caseIndex``-th case is only selected, e.g. when it's already open.
+        """
+        if self.triageModeCheckBox.checked:
+            self.openVerdictLog()
         # select data button
         if len(self.image_label_dict) > 1:
             self.selectDataButton.setText(str(len(self.image_label_dict))+' cases')
         elif len(self.image_label_dict) == 1:
             self.selectDataButton.setText(os.path.basename(list(self.image_label_dict.keys())[0]))
         
-        # case combobox
+        # case combobox; its signals are blocked so clearing it doesn't switch (and save) cases
+        self.caseComboBox.blockSignals(True)
         self.caseComboBox.clear()
         if self.image_label_dict:
             case_names = list(self.image_label_dict.keys())
             self.caseComboBox.addItems(case_names)  # load names into combobox
+            self.caseComboBox.setCurrentIndex(caseIndex)
+        self.caseComboBox.blockSignals(False)
+        if self.image_label_dict:
+            self.updateCaseTooltips()
+            self.updateVerdictStatus()
             self.caseComboBox.enabled = True
+            self.saveManifestButton.enabled = True
             self.nextImageButton.enabled = True
             self.previousImageButton.enabled = True
-            self.selected_image_ind = 0
+            self.selected_image_ind = caseIndex
+            if loadCase:
+                self.onCaseComboboxChanged(case_names[caseIndex])
         else:
             self.selectDataButton.setText('Select Data Folders')
             self.caseComboBox.enabled = False
+            self.saveManifestButton.enabled = False
             self.nextImageButton.enabled = False
             self.previousImageButton.enabled = False
             self.selected_image_ind = None
@@ -267,14 +804,15 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
 
         Raises:
             ValueError: if the config is missing name/color for one of the integer labels in the 
-                label file
+                label file, or the label file has labels that aren't integers from 0 to 255
         """
+        startTime = time.perf_counter()
         
         if not self.image_label_dict:
             return
 
         try:
-            self.selected_image_ind = list(self.image_label_dict.keys()).index(text)
+            caseIndex = list(self.image_label_dict.keys()).index(text)
         except ValueError:
             return
 
@@ -283,8 +821,23 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
             im_fns_dict, label_fn = self.image_label_dict[text]
         except KeyError:
             print('Could not find %s among selected images' % text)
+            self.selectActiveCase()
             return
+        # the loaded case stays open (and selected) if this one can't be loaded
+        missing_fns = [fn for fn in list(im_fns_dict.values()) + [label_fn] if not caseFileExists(fn)]
+        if missing_fns:
+            print('ERROR: Cannot load '+text+' because some of its files are missing:', missing_fns)
+            self.selectActiveCase()
+            return
+        if text in self.badCaseFiles:
+            print('ERROR: Cannot load '+text+' because some of its files are corrupt:', dict(self.badCaseFiles[text]))
+            self.selectActiveCase()
+            return
+        if text not in self.geometryCheckedCases:
+            self.checkCaseGeometries([text])
         self.active_label_fn = label_fn
+        self.active_case_name = text
+        self.selected_image_ind = caseIndex
 
         # remove existing nodes (if any)
         self.clearNodes()
@@ -295,33 +848,204 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         # create segmentation
         self.createSegmentationFromFile(label_fn)
 
-        # set the correct orientation
-        sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
-        selectedOrientation = self.viewButtonGroup.checkedButton().text
-        for sliceNode in sliceNodes:
-            if selectedOrientation == 'axial':
-                sliceNode.SetOrientationToAxial()
-            elif selectedOrientation == 'sagittal':
-                sliceNode.SetOrientationToSagittal()
-            elif selectedOrientation == 'coronal':
-                sliceNode.SetOrientationToCoronal()
+        loadedTime = time.perf_counter()
 
-        # configure views
+        # configure all views as one batch with rendering paused, then render once
         volNames = [
             self.redViewCombobox.currentText,
             self.greenViewCombobox.currentText,
             self.yellowViewCombobox.currentText,
         ]
-        for volName, color in zip(volNames, ['Red', 'Green', 'Yellow']):
-            volNode = self.volNodes[volName]
-            self.setSliceViewVolume(color, volName, volNode)
+        with slicer.util.RenderBlocker():
+            # set the correct orientation
+            sliceNodes = slicer.util.getNodesByClass('vtkMRMLSliceNode')
+            selectedOrientation = self.viewButtonGroup.checkedButton().text
+            for sliceNode in sliceNodes:
+                if selectedOrientation == 'axial':
+                    sliceNode.SetOrientationToAxial()
+                elif selectedOrientation == 'sagittal':
+                    sliceNode.SetOrientationToSagittal()
+                elif selectedOrientation == 'coronal':
+                    sliceNode.SetOrientationToCoronal()
+
+            for volName, color in zip(volNames, ['Red', 'Green', 'Yellow']):
+                volNode = self.volNodes[volName]
+                self.setSliceViewVolume(color, volName, volNode)
+        slicer.util.forceRenderAllViews()
+        showCaseLoadTime(text, startTime, loadedTime)
+
+        self.caseLoadTime = time.time()
+        self.prefetchUpcomingCases()
+        self.saveSession()
+
+
+    def selectActiveCase(self):
+        """Point the case combobox back at the case that is loaded, without reloading it"""
+        if self.active_case_name not in self.image_label_dict:
+            return
+        self.selected_image_ind = list(self.image_label_dict).index(self.active_case_name)
+        self.caseComboBox.blockSignals(True)
+        self.caseComboBox.setCurrentIndex(self.selected_image_ind)
+        self.caseComboBox.blockSignals(False)
+
+
+    def prefetchUpcomingCases(self):
+        """Read ahead the files of the next few cases in the background
+
+        In triage mode the next unreviewed cases are read into memory, so the case after a verdict
+        loads without waiting on the disk (or network). Otherwise only remote files are downloaded.
+        """
+        numCases = self.config.get('prefetchCases', 2)
+        if self.triageModeCheckBox.checked:
+            caseNames = self.upcomingUnreviewedCases(numCases)
+            self.casePrefetcher.prefetch([fn for name in caseNames for fn in list(self.image_label_dict[name][0].values()) + [self.image_label_dict[name][1]] if fn not in self.resampleTargets])
+            return
+        caseNames = list(self.image_label_dict)[self.selected_image_ind+1:self.selected_image_ind+1+numCases]
+        urls = [fn for name in caseNames for fn in list(self.image_label_dict[name][0].values()) + [self.image_label_dict[name][1]] if isRemoteUrl(fn)]
+        if urls:
+            RemoteFileCache.shared().prefetch(urls)
+
+
+    def loadCaseVolume(self, filename, labelmap=False):
+        """Create a volume node from the arrays read ahead by ``self.casePrefetcher``, else load the file
+
+        Files on a different grid than the case's first image are loaded from ``self.resampleCache``.
+        """
+        geometry = self.resampleTargets.get(filename)
+        if geometry is not None:
+            array, ijkToRas = self.resampleCache.load(filename, geometry, labelmap), np.array(geometry['ijkToRas'])
+        else:
+            prefetched = self.casePrefetcher.take(filename)
+            if prefetched is None:
+                return loadCaseVolume(filename, labelmap)
+            array, ijkToRas = prefetched
+        nodeClassName = 'vtkMRMLLabelMapVolumeNode' if labelmap else 'vtkMRMLScalarVolumeNode'
+        return slicer.util.addVolumeFromArray(array, ijkToRas, caseNodeName(filename), nodeClassName)
+
+
+    #### Triage ####
+
+    def triageKeys(self):
+        """Hotkeys for the triage actions, from the config's ``triageKeys`` (defaults A/R/F/C)"""
+        keys = {'accept': 'A', 'reject': 'R', 'flag': 'F', 'comment': 'C'}
+        keys.update(self.config.get('triageKeys', {}))
+        return keys
+
+
+    def onTriageModeToggled(self, checked):
+        """Install the verdict hotkeys and open the dataset's verdict file, or remove/close them"""
+        if not checked:
+            self.removeTriageShortcuts()
+            self.closeVerdictLog()
+            self.casePrefetcher.prefetch([])
+            return
+        if slicer.util.selectedModule() == 'SegReview':
+            self.installTriageShortcuts()
+        self.openVerdictLog()
+        self.updateVerdictStatus()
+        if self.selected_image_ind is not None:
+            self.prefetchUpcomingCases()
+
+
+    def installTriageShortcuts(self):
+        """Add the verdict hotkeys to the main window in triage mode (only while this module is shown, see ``exit``)"""
+        self.removeTriageShortcuts()
+        if not self.triageModeCheckBox.checked:
+            return
+        keys = self.triageKeys()
+        actions = [(keys[verdict], lambda verdict=verdict: self.recordVerdict(verdict)) for verdict in ('accept', 'reject', 'flag')]
+        actions.append((keys['comment'], self.verdictCommentLineEdit.setFocus))
+        for key, callback in actions:
+            shortcut = qt.QShortcut(qt.QKeySequence(key), slicer.util.mainWindow())
+            shortcut.connect('activated()', callback)
+            self.triageShortcuts.append(shortcut)
+
+
+    def removeTriageShortcuts(self):
+        for shortcut in self.triageShortcuts:
+            shortcut.setEnabled(False)
+            shortcut.setParent(None)
+        self.triageShortcuts = []
+
+
+    def openVerdictLog(self):
+        self.closeVerdictLog()
+        if self.dataSource:
+            self.verdictLog = VerdictLog(self.verdictFilename())
+
+
+    def closeVerdictLog(self):
+        if self.verdictLog:
+            self.verdictLog.close()
+            self.verdictLog = None
+
+
+    def syncVerdicts(self):
+        if self.verdictLog:
+            self.verdictLog.sync()
+
+
+    def recordVerdict(self, verdict):
+        """Record ``verdict`` for the active case and move on to the next unreviewed case"""
+        if self.verdictLog is None or self.selected_image_ind is None:
+            return
+        case_name = list(self.image_label_dict)[self.selected_image_ind]
+        record = OrderedDict([
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('case', case_name),
+            ('verdict', verdict),
+            ('comment', self.verdictCommentLineEdit.text.strip()),
+            ('labelFilename', self.active_label_fn),
+            ('secondsOnCase', round(time.time() - self.caseLoadTime, 1) if self.caseLoadTime else None),
+        ])
+        self.verdictLog.append(record)
+        self.verdictSyncTimer.start()  # fsync a couple of seconds after the last verdict at the latest
+        self.verdictCommentLineEdit.text = ''
+
+        upcoming = self.upcomingUnreviewedCases(1)
+        self.updateVerdictStatus('Last verdict: %s %s' % (verdict, case_name) + ('' if upcoming else ' (every case has a verdict)'))
+        if upcoming:
+            self.caseComboBox.setCurrentIndex(list(self.image_label_dict).index(upcoming[0]))
+
+
+    def upcomingUnreviewedCases(self, numCases):
+        """Names of the next ``numCases`` loadable cases (after the active one, wrapping around) without a verdict"""
+        verdicts = self.verdictLog.verdicts if self.verdictLog else {}
+        return upcomingUnreviewedCases(list(self.image_label_dict), self.selected_image_ind, verdicts, numCases, self.isCaseLoadable)
+
+
+    def isCaseLoadable(self, case_name):
+        """Whether none of the case's files are known to be corrupt or are missing"""
+        if case_name in self.badCaseFiles:
+            return False
+        im_fns_dict, label_fn = self.image_label_dict[case_name]
+        return all(caseFileExists(fn) for fn in list(im_fns_dict.values()) + [label_fn])
+
+
+    def updateVerdictStatus(self, message=None):
+        """Show verdict counts (under ``message``, e.g. the last verdict), and color each case in the combobox by its verdict"""
+        verdicts = self.verdictLog.verdicts if self.verdictLog else {}
+        counts = OrderedDict((verdict, 0) for verdict in ('accept', 'reject', 'flag'))
+        colors = {'accept': qt.QColor('green'), 'reject': qt.QColor('red'), 'flag': qt.QColor('orange')}
+        for ind in range(self.caseComboBox.count):
+            record = verdicts.get(self.caseComboBox.itemText(ind))
+            if record:
+                counts[record['verdict']] = counts.get(record['verdict'], 0) + 1
+            self.caseComboBox.setItemData(ind, colors.get(record['verdict']) if record else None, qt.Qt.ForegroundRole)
+        status = '%d accepted, %d rejected, %d flagged of %d cases' % (
+            counts['accept'], counts['reject'], counts['flag'], len(self.image_label_dict))
+        self.verdictStatusLabel.text = message+'\n'+status if message else status
+        self.verdictStatusLabel.toolTip = 'Verdicts are recorded to '+self.verdictLog.filename if self.verdictLog else ''
         
 
     def setSliceViewVolume(self, color, volName, volNode):
         """Show the given volume in the 'color' slice view"""
         view = slicer.app.layoutManager().sliceWidget(color)
-        view.sliceLogic().GetSliceCompositeNode().SetBackgroundVolumeID(volNode.GetID())
-        view.sliceLogic().GetSliceCompositeNode().SetLinkedControl(True)
+        compositeNode = view.sliceLogic().GetSliceCompositeNode()
+        wasModifying = compositeNode.StartModify()  # one modified event (and linked-view update) per view
+        compositeNode.SetBackgroundVolumeID(volNode.GetID())
+        compositeNode.SetLinkedControl(True)
+        compositeNode.EndModify(wasModifying)
         view.mrmlSliceNode().RotateToVolumePlane(volNode)
         view.sliceController().setSliceVisible(True)  # show in 3d view
         
@@ -329,14 +1053,14 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
     def loadVolumesFromFiles(self, filename_dict):
         self.volNodes = OrderedDict()
         for display_name, filename in filename_dict.items():
-            volNode = slicer.util.loadVolume(filename)
+            volNode = self.loadCaseVolume(filename)
             if volNode:
                 volNode.GetScalarVolumeDisplayNode().SetInterpolate(0)
                 self.volNodes[display_name] = volNode
             else:
                 print('WARNING: Failed to load volume ', filename)
         if len(self.volNodes) == 0:
-            print('Failed to load any volumes ({filenames})!')
+            print('Failed to load any volumes ('+', '.join(filename_dict.values())+')!')
             return
 
 
@@ -344,11 +1068,20 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
         print('INFO: SegReview.createSegmentationFromFile invoked', label_fn)
 
         # create label node as a labelVolume
-        labelmapNode = slicer.util.loadLabelVolume(label_fn)
+        labelmapNode = self.loadCaseVolume(label_fn, labelmap=True)
         if not labelmapNode:
             print('Failed to load label volume ', label_fn)
             return
 
+        # keep all ROIs in one shared uint8 labelmap layer
+        labelArray = slicer.util.arrayFromVolume(labelmapNode)
+        if labelArray.dtype != np.uint8:
+            # the cast would silently truncate fractional or out-of-range labels
+            if labelArray.size and (labelArray.min() < 0 or labelArray.max() > 255 or not np.array_equal(labelArray, np.floor(labelArray))):
+                slicer.mrmlScene.RemoveNode(labelmapNode)
+                raise ValueError('The labels in '+label_fn+' must be integers from 0 to 255 to match the config labelNames, found values in ['+str(labelArray.min())+', '+str(labelArray.max())+']')
+            slicer.util.updateVolumeFromArray(labelmapNode, labelArray.astype(np.uint8))
+
         # create segmentation node from labelVolume
         self.segmentationNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode', 'Tumor Segmentation')
         self.segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(list(self.volNodes.values())[0])
@@ -391,26 +1124,366 @@ class SegReviewWidget(ScriptedLoadableModuleWidget):
             else:  # label is missing from labelmap, create empty segment
                 print('INFO: Adding empty segment for class', labelName)
                 segmentation.AddEmptySegment(str(labelVal), labelName, color)
+        segmentation.CollapseBinaryLabelmaps(False)  # move the empty segments into the shared layer
                 
 
     def clearNodes(self):
         print('INFO: SegReview.clearNodes invoked')
+        before = lifecycleSnapshot(self)
         for volNode in self.volNodes.values():
             slicer.mrmlScene.RemoveNode(volNode)
         if self.segmentationNode:
+            self.segEditorWidget.setSegmentationNode(None)  # the editor would keep the removed node alive
             slicer.mrmlScene.RemoveNode(self.segmentationNode)
         self.segmentationNode = None
         self.volNodes = OrderedDict()
+        self.recordLifecycle(before, lifecycleSnapshot(self))
+
+
+    def recordLifecycle(self, before, after):
+        """Log the node/observer/reference counts around ``clearNodes`` and warn when they grow"""
+        self.lifecycleLog.append((before, after))
+        print('INFO: clearNodes: %d -> %d scene nodes, %d -> %d observers, %d -> %d node references, %.0f -> %.0f MB' % (
+            before['sceneNodes'], after['sceneNodes'], before['observers'], after['observers'],
+            before['nodeRefs'], after['nodeRefs'], before['rssMB'], after['rssMB']))
+        if after['detachedNodeRefs']:
+            print('WARNING: %d removed nodes are still referenced by the widget' % after['detachedNodeRefs'])
+        firstAfter = self.lifecycleLog[0][1]
+        if after['sceneNodes'] > firstAfter['sceneNodes']:
+            print('WARNING: %d more scene nodes remain after clearing than after the first clear' % (after['sceneNodes'] - firstAfter['sceneNodes']))
 
                 
+    def onProfileActionsToggled(self, checked):
+        self.actionProfiler.enabled = checked
+        if checked:
+            print('INFO: profiling user actions into', self.actionProfiler.outputDir)
+
+
+    def updateSlowestActions(self):
+        """List the slowest profiled actions of the session, with their profile files"""
+        self.slowestActionsList.clear()
+        for seconds, action, caseName, profile_fn in self.actionProfiler.slowestActions():
+            item = qt.QListWidgetItem('%.2f s  %s  (%s)' % (seconds, action, caseName))
+            item.setData(qt.Qt.UserRole, profile_fn)
+            item.setToolTip(profile_fn)
+            self.slowestActionsList.addItem(item)
+
+
+    def onSlowestActionClicked(self, item):
+        printProfileHotSpots(item.data(qt.Qt.UserRole))
+
+
     def cleanup(self):
         print('INFO: SegReview.cleanup() invoked')
+        self.closeVerdictLog()
+        if self.thumbnailMosaic:
+            self.thumbnailMosaic.dialog.close()
         self.clearNodes()
 
 
-def loadLabelArrayFromFile(labelFilename):
-    """Load raw numpy array from a label image file"""
-    labelmapNode = slicer.util.loadLabelVolume(labelFilename)
-    labelArray = slicer.util.arrayFromVolume(labelmapNode)
-    slicer.mrmlScene.RemoveNode(labelmapNode)
-    return labelArray
+def upcomingUnreviewedCases(case_names, activeIndex, verdicts, numCases, isLoadable=None):
+    """Names of the next ``numCases`` of ``case_names`` after ``activeIndex`` (wrapping around, active case excluded) that aren't in ``verdicts``
+
+    Cases for which ``isLoadable(case_name)`` is false are skipped; it's only called on cases without a verdict.
+    """
+    activeIndex = activeIndex or 0
+    upcoming = []
+    for case_name in case_names[activeIndex+1:] + case_names[:activeIndex]:
+        if case_name not in verdicts and (isLoadable is None or isLoadable(case_name)):
+            upcoming.append(case_name)
+            if len(upcoming) == numCases:
+                break
+    return upcoming
+
+
+class VerdictLog():
+    """Append-only JSONL file of triage verdicts
+
+    Each record is written and flushed to the OS as soon as it's appended, but ``os.fsync`` only
+    runs every ``syncEvery`` records (or when ``sync`` is called), so recording a verdict never
+    waits on the disk. When the file is read the latest record of a case wins, so a case can be
+    re-judged by recording a new verdict.
+
+    Args:
+        filename (str): the verdict file, created if needed
+        syncEvery (int): number of appended records between fsyncs
+    """
+
+    def __init__(self, filename, syncEvery=20):
+        self.filename = filename
+        self.syncEvery = syncEvery
+        self.unsynced = 0
+        self.verdicts = OrderedDict()  # case name -> latest record
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        line = '\n'
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # partial last line from a crash
+                    self.verdicts[record['case']] = record
+        self.file = open(filename, 'a')
+        if not line.endswith('\n'):
+            self.file.write('\n')  # don't append to a partial line
+
+
+    def append(self, record):
+        self.file.write(json.dumps(record)+'\n')
+        self.file.flush()
+        self.verdicts[record['case']] = record
+        self.unsynced += 1
+        if self.unsynced >= self.syncEvery:
+            self.sync()
+
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+class CasePrefetcher():
+    """Reads the files of upcoming cases into arrays on background threads
+
+    ``prefetch`` starts reading files (without the MRML scene) and ``take`` hands over the result,
+    waiting for a read that's still running. Files that are no longer in the latest ``prefetch``
+    call are dropped, so only the upcoming cases are held in memory.
+    """
+
+    def __init__(self, maxWorkers=2):
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers)
+        self.futures = OrderedDict()  # filename -> future of (array, IJK-to-RAS matrix)
+
+
+    def prefetch(self, filenames):
+        filenames = list(filenames)
+        for filename in list(self.futures):
+            if filename not in filenames:
+                self.futures.pop(filename).cancel()
+        for filename in filenames:
+            if filename not in self.futures:
+                self.futures[filename] = self.executor.submit(readCaseArrayAndGeometry, filename)
+
+
+    def take(self, filename):
+        """``(array, ijkToRas)`` of ``filename`` if it was prefetched, else None"""
+        future = self.futures.pop(filename, None)
+        if future is None:
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print('WARNING: prefetching '+filename+' failed:', e)
+            return None
+
+
+class SegReviewTest():
+
+    # import + widget setup budget for ``testStartupTime``
+    startupTimeBudgetSec = 2.0
+
+    def delayDisplay(self, message, msec=150):
+        """Display a small dialog and wait
+    
+        This does two things: 1) it lets the event loop catch up
+        to the state of the test so that rendering and widget updates
+        have all taken place before the test continues and 2) it
+        shows the user/developer/tester the state of the test
+        so that we'll know when it breaks
+        """
+        print('TEST:', message)
+        self.info = qt.QDialog()
+        self.infoLayout = qt.QVBoxLayout()
+        self.info.setLayout(self.infoLayout)
+        self.label = qt.QLabel(message,self.info)
+        self.infoLayout.addWidget(self.label)
+        qt.QTimer.singleShot(msec, self.info.close)
+        self.info.exec_()
+
+
+    def setUp(self):
+        """ Do whatever is needed to reset the state - typically a scene clear will be enough."""
+        slicer.mrmlScene.Clear(0)
+
+
+    def runTest(self):
+        """Run as few or as many tests as needed here."""
+        self.setUp()
+        self.testStartupTime()
+        self.testVerdictLog()
+        self.testTriage()
+        self.testThumbnail()
+
+    def testStartupTime(self):
+        """Module import plus widget setup must stay within ``startupTimeBudgetSec``
+
+        Everything here runs on every Slicer launch (import) or on first opening the module (setup),
+        so heavy imports and installs belong in the functions that need them.
+        """
+        self.delayDisplay('Startup time test')
+
+        # execute the module file under a different name so the loaded module isn't replaced
+        startTime = time.perf_counter()
+        spec = importlib.util.spec_from_file_location('SegReviewStartupCheck', __file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        importTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = module.SegReviewWidget(parent)
+        widget.setup()
+        setupTime = time.perf_counter() - startTime
+        widget.cleanup()
+        parent.deleteLater()
+
+        print('TEST: SegReview import took %.3fs, widget setup took %.3fs' % (importTime, setupTime))
+        if importTime + setupTime > self.startupTimeBudgetSec:
+            raise AssertionError('SegReview startup took %.3fs (budget is %.3fs)' % (importTime + setupTime, self.startupTimeBudgetSec))
+        self.delayDisplay('Startup time test passed')
+
+
+    def testVerdictLog(self):
+        self.delayDisplay('Verdict log test')
+
+        verdict_fn = os.path.join(tempfile.mkdtemp(), 'verdicts.jsonl')
+        log = VerdictLog(verdict_fn, syncEvery=3)
+        log.append({'case': 'case1', 'verdict': 'accept', 'comment': ''})
+        log.append({'case': 'case2', 'verdict': 'flag', 'comment': 'check edema'})
+        assert log.unsynced == 2
+        log.append({'case': 'case1', 'verdict': 'reject', 'comment': ''})
+        assert log.unsynced == 0
+        log.close()
+
+        # a crash mid-write leaves a partial line, which is skipped and not appended to
+        with open(verdict_fn, 'a') as f:
+            f.write('{"case": "case3", "verd')
+        log = VerdictLog(verdict_fn)
+        assert {case: record['verdict'] for case, record in log.verdicts.items()} == {'case1': 'reject', 'case2': 'flag'}
+        log.append({'case': 'case3', 'verdict': 'accept', 'comment': ''})
+        log.close()
+        assert VerdictLog(verdict_fn).verdicts['case3']['verdict'] == 'accept'
+
+        self.delayDisplay('Verdict log test passed')
+
+
+    def testTriage(self):
+        self.delayDisplay('Triage test')
+        import SimpleITK as sitk
+
+        # the next cases without a verdict, wrapping around and skipping the active case
+        case_names = ['case1', 'case2', 'case3', 'case4']
+        assert upcomingUnreviewedCases(case_names, 1, {'case3': {}}, 2) == ['case4', 'case1']
+        assert upcomingUnreviewedCases(case_names, 3, {}, 10) == ['case1', 'case2', 'case3']
+        assert upcomingUnreviewedCases(case_names, 0, {'case2': {}, 'case3': {}, 'case4': {}}, 1) == []
+        assert upcomingUnreviewedCases(case_names, None, {}, 1) == ['case2']
+        assert upcomingUnreviewedCases(case_names, 0, {'case4': {}}, 3, lambda case_name: case_name != 'case2') == ['case3']
+
+        # loading a case saves a session, so the user's last session setting is put back afterwards
+        lastSession = qt.QSettings().value('SegReview/lastSession')
+        tempdir = tempfile.mkdtemp()
+        parent = slicer.qMRMLWidget()
+        parent.setLayout(qt.QVBoxLayout())
+        parent.setMRMLScene(slicer.mrmlScene)
+        widget = SegReviewWidget(parent)
+        widget.setup()
+        widget.config['verdictFilename'] = os.path.join(tempdir, 'verdicts.jsonl')
+        image_label_dict = OrderedDict()
+        for case_name in case_names[:3]:
+            image_fn, label_fn = os.path.join(tempdir, case_name+'_t1.nii.gz'), os.path.join(tempdir, case_name+'_seg.nii.gz')
+            sitk.WriteImage(sitk.GetImageFromArray(np.ones((4, 8, 8), np.float32)), image_fn)
+            label = np.zeros((4, 8, 8), np.uint8)
+            label[1:3, 2:5, 2:5] = 1
+            sitk.WriteImage(sitk.GetImageFromArray(label), label_fn)
+            image_label_dict[case_name] = OrderedDict((name, image_fn) for name in widget.config['imageFilenamePatterns']), label_fn
+        widget.image_label_dict = image_label_dict
+        widget.dataSource = {'manifest': os.path.join(tempdir, 'manifest.csv')}
+        widget.updateWidgets()
+
+        # a verdict moves on to the next unreviewed case, skipping cases that already have one
+        widget.triageModeCheckBox.checked = True
+        widget.verdictLog.append({'case': 'case2', 'verdict': 'accept', 'comment': ''})
+        widget.recordVerdict('reject')
+        assert widget.caseComboBox.currentText == 'case3' and widget.selected_image_ind == 2
+        assert widget.verdictLog.verdicts['case1']['verdict'] == 'reject'
+        widget.recordVerdict('flag')
+        assert widget.caseComboBox.currentText == 'case3', 'every case has a verdict'
+        assert widget.verdictStatusLabel.text.startswith('Last verdict: flag case3 (every case has a verdict)')
+
+        # choosing a case that can't be loaded leaves the open case selected
+        widget.badCaseFiles = {'case2': {image_label_dict['case2'][1]: 'truncated file'}}
+        widget.caseComboBox.setCurrentIndex(1)
+        assert widget.caseComboBox.currentText == 'case3' and widget.selected_image_ind == 2
+        assert not widget.isCaseLoadable('case2') and widget.isCaseLoadable('case1')
+        widget.badCaseFiles = {}
+
+        # reordering the cases keeps the open case open and selected
+        widget.qcScores = {'case3': 2.0, 'case1': 1.0}
+        widget.orderByAnomalyCheckBox.checked = True
+        assert list(widget.image_label_dict) == ['case3', 'case1', 'case2']
+        assert widget.caseComboBox.currentText == 'case3' and widget.selected_image_ind == 0 and widget.active_case_name == 'case3'
+        widget.orderByAnomalyCheckBox.checked = False
+        assert widget.caseComboBox.currentText == 'case3' and widget.selected_image_ind == 2
+
+        # the hotkeys only exist while the module is shown
+        widget.enter()
+        assert len(widget.triageShortcuts) == 4
+        widget.exit()
+        assert widget.triageShortcuts == []
+        widget.triageModeCheckBox.checked = False
+        widget.enter()
+        assert widget.triageShortcuts == []
+
+        widget.cleanup()
+        parent.deleteLater()
+        if lastSession:
+            qt.QSettings().setValue('SegReview/lastSession', lastSession)
+        else:
+            qt.QSettings().remove('SegReview/lastSession')
+        shutil.rmtree(tempdir)
+        self.delayDisplay('Triage test passed')
+
+
+    def testThumbnail(self):
+        self.delayDisplay('Thumbnail test')
+        import SimpleITK as sitk
+
+        tempdir = tempfile.mkdtemp()
+        image = np.random.default_rng(0).normal(100, 10, size=(20, 60, 40)).astype(np.float32)
+        label = np.zeros(image.shape, np.uint8)
+        label[7, 10:30, 10:20] = 1  # largest ROI area is on slice 7
+        label[3, 5:8, 5:8] = 2
+        image_fn, label_fn = os.path.join(tempdir, 't1.nii.gz'), os.path.join(tempdir, 'seg.nii.gz')
+        sitk.WriteImage(sitk.GetImageFromArray(image), image_fn)
+        sitk.WriteImage(sitk.GetImageFromArray(label), label_fn)
+
+        thumbnail_fn = os.path.join(tempdir, 'thumbnail.png')
+        renderThumbnail(image_fn, [(label_fn, {1: (255, 0, 0), 2: (0, 255, 0)})], thumbnail_fn, size=128)
+        thumbnail = sitk.GetArrayFromImage(sitk.ReadImage(thumbnail_fn))
+        assert thumbnail.shape == (128, 128, 3)
+        outline = np.argwhere((thumbnail == (255, 0, 0)).all(axis=-1))
+        assert len(outline) and outline.min(axis=0).tolist() == [22, 43] and outline.max(axis=0).tolist() == [63, 63]
+        assert not (thumbnail == (0, 255, 0)).all(axis=-1).any(), 'ROI 2 is not on the chosen slice'
+
+        # the mosaic keys thumbnails by content, so a copy of the case reuses the cached one
+        mosaic = ThumbnailMosaic('Thumbnail test', os.path.join(tempdir, 'thumbnails'), lambda caseName: None, size=64)
+        segs = [(label_fn, {1: (255, 0, 0)})]
+        assert mosaic.thumbnail(image_fn, segs)[1] and not mosaic.thumbnail(image_fn, segs)[1]
+        copyDir = os.path.join(tempdir, 'copy')
+        os.makedirs(copyDir)
+        for fn in (image_fn, label_fn):
+            shutil.copy(fn, copyDir)
+        assert mosaic.thumbnail(os.path.join(copyDir, 't1.nii.gz'), [(os.path.join(copyDir, 'seg.nii.gz'), {1: (255, 0, 0)})]) == (mosaic.thumbnailFilename(image_fn, segs), False)
+        mosaic.dialog.deleteLater()
+
+        shutil.rmtree(tempdir)
+        self.delayDisplay('Thumbnail test passed')